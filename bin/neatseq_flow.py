@@ -23,7 +23,6 @@ sys.path.pop(0)
 # Append neatseq_flow path to list (when using installed version, will find it before getting to this search path)
 # Problem that might arrise: When trying to run a local copy when it is installed in site-packages/
 sys.path.append(os.path.realpath(os.path.expanduser(os.path.dirname(os.path.abspath(__file__))+os.sep+"..")))
-from neatseq_flow.PLC_main import NeatSeqFlow
 
 # Parse arguments:
 parser = argparse.ArgumentParser(description="""
@@ -50,6 +49,18 @@ parser.add_argument("--delete", help="Delete all NeatSeq-Flow folders in workflo
 parser.add_argument("-V", "--verbose", help="Print admonitions?", action='store_true')
 parser.add_argument("-v", "--version", help="Print version and exit.", action='store_true')
 parser.add_argument("--list_modules", help="List modules available in modules_paths.", action='store_true')
+parser.add_argument("--parallel", help="Number of processes to use for building the scripts of independent steps "
+                                       "in parallel. Default: build serially.", type=int, default=None)
+parser.add_argument("--incremental", help="Reuse the scripts of steps that have not changed since the previous run. "
+                                          "Only changed steps and the steps downstream of them are rebuilt. The run "
+                                          "ID of reused scripts is updated.", action='store_true')
+parser.add_argument("--profile", help="Time the phases of script generation. Writes a trace file (Chrome trace "
+                                      "format) to the objects dir and prints the N slowest phases (default 20).",
+                    nargs="?", type=int, const=20, default=None, metavar="N")
+parser.add_argument("--param_cache", help="Cache the parsed parameter files in directory DIR, and reuse them when the "
+                                          "files have not changed. Default DIR: $NSF_CACHE_DIR or "
+                                          "~/.cache/neatseq_flow.",
+                    nargs="?", const="", default=None, metavar="DIR")
 
 args = parser.parse_args()
 
@@ -110,6 +121,9 @@ if args.sample_file is None or args.param_file is None:
 # Converting list of parameter files into comma-separated list. This is deciphered by the neatseq_flow class.
 args.param_file = ",".join(args.param_file)
 
+# Imported only when needed, so that --version, --delete etc. do not load the workflow modules
+from neatseq_flow.PLC_main import NeatSeqFlow
+
 try:
     NeatSeqFlow(sample_file   = args.sample_file,
                 param_file    = args.param_file,
@@ -118,6 +132,10 @@ try:
                 message       = args.message,
                 runid         = args.runid,
                 verbose       = args.verbose,
-                list_modules  = args.list_modules)
+                list_modules  = args.list_modules,
+                parallel      = args.parallel,
+                incremental   = args.incremental,
+                profile       = args.profile,
+                param_cache   = args.param_cache)
 except SystemExit:
     pass
\ No newline at end of file
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+
+""" Benchmark workflow generation
+
+Generates synthetic workflows of different shapes and sizes with each executor, and records the wall time, peak
+memory and files written. See neatseq_flow/modules/benchmark.py
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+__affiliation__ = "Bioinformatics Core Unit, NIBN, Ben Gurion University"
+
+
+import os
+import sys
+import json
+import shlex
+import argparse
+
+# Remove bin from search path:
+sys.path.pop(0)
+# Append neatseq_flow path to list (when using installed version, will find it before getting to this search path)
+sys.path.append(os.path.realpath(os.path.expanduser(os.path.dirname(os.path.abspath(__file__))+os.sep+"..")))
+
+from neatseq_flow.modules.benchmark import SHAPES, run_benchmark, compare_results
+
+# Parse arguments:
+parser = argparse.ArgumentParser(description="""
+Benchmark NeatSeq-Flow script generation on synthetic workflows.
+
+For each combination of shape, size and executor, a workflow is generated and its wall time, peak memory and the
+number and size of the files written are saved to a JSON file. Pass --baseline to compare the results with a previous
+JSON file. The exit status is 1 if there are regressions.
+""",
+                                 epilog="""
+Author: Menachem Sklarz, NIBN
+""")
+parser.add_argument("--shapes", help="Comma-separated list of workflow shapes: {shapes}. Default: all".
+                    format(shapes=", ".join(SHAPES)), default=",".join(SHAPES))
+parser.add_argument("--sizes", help="Comma-separated list of workflow sizes, each as STEPSxSAMPLESxTYPES: number of "
+                                    "steps, number of samples and number of file types per sample. "
+                                    "Default: 5x10x2,20x100x2", default="5x10x2,20x100x2")
+parser.add_argument("--executors", help="Comma-separated list of executors. Default: Local,SGE,SLURM",
+                    default="Local,SGE,SLURM")
+parser.add_argument("--repeats", help="Number of times to generate each workflow. The shortest time is reported. "
+                                      "Default: 1", type=int, default=1)
+parser.add_argument("-o", "--output", help="JSON file for the results. Default: benchmark.json",
+                    default="benchmark.json")
+parser.add_argument("--work_dir", help="Directory in which to generate the workflows. Default: a temporary directory")
+parser.add_argument("--keep", help="Keep the generated workflows in --work_dir", action='store_true')
+parser.add_argument("--nsf_args", help="Extra arguments for neatseq_flow.py, e.g. '--parallel 4'", default="")
+parser.add_argument("--baseline", help="A results JSON file to compare the results with")
+parser.add_argument("--tolerance", help="Fraction by which time, memory and output size may grow before being "
+                                        "reported as a regression. Default: 0.25", type=float, default=0.25)
+
+args = parser.parse_args()
+
+try:
+    benchmark = run_benchmark(shapes=args.shapes.split(","),
+                              sizes=args.sizes.split(","),
+                              executors=args.executors.split(","),
+                              output=args.output,
+                              work_dir=args.work_dir,
+                              repeats=args.repeats,
+                              nsf_args=shlex.split(args.nsf_args),
+                              keep=args.keep)
+except ValueError as err:
+    sys.exit(str(err))
+
+failed = [result["name"] for result in benchmark["results"] if result["status"] != "ok"]
+if args.baseline:
+    with open(args.baseline, "r") as baseline_fh:
+        baseline = json.load(baseline_fh)
+    regressions = compare_results(benchmark, baseline, tolerance=args.tolerance)
+    print("{num} regressions found".format(num=regressions))
+    if regressions:
+        sys.exit(1)
+elif failed:
+    sys.exit("Generation failed for: {failed}".format(failed=", ".join(failed)))
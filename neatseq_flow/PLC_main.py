@@ -23,7 +23,10 @@ from collections import OrderedDict
 from traceback import format_exc
 
 from .modules.parse_sample_data import parse_sample_file,parse_grouping_file
-from .modules.parse_param_data import parse_param_file
+from .modules.workflow_graph import expand_dependencies
+from .modules.index_writer import IndexWriter
+from .modules.profiler import Profiler, NullProfiler
+from .modules.script_constructor_registry import get_script_constructors
 
 from .PLC_step import Step, AssertionExcept
 
@@ -40,11 +43,22 @@ class NeatSeqFlow(object):
                  message       = None,
                  runid = None,
                  verbose = False,
-                 list_modules = False):
+                 list_modules = False,
+                 parallel = None,
+                 incremental = False,
+                 profile = None,
+                 param_cache = None):
         """
         Initialize and create all workflow scripts.
+        If profile is set, the generation phases are timed, and the 'profile' slowest phases are reported.
+        If param_cache is set, the parsed parameter files are cached in directory param_cache (see
+        modules/param_cache.py). Pass "" for the default cache directory.
         :returns: A workflow object
         """
+        # Profiler for timing the generation phases (see modules/profiler.py):
+        self.profile = profile
+        self.profiler = Profiler() if profile else NullProfiler()
+
         # Read and parse the sample and parameter files:
 
         sys.stdout.write("Reading files...\n")
@@ -52,7 +66,8 @@ class NeatSeqFlow(object):
 
         # Reading sample_file
         try:
-            self.sample_data = parse_sample_file(sample_file)
+            with self.profiler.phase("parse_sample_file"):
+                self.sample_data = parse_sample_file(sample_file)
         except Exception as raisedex:
             print("An exception has occurred in sample file reading. Double check!")
             if re.match(string=raisedex.args[0],pattern="Issues in"):
@@ -60,8 +75,13 @@ class NeatSeqFlow(object):
                 return
             raise raisedex
         # Reading parameter file
+        # Imported here, so that importing this module does not load yaml
+        from .modules.parse_param_data import parse_param_file
+        from .modules.param_cache import ParamCache
         try:
-            self.param_data = parse_param_file(param_file)
+            with self.profiler.phase("parse_param_file"):
+                self.param_data = parse_param_file(param_file,
+                                                   ParamCache(param_cache) if param_cache is not None else None)
         except Exception as raisedex:
             if raisedex.args[0] == "Issues in parameters":
                 print(raisedex.args[1])
@@ -102,7 +122,8 @@ class NeatSeqFlow(object):
                     grouping_file=grouping_file[0]
 
             try:
-                mapping_data = parse_grouping_file(grouping_file)
+                with self.profiler.phase("parse_grouping_file"):
+                    mapping_data = parse_grouping_file(grouping_file)
             except Exception as raisedex:
                 if raisedex.args[0] == "Issues in grouping":
                     print(raisedex.args[1])
@@ -155,6 +176,16 @@ class NeatSeqFlow(object):
 
         self.pipe_data["verbose"] = verbose
 
+        # Number of processes for building the scripts. Not stored in pipe_data, which is saved in the JSON file.
+        self.parallel = parallel
+
+        # Writer for the script, run and depend indices. Steps pass their lines to it, and it is flushed per step:
+        self.index_writer = IndexWriter()
+
+        # Reuse steps that have not changed since the previous run? (see modules/step_cache.py)
+        self.incremental = incremental
+        self.step_cache = None
+
         # Create run code to identify the scripts etc.
         # Date+rand num (to preserve order of pipelines)
         if runid:
@@ -177,9 +208,53 @@ class NeatSeqFlow(object):
         self.pipe_data["run_code"] = self.run_code
 
         # Putting following global types in pipe_data:
-        for topipedata in ["Default_wait", "job_limit","setenv"]:
+        for topipedata in ["Default_wait", "job_limit", "setenv", "array_jobs", "local_scheduler", "local_resources",
+                           "run_state", "event_log"]:
             if topipedata in self.param_data["Global"]:
                 self.pipe_data[topipedata] = self.param_data["Global"][topipedata]
+        # Run Local jobs with a scheduler daemon? (see modules/local_scheduler.py)
+        if "local_scheduler" in self.pipe_data:
+            if str(self.pipe_data["local_scheduler"]).upper() in ["FALSE", "NO", "NONE", ""]:
+                del self.pipe_data["local_scheduler"]
+            elif self.pipe_data["Executor"] != "Local":
+                sys.stderr.write("WARNING: 'local_scheduler' is used only by the Local executor. "
+                                 "Ignoring 'local_scheduler'.\n")
+                del self.pipe_data["local_scheduler"]
+        # Capacity of the node for Local jobs. By default, detected when the jobs are run:
+        if "local_resources" in self.pipe_data:
+            if self.pipe_data["Executor"] != "Local":
+                sys.stderr.write("WARNING: 'local_resources' is used only by the Local executor. "
+                                 "Ignoring 'local_resources'.\n")
+                del self.pipe_data["local_resources"]
+            else:
+                try:
+                    self.pipe_data["local_resources"] = self.get_local_resources(self.pipe_data["local_resources"])
+                except Exception as raisedex:
+                    print("ERROR: " + raisedex.args[0])
+                    return
+        # Keep the run state in an SQLite database instead of run_index? (see modules/run_state.py)
+        if "run_state" in self.pipe_data:
+            if str(self.pipe_data["run_state"]).lower() in ["false", "no", "none", "", "text"]:
+                del self.pipe_data["run_state"]
+            elif str(self.pipe_data["run_state"]).lower() != "sqlite":
+                print("ERROR: 'run_state' must be 'sqlite' or 'text' ({value})".
+                      format(value=self.pipe_data["run_state"]))
+                return
+            elif self.pipe_data["Executor"] not in ["Local", "SLURM"]:
+                sys.stderr.write("WARNING: 'run_state' is used only by the Local and SLURM executors. "
+                                 "Ignoring 'run_state'.\n")
+                del self.pipe_data["run_state"]
+        # Append the job events to a JSON lines event log instead of the log file? (see modules/event_log.py)
+        if "event_log" in self.pipe_data:
+            if str(self.pipe_data["event_log"]).lower() in ["false", "no", "none", "", "text"]:
+                del self.pipe_data["event_log"]
+            elif str(self.pipe_data["event_log"]).lower() != "jsonl":
+                print("ERROR: 'event_log' must be 'jsonl' or 'text' ({value})".
+                      format(value=self.pipe_data["event_log"]))
+                return
+        if "array_jobs" in self.pipe_data and not get_script_constructors(self.pipe_data).has_class("array"):
+            sys.stderr.write("WARNING: Executor {executor} does not support array jobs. "
+                             "Ignoring 'array_jobs'.\n".format(executor=self.pipe_data["Executor"]))
         # if "job_limit" in list(self.param_data["Global"].keys()):
         #     self.pipe_data["job_limit"] = self.param_data["Global"]["job_limit"]
 
@@ -213,7 +288,8 @@ class NeatSeqFlow(object):
 
         # Expanding dependencies based on "base" parameter:
         # Storing in self.depend_dict
-        self.expand_depends()
+        with self.profiler.phase("expand_depends"):
+            self.expand_depends()
 
         # Create directory structure:
         sys.stdout.write("Creating directory structure...\n")
@@ -240,6 +316,12 @@ class NeatSeqFlow(object):
         # Create script execution script:
         self.create_script_execution_script()
 
+        # Create script for using the run state database:
+        self.create_run_state_script()
+
+        # Create script for writing the log file from the event log:
+        self.create_event_log_script()
+
         # Create file md5sum registration file:
         self.create_registration_file()
         
@@ -258,7 +340,8 @@ class NeatSeqFlow(object):
         sys.stdout.flush()
 
         try:
-            self.make_step_instances()
+            with self.profiler.phase("make_step_instances"):
+                self.make_step_instances()
 
         except AssertionExcept as assertErr:
             print(assertErr.get_error_str())
@@ -290,50 +373,63 @@ class NeatSeqFlow(object):
         # Also, catching assetion exceptions raised by class build_scripts() and 
         sys.stdout.write("Building scripts for:\n")
         try:
-            self.build_scripts()
-            
+            with self.profiler.phase("build_scripts"):
+                self.build_scripts()
+
         except AssertionExcept as assertErr:
             print(assertErr.get_error_str())
             print("An error has occurred. See comment above.\nPrinting current JSON and exiting\n")
-            with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-                json_fh.write(self.get_json_encoding())
+            self.write_workflow_data()
             # sys.exit()
             self.cleanup()
             return
 
-        # Make main script:
-        self.make_main_pipeline_script()
+        with self.profiler.phase("create_main_scripts"):
+            # Make main script:
+            self.make_main_pipeline_script()
 
-        # Make main scripts for tags:
-        self.make_tag_steps_script()
+            # Make main scripts for tags:
+            self.make_tag_steps_script()
 
-        # Make the qalter script:
-        self.create_qalter_script()
+            # Make the qalter script:
+            self.create_qalter_script()
+
+            # Create reverse dependency index
+            self.create_reverse_depends_file()
 
-        # Create reverse dependency index
-        self.create_reverse_depends_file()
+            # Make intermediate removal script
+            self.create_rm_intermediate_script()
 
-        # Make intermediate removal script
-        self.create_rm_intermediate_script()
+            # Create the run state database from run_index (requires all the scripts to be built):
+            self.create_run_state_db()
 
         # Make js graphical representation (maybe add parameter to not include this feature?)
         sys.stdout.write("Making workflow plots...\n")
-        self.create_js_graphic()
-        self.create_diagrammer_graphic()
+        with self.profiler.phase("create_js_graphic"):
+            self.create_js_graphic()
+        with self.profiler.phase("create_diagrammer_graphic"):
+            self.create_diagrammer_graphic()
         
         # Writing JSON encoding ofg pipeline:
         sys.stdout.write("Writing JSON files...\n")
-        with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-            json_fh.write(self.get_json_encoding())
-        # Writing JSON encoding of qsub names (can be used by remote progress monitor)
-        with open(self.pipe_data["objects_dir"]+"qsub_names.json", "w") as json_fh:
-            json_fh.write(self.get_qsub_names_json_encoding())
+        with self.profiler.phase("write_json"):
+            self.write_workflow_data()
+            # Writing JSON encoding of qsub names (can be used by remote progress monitor)
+            with open(self.pipe_data["objects_dir"]+"qsub_names.json", "w") as json_fh:
+                json_fh.write(self.get_qsub_names_json_encoding())
 
         # Step cleanup
         [step_n.cleanup() for step_n in self.step_list]
-        
+
+        # Saving the steps built, for reuse by the next incremental run (requires the step scripts to be closed):
+        if self.step_cache is not None:
+            self.step_cache.save()
+
         self.create_log_plotter()
-        
+
+        if self.profile:
+            self.write_profile()
+
         sys.stderr.flush()
         sys.stdout.flush()
 
@@ -355,6 +451,28 @@ class NeatSeqFlow(object):
         # If Qsub_opts is defined by user in global params, copy into pipe_data:
         self.pipe_data["qsub_params"]["opts"] = self.param_data["Global"]["Qsub_opts"] if "Qsub_opts" in list(self.param_data["Global"].keys()) else {}
 
+    def get_local_resources(self, local_resources):
+        """ Returns the node capacity set in 'local_resources' as a {"cpus": number, "mem": MB} dict.
+            Resources not set are None, and are detected when the jobs are run.
+        """
+        if not local_resources:
+            return {"cpus": None, "mem": None}
+        if not isinstance(local_resources, dict) or set(local_resources) - {"cpus", "mem"}:
+            raise Exception("'local_resources' must be a block with 'cpus' and/or 'mem', e.g. {cpus: 8, mem: 32G}",
+                            "parameters")
+        cpus = local_resources.get("cpus")
+        if cpus is not None and (not re.match("^[0-9]+$", str(cpus)) or int(cpus) < 1):
+            raise Exception("'cpus' in 'local_resources' must be a positive integer ({cpus})".format(cpus=cpus),
+                            "parameters")
+        mem = local_resources.get("mem")
+        if mem is not None:
+            from .modules.local_scheduler import parse_mem_size
+            mem = parse_mem_size(mem)
+            if not mem:
+                raise Exception("'mem' in 'local_resources' must be a memory size, e.g. 32G ({mem})".
+                                format(mem=local_resources["mem"]), "parameters")
+        return {"cpus": int(cpus) if cpus is not None else None, "mem": mem}
+
     # Handlers
     def get_param_data(self):
         """ Return parameter data
@@ -393,57 +511,108 @@ class NeatSeqFlow(object):
         
     def build_scripts(self):
         """ Run the actual script building
+            If self.parallel is larger than 1, steps are built in parallel (see modules/parallel_build.py)
+            If self.incremental is set, steps that have not changed are restored instead of built
+            (see modules/step_cache.py)
         """
+        if self.incremental:
+            # Imported here, because it is not needed otherwise
+            from .modules.step_cache import StepCache
+            self.step_cache = StepCache(self)
+
+        if self.parallel and self.parallel > 1:
+            from .modules.parallel_build import build_scripts_parallel
+            build_scripts_parallel(self, self.parallel)
+            return
+
         # For each step name (step_n), set sample_data based on the steps base(s) and then create scripts
         for step_n in self.step_list:
-            try:
-                
-                step_name = step_n.get_step_name()
-                # step_step = step_n.get_step_step()
-                sys.stdout.write('<span  style="color:purple;">......['+step_name+']</span >'+"\n")
-                
-                # Find base step(s) for current step: (If does not exist return None)
-                base_name_list = step_n.get_base_step_name()
-
-                # For Import, 1st step, this will be true, passing the original sample_data to the step:
-                if base_name_list is None:
-                    step_n.set_sample_data(self.sample_data)
-                    step_n.set_base_step([])
-                # For the others, finds the instance(s) of the base step(s) and
-                # calls set_base_step() with the list of bases:
-                else:
-                    # Note: set_base_step() takes a list of step objects, not names.
-                    # Finding them is done by the .index() method.
-                    step_n.set_base_step([self.step_list[self.step_list_index.index(base_name)]
-                                          for base_name
-                                          in base_name_list])
+            self.print_step_name(step_n)
+            self.build_step(step_n)
+
+    def print_step_name(self, step_n):
+        """ Print the name of a step when starting to build it
+        """
+        sys.stdout.write('<span  style="color:purple;">......['+step_n.get_step_name()+']</span >'+"\n")
+
+    def restore_step(self, step_n):
+        """ Restore step_n from the previous run if it has not changed. Returns True if the step was restored.
+        """
+        if self.step_cache is None:
+            return False
+        with self.profiler.phase("restore_step", "step", step=step_n.get_step_name()):
+            return self.step_cache.restore(step_n)
 
-                # Do the actual script building for step_n
+    def build_step(self, step_n):
+        """ Build step_n, or restore it if it has not changed, and write its lines in the shared files
+        """
+        if self.restore_step(step_n):
+            self.write_step_output(step_n)
+            return
+        if self.step_cache is not None:
+            # Keeping the step's writes to the shared files, for saving with the step:
+            step_n.deferred_writes = list()
+        try:
+            self.make_step_scripts(step_n)
+        finally:
+            self.write_step_output(step_n)
+
+    def write_step_output(self, step_n):
+        """ Write the lines step_n added to the shared files
+        """
+        writes = step_n.deferred_writes
+        step_n.write_deferred()
+        self.index_writer.flush()
+        if self.step_cache is not None and writes is not None:
+            self.step_cache.add_built_step(step_n, writes)
+
+    def make_step_scripts(self, step_n):
+        """ Set sample_data for step_n based on the step's base(s) and then create its scripts
+        """
+        try:
+            # Find base step(s) for current step: (If does not exist return None)
+            base_name_list = step_n.get_base_step_name()
+
+            # For Import, 1st step, this will be true, passing the original sample_data to the step:
+            if base_name_list is None:
+                step_n.set_sample_data(self.sample_data)
+                step_n.set_base_step([])
+            # For the others, finds the instance(s) of the base step(s) and
+            # calls set_base_step() with the list of bases:
+            else:
+                # Note: set_base_step() takes a list of step objects, not names.
+                # Finding them is done by the .index() method.
+                step_n.set_base_step([self.step_list[self.step_list_index.index(base_name)]
+                                      for base_name
+                                      in base_name_list])
+
+            # Do the actual script building for step_n
+            with self.profiler.phase("create_all_scripts", "step", step=step_n.get_step_name()):
                 step_n.create_all_scripts()
 
-            # Catching cases where a module refers to a file type that does not exist. This is so that the module
-            # developer does not have to check all file types he might need.
-            # All other exceptions will be raised as-is for debiugging by module developer.
-            except KeyError as keyexc:
-                print(step_n)
-                t1 = format_exc()
-                t1 = t1.split("\n")[-3]
-                # In last line but one, see if the exception is in a reference to self.sample_data. If so, extract type
-                # and raise AssertionExcept.
-                parse_error = re.search(string=t1, pattern="self\.sample_data\[(.*?)\]\[(.*?)\]")
-                if parse_error is not None:
-                    key_lev, file_type = parse_error.groups()
-                    raise AssertionExcept("Type {type} does not exists! Check scope and previous steps.".
-                                          format(type=file_type),
-                                          step=step_n.get_step_name())
-                if re.search(string=t1, pattern="self\.params"):
-                    print(t1)
-                    dict_path = re.findall(string=t1, pattern="\[(.*?)\]")
-                    raise AssertionExcept("You have to define the following key in the parameter file: {type} ".
-                                          format(type="->".join(dict_path)),
-                                          step=step_n.get_step_name())
-
-                raise keyexc
+        # Catching cases where a module refers to a file type that does not exist. This is so that the module
+        # developer does not have to check all file types he might need.
+        # All other exceptions will be raised as-is for debiugging by module developer.
+        except KeyError as keyexc:
+            print(step_n)
+            t1 = format_exc()
+            t1 = t1.split("\n")[-3]
+            # In last line but one, see if the exception is in a reference to self.sample_data. If so, extract type
+            # and raise AssertionExcept.
+            parse_error = re.search(string=t1, pattern="self\.sample_data\[(.*?)\]\[(.*?)\]")
+            if parse_error is not None:
+                key_lev, file_type = parse_error.groups()
+                raise AssertionExcept("Type {type} does not exists! Check scope and previous steps.".
+                                      format(type=file_type),
+                                      step=step_n.get_step_name())
+            if re.search(string=t1, pattern="self\.params"):
+                print(t1)
+                dict_path = re.findall(string=t1, pattern="\[(.*?)\]")
+                raise AssertionExcept("You have to define the following key in the parameter file: {type} ".
+                                      format(type="->".join(dict_path)),
+                                      step=step_n.get_step_name())
+
+            raise keyexc
 
     def make_depends_dict(self):
         """ Creates and returns the basic depend_dict structure
@@ -464,23 +633,9 @@ class NeatSeqFlow(object):
         # Get the base list for each step.
         self.make_depends_dict()
 
-        # Convert from dict of lists to dict of sets:
-        depend_dict = {key:set(value) for key,value in self.depend_dict.items()}
-        new_depend_dict = deepcopy(depend_dict)
-
-        while True:
-            temp_dd = deepcopy(new_depend_dict)
-            for key in list(temp_dd.keys()):
-                for substep in temp_dd[key]:
-                    if substep:
-                        new_depend_dict[key] = new_depend_dict[key] | (temp_dd[substep] - set([""]))
-            if all([temp_dd[x] == new_depend_dict[x] for x in list(new_depend_dict.keys())]):
-                break
-        new_depend_dict = {key:list(value) if value!={''} else list()
-                           for key,value
-                           in new_depend_dict.items()}
-
-        looping_steps = [k for k,v in new_depend_dict.items() if k in v]
+        # Get the ancestors of each step and the order of the steps in one pass over the graph:
+        new_depend_dict, self.step_order, looping_steps = expand_dependencies(self.depend_dict)
+
         if looping_steps:
             sys.exit("There seems to be a cycle in the workflow design. "
                      "Check dependencies of steps: {offenders}".format(offenders=", ".join(looping_steps)))
@@ -496,15 +651,16 @@ class NeatSeqFlow(object):
 
     def sort_step_list(self):
         """ This function sorts the step list
-            By default uses the list.sort function on the step list, which sorts the steps by level, i.e. all direct merge dependents first, then their dependents, etc.
+            By default uses the topological order found in expand_depends(), which sorts the steps by level, i.e. all direct merge dependents first, then their dependents, etc.
             A different sorting scheme can be added here for depth-wise sorting, for instance.
         """
-        
-        self.step_list.sort()    # Sort by internal __lt__ and __gt__
+
+        step_position = {name: position for position, name in enumerate(self.step_order)}
+        self.step_list.sort(key=lambda step_n: step_position[step_n.get_step_name()])
         
     def make_step_instances(self):
         """ Makes step instances and stores them in self.step_list.
-            The steps are also sorted based on their dependencies. See __lt__ and __gt__ in "Step" class definition.
+            The steps are also sorted based on their dependencies. See sort_step_list().
         """
         # The list of steps is created using a helper function, make_step_type_instance.
         # See definition of make_step_type_instance to see how step type is determined and imported...
@@ -646,7 +802,10 @@ class NeatSeqFlow(object):
         step_params = self.get_step_param_data()[step_type][step_name]
         
         # Find the location of the step module in the file structure (see function find_step_module())
-        step_module_loc, step_module_path = Step.find_step_module(step_type, self.param_data, self.pipe_data)  # Passing param data because it contains the optional search path...
+        step_module_loc, step_module_path = Step.find_step_module(step_type,
+                                                                  self.param_data,
+                                                                  self.pipe_data,
+                                                                  self.get_module_index())
         try:
             # Import the module:
             StepClass = getattr(importlib.import_module(step_module_loc), 'Step_'+step_type)
@@ -665,6 +824,8 @@ CMD: from {loc} import {type} as StepClass""".format(loc=step_module_loc,type='S
                              pipe_data=self.pipe_data,
                              module_path=step_module_path,
                              caller=self)
+        new_step.index_writer = self.index_writer
+        new_step.profiler = self.profiler
 
         return new_step
         # except AssertionExcept as assertErr:
@@ -747,11 +908,7 @@ CMD: from {loc} import {type} as StepClass""".format(loc=step_module_loc,type='S
         self.pipe_data["kill_script_name"] = self.pipe_data["scripts_dir"] + "99.kill_all.sh"
         
         # Creation itself is done in ScriptConstrutor class
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".\
-            format(executor=self.pipe_data["Executor"])
-        classname = "KillScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
-
-        scriptclass = getattr(importlib.import_module(modname), classname)
+        scriptclass = get_script_constructors(self.pipe_data).get_class("kill")
         kill_script_preamble = scriptclass.get_main_preamble(self.pipe_data["run_index"])
         kill_script_postamble = scriptclass.get_main_postamble(self.pipe_data["run_index"])
 
@@ -786,14 +943,9 @@ CMD: from {loc} import {type} as StepClass""".format(loc=step_module_loc,type='S
         """
         self.pipe_data["helper_funcs"] = self.pipe_data["scripts_dir"] + "CC.helper_funcs.sh"
 
-        # modname: the module path for current executor
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".\
-            format(executor=self.pipe_data["Executor"])
-        # classname: the name of the class for current executor
-        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
-
         try:
-            scriptclass = getattr(importlib.import_module(modname), classname)
+            # The base script constructor class of the current executor
+            scriptclass = get_script_constructors(self.pipe_data).get_class()
             helper_script = scriptclass.get_helper_script(self.pipe_data)
             with open(self.pipe_data["helper_funcs"], "w") as script_fh:
                 script_fh.write(helper_script)
@@ -806,10 +958,7 @@ CMD: from {loc} import {type} as StepClass""".format(loc=step_module_loc,type='S
             In includes functions to be execute for trapping error and SIGUSR2 signals
         """
 
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}". \
-            format(executor=self.pipe_data["Executor"])
-        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
-        scriptclass = getattr(importlib.import_module(modname), classname)
+        scriptclass = get_script_constructors(self.pipe_data).get_class()
 
         try:
             utilities_script = scriptclass.get_utilities_script(self.pipe_data)
@@ -851,6 +1000,13 @@ Pipeline {run_code} logfile:
 Timestamp\tEvent\tModule\tInstance\tJob name\tLevel\tHost\tJob ID\tMax mem\tStatus
 """)
 
+        # With 'event_log: jsonl', the jobs write their events to the event log. The log file is written from it with
+        # scripts/NSF_event_log.sh:
+        if "event_log" in self.pipe_data:
+            self.pipe_data["event_log_file"] = "{log_dir}log_{run_code}.jsonl".format(log_dir=self.pipe_data["logs_dir"],
+                                                                                     run_code=self.pipe_data["run_code"])
+            self.pipe_data["event_log_script"] = "".join([self.pipe_data["scripts_dir"], "NSF_event_log.sh"])
+
         # Set file name for storing list of pipeline versions:
         self.pipe_data["version_list_file"] = "".join([self.pipe_data["logs_dir"], "version_list.txt"])
         # if not os.path.exists(self.pipe_data["version_list_file"]):
@@ -869,6 +1025,11 @@ Timestamp\tEvent\tModule\tInstance\tJob name\tLevel\tHost\tJob ID\tMax mem\tStat
         self.pipe_data["run_index"] = "".join([self.pipe_data["objects_dir"], "run_index" ,  ".txt"])
         # Clearing file:
         open(self.pipe_data["run_index"], "w").close()
+        # With 'run_state: sqlite', the run state is kept in a database, created from run_index when the scripts
+        # are built:
+        if "run_state" in self.pipe_data:
+            self.pipe_data["run_state_db"] = "".join([self.pipe_data["objects_dir"], "run_index", ".db"])
+            self.pipe_data["run_state_script"] = "".join([self.pipe_data["scripts_dir"], "NSF_run_state.sh"])
 
         # Set depend_index filename in pipe_data
         self.pipe_data["depend_index"] = "".join([self.pipe_data["objects_dir"], "depend_index", ".txt"])
@@ -959,6 +1120,17 @@ Date\tStep\tName\tScript\tFile\tmd5sum\n
         
         return ret_dict
 
+    def write_workflow_data(self):
+        """ Write the compact encoding of the workflow to WorkflowData.json (see modules/workflow_data.py).
+            Use WorkflowDataReader from the same module to read it.
+        """
+        from .modules.workflow_data import write_workflow_data
+        write_workflow_data(self.pipe_data["objects_dir"] + "WorkflowData.json",
+                            self.sample_data,
+                            self.pipe_data,
+                            self.param_data["Global"],
+                            self.step_list)
+
     def get_json_encoding(self):
         """ Convert pipeline data into JSON format
         """
@@ -1268,49 +1440,30 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         with open(self.pipe_data["objects_dir"] + "diagrammer.R" , "w") as diagrammer:
             diagrammer.write(Gviz_text)
 
+    def get_module_index(self):
+        """ Returns the index of available modules (see modules/module_index.py).
+            The index is created once per run, and saved in the objects dir for reuse by the next run.
+        """
+
+        if getattr(self, "module_index", None) is None:
+            from .modules.module_index import ModuleIndex
+            self.module_index = ModuleIndex(self.param_data["Global"].get("module_path", []),
+                                            Step.Cwd,
+                                            os.path.join(self.pipe_data["home_dir"], "objects", "module_index.json"))
+            self.module_index.save()
+        return self.module_index
+
     def find_modules(self):
         """ Searches all module repositories for a list of possible modules
             Meant to be used by the GUI generator for supplying the user with a list of modules he can include
         """
-        
-        if "module_path" in self.param_data["Global"]:
-            module_paths = self.param_data["Global"]["module_path"]
-            
-        module_paths.append(os.path.dirname(os.path.abspath(__file__)))
 
-        for module_path_raw in module_paths:#.split(" "):
-            # Remove trainling '/' from dir name. For some reason that botches things up!
-            module_path = module_path_raw.rstrip(os.sep)
-
-            # Expanding '~' and returning full path 
-            module_path = os.path.realpath(os.path.expanduser(module_path))
-
-            # Check the dir exists:
-            if not os.path.isdir(module_path):
-                sys.stderr.write("WARNING: Path %s from module_path does not exist. Skipping...\n" % module_path)
-                
-                continue
-
-            def walkerr(err):
-                """ Helper function for os.walk below. Catches errors during walking and reports on them.
-                """
-                print("WARNING: Error while searching for modules:")
-                print(err)
-
-            # module_list is a dictionary, where module name is the key and the value is a list of dirs in which the
-            # module exists.
-            module_list = dict()
-            dir_generator = os.walk(module_path, onerror = walkerr)
-            # Each .next call on this generator returns a level tuple as follows:
-            for level in dir_generator:
-                # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-                for file in [file for file in level[2] if re.match(".*\.py$",file)]:
-                    with open(level[0] + os.sep + file,"r") as pyt_fh:
-                        if re.search("class Step_%s"%file.strip(".py"),pyt_fh.read()):
-                            if file.strip(".py") not in module_list:
-                                module_list[file.strip(".py")] = list()
-                            module_list[file.strip(".py")].append(level[0].split(os.sep)[-1])
-            return module_list
+        module_index = self.get_module_index()
+        # module_list is a dictionary, where module name is the key and the value is a list of dirs in which the
+        # module exists.
+        module_list = module_index.list_modules()
+        module_index.save()
+        return module_list
 
     def add_step(self, step_name, step_params):
         """ Add a step to an existing main neatseq-flow class
@@ -1359,8 +1512,7 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         except AssertionExcept as assertErr:
             print(assertErr.get_error_str())
             print("An error has occurred. See comment above.\nPrinting current JSON and exiting\n")
-            with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-                json_fh.write(self.get_json_encoding())
+            self.write_workflow_data()
             # sys.exit()
             self.cleanup()
             return
@@ -1378,8 +1530,7 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         
         # Writing JSON encoding ofg pipeline:
         sys.stdout.write("Writing JSON files...\n")
-        with open(self.pipe_data["objects_dir"]+"WorkflowData.json", "w") as json_fh:
-            json_fh.write(self.get_json_encoding())
+        self.write_workflow_data()
         # Writing JSON encoding of qsub names (can be used by remote progress monitor)
         with open(self.pipe_data["objects_dir"]+"qsub_names.json", "w") as json_fh:
             json_fh.write(self.get_qsub_names_json_encoding())
@@ -1395,13 +1546,8 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
         """
         """
 
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(
-            executor=self.pipe_data["Executor"])
-        # classname = "get_script_exec_line"
-        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
-
         try:
-            scriptclass = getattr(importlib.import_module(modname), classname)
+            scriptclass = get_script_constructors(self.pipe_data).get_class()
             exec_script = scriptclass.get_exec_script(self.pipe_data)
 
             if exec_script:
@@ -1417,17 +1563,38 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
             print("Make sure the script constructor defines class method 'get_exec_script()'")
             raise
 
-    def create_run_index_cleaning_script(self):
+    def create_run_state_script(self):
+        """ Creates the script for using the run state database (see modules/run_state.py)
         """
+        if "run_state" not in self.pipe_data:
+            return
+        scriptclass = get_script_constructors(self.pipe_data).get_class()
+        with open(self.pipe_data["run_state_script"], "w") as script_fh:
+            script_fh.write(scriptclass.get_run_state_script(self.pipe_data))
+
+    def create_event_log_script(self):
+        """ Creates the script for writing the log file from the event log (see modules/event_log.py)
+        """
+        if "event_log" not in self.pipe_data:
+            return
+        scriptclass = get_script_constructors(self.pipe_data).get_class()
+        with open(self.pipe_data["event_log_script"], "w") as script_fh:
+            script_fh.write(scriptclass.get_event_log_script(self.pipe_data))
+
+    def create_run_state_db(self):
+        """ Creates the run state database from run_index, replacing the database of previous runs
         """
+        if "run_state" in self.pipe_data:
+            # Imported here, because sqlite3 is needed only with 'run_state: sqlite'
+            from .modules.run_state import create_run_state
+            create_run_state(self.pipe_data["run_state_db"], self.pipe_data["run_index"])
 
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(
-            executor=self.pipe_data["Executor"])
-        # classname = "get_script_exec_line"
-        classname = "ScriptConstructor{executor}".format(executor=self.pipe_data["Executor"])
+    def create_run_index_cleaning_script(self):
+        """
+        """
 
         try:
-            scriptclass = getattr(importlib.import_module(modname), classname)
+            scriptclass = get_script_constructors(self.pipe_data).get_class()
             clean_script = scriptclass.get_run_index_clean_script(self.pipe_data)
 
             if clean_script:
@@ -1441,6 +1608,17 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
                 sys.stderr.write("Script constructor does not define class method 'get_run_index_clean_script()'. "
                                  "Not creating\n")
 
+    def write_profile(self):
+        """ Write the profile trace to the objects dir and a summary of the slowest phases to stderr
+        """
+        trace_file = "{dir}profile_{run_code}.json".format(dir=self.pipe_data["objects_dir"],
+                                                           run_code=self.pipe_data["run_code"])
+        self.profiler.write_trace(trace_file)
+        sys.stdout.flush()
+        self.profiler.write_summary(top=self.profile)
+        sys.stderr.write("Profile trace written to %s (open with chrome://tracing or https://ui.perfetto.dev)\n"
+                         % trace_file)
+
     def cleanup(self):
         try:
             for step_n in self.step_list:
@@ -1452,37 +1630,42 @@ saveWidget(myviz,file = "{out_file_name}",selfcontained = F, title="{title}")
 
     def check_cyclic_step_names(self):
         """ Check no names are prefixes of other names.
+
+            A name is checked as its glob name up to the final glob *. All names having a given name as prefix follow
+            it when the names are sorted, so each name is compared only with the names following it until the first
+            name it is not a prefix of.
         """
 
-        def qsub_name_glob(qsubname1, qsubname2):
-            """ Helper function: Checks if name A is a prefix of name B, after removing final glob *
-                Returns True if A is prefix of B
-            """
-            # print "{i1} <---> {i2}".format(i1=qsubname1,i2=qsubname2)
-            return re.sub(pattern="\*.*$",
-                          repl="",
-                          string=qsubname2).startswith(re.sub(pattern="\*.*$",
-                                                              repl="",
-                                                              string=qsubname1))
+        prefix_list = sorted((re.sub(pattern="\*.*$", repl="", string=instance.get_glob_name()), ind)
+                             for ind, instance
+                             in enumerate(self.step_list))
+        conflicts = list()  # (index of prefix instance, index of instance it is a prefix of)
+        group_start = 0
+        while group_start < len(prefix_list):
+            prefix = prefix_list[group_start][0]
+            # Instances with the same prefix are prefixes of each other:
+            group_end = group_start
+            while group_end < len(prefix_list) and prefix_list[group_end][0] == prefix:
+                group_end += 1
+            next_ind = group_start
+            while next_ind < len(prefix_list) and prefix_list[next_ind][0].startswith(prefix):
+                for _, ind1 in prefix_list[group_start:group_end]:
+                    conflicts.append((ind1, prefix_list[next_ind][1]))
+                next_ind += 1
+            group_start = group_end
 
         issues = False
-        for instance1 in self.step_list:
-            for instance2 in self.step_list:
-                # Don't test steps against themselves:
-                if instance1.get_step_name() == instance2.get_step_name():
-                    pass
-                else:
-                    glob_name_inst1 = instance1.get_glob_name()
-                    glob_name_inst2 = instance2.get_glob_name()
-
-                    if qsub_name_glob(glob_name_inst1,glob_name_inst2):
-                        print("* Instance '{inst1}' name is a prefix of instance '{inst2}' name, and both are from " \
-                              "the same module. This can cause cyclic dependencies! " \
-                              "Please modify '{inst1}' to avoid this.\n".format(inst1=instance1.get_step_name(),
-                                                                                inst2=instance2.get_step_name()))
-                        issues = True
-                    else:
-                        pass
+        for ind1, ind2 in sorted(conflicts):
+            instance1 = self.step_list[ind1]
+            instance2 = self.step_list[ind2]
+            # Don't test steps against themselves:
+            if instance1.get_step_name() == instance2.get_step_name():
+                continue
+            print("* Instance '{inst1}' name is a prefix of instance '{inst2}' name, and both are from " \
+                  "the same module. This can cause cyclic dependencies! " \
+                  "Please modify '{inst1}' to avoid this.\n".format(inst1=instance1.get_step_name(),
+                                                                    inst2=instance2.get_step_name()))
+            issues = True
 
         if issues:
             sys.exit("Issues with instance names. See above")
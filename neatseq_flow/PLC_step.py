@@ -16,7 +16,11 @@ import json
 
 from copy import *
 from pprint import pprint as pp
-from .modules.parse_param_data import manage_conda_params
+from .modules.sample_data_layer import SampleDataLayer, Mapping, find_merge_conflicts
+from .modules.sample_list import SampleList
+from .modules.profiler import NullProfiler
+from .modules.grouping_index import GroupingIndex
+from .modules.script_constructor_registry import get_script_constructors
 
 __author__ = "Menachem Sklarz"
 __version__ = "1.6.0"
@@ -70,100 +74,31 @@ class Step(object):
 # ----------------------------------------------------------------------------------
 
     @classmethod
-    def find_step_module(cls, step, param_data, pipe_data):
+    def find_step_module(cls, step, param_data, pipe_data, module_index=None):
         """ A class method for finding the location of a module for a given step
+            The module is looked up in module_index (see modules/module_index.py). If not passed, an index is
+            created for this search only.
         """
 
-        def walkerr(err):
-            """ Helper function for os.walk below. Catches errors during walking and reports on them.
-            """
-            print("WARNING: Error while searching for modules:")
-            print(err)
-
-        # Searching module paths passed by user in parameter file:
-        if "module_path" in param_data["Global"]:
-            for module_path_raw in param_data["Global"]["module_path"]:
-                # Remove trainling '/' from dir name. For some reason that botches things up!
-                module_path = module_path_raw.rstrip(os.sep)
-
-                # Expanding '~' and returning full path 
-                module_path = os.path.realpath(os.path.expanduser(module_path))
-                
-
-                # Check the dir exists:
-                if not os.path.isdir(module_path):
-                    sys.stderr.write("WARNING: Path %s from module_path does not exist. Skipping...\n" % module_path)
-                    continue
-
-                mod_t = step
-                dir_generator = os.walk(module_path, onerror = walkerr)
-                # Each .next call on this generator
-                # returns a level tuple as follows:
-                try:
-                    level = next(dir_generator)
-                    # level is a tuple with: (current dir. [list of dirs],[list of files])
-                except StopIteration:
-                    sys.stderr.write("WARNING: Module path {mod_path} seems to be empty! Possibly issue with "
-                                     "permissions...\n".format(mod_path=module_path))
-                while mod_t + ".py" not in level[2] or "__init__.py" not in level[2]:
-                    # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-                    #   and while __init__.py is not in current dir (avoid finding modules in non-active dirs)
-                    try:
-                        level = next(dir_generator)    # Try getting another level    
-                    except StopIteration:
-                        # print "Step %s not found in path %s." % (mod_t,module_path)
-                        break # Leave while without executing "else"
-                else:
-                    # Adding module_path to search path
-                    if module_path not in sys.path:
-                        sys.path.append(os.path.abspath(module_path))
-                        # print ">>> ", sys.path
-                        
-                    # Backup module to backups dir:
-                    shutil.copyfile(level[0] + os.sep + mod_t + ".py", \
-                        "{bck_dir}{runcode}{ossep}{filename}".format(bck_dir = pipe_data["backups_dir"], \
-                                                                     runcode = pipe_data["run_code"], \
-                                                                     ossep = os.sep, \
-                                                                     filename = mod_t + ".py"))
+        if module_index is None:
+            from .modules.module_index import ModuleIndex
+            module_index = ModuleIndex(param_data["Global"].get("module_path", []), cls.Cwd)
 
-                    # For what this does, see below (# Build module name)...
-                    retval = (level[0].split(module_path)[1].partition(os.sep)[2].replace(os.sep,".") + "." + mod_t).lstrip(".")
-                    module_loc = level[0] + os.sep + mod_t + ".py"
+        found = module_index.find_module(step)
+        if found is None:
+            raise AssertionExcept("Step %s not found in regular path or user defined paths." % step)
+        retval, module_loc, module_path = found
 
-                    return retval, module_loc
-
-
-        # If not found, do the same with cls.Cwd:
-        mod_t = step
-        dir_generator = os.walk(cls.Cwd, onerror = walkerr)     # Each .next call on this generator returns a level tuple as follows:
-        try:
-            level = next(dir_generator)           # level is a tuple with: (current dir. [list of dirs],[list of files])
-        except StopIteration:
-            sys.stderr.write("WARNING: Module path %s seems to be empty! Possibly issue with permissions...\n" % self.Cwd)
-
-        while(mod_t + ".py" not in level[2]):     # Repeat while expected filename is NOT in current dir contents (=level[2]. see above)
-            try:
-                level = next(dir_generator)    # Try getting another level    
-            except StopIteration:
-                raise AssertionExcept("Step %s not found in regular path or user defined paths." % mod_t)
-        
+        # Adding module_path to search path
+        if module_path is not None and module_path not in sys.path:
+            sys.path.append(os.path.abspath(module_path))
 
         # Backup module to backups dir:
-        shutil.copyfile(level[0] + os.sep + mod_t + ".py", \
+        shutil.copyfile(module_loc, \
                         "{bck_dir}{runcode}{ossep}{filename}".format(bck_dir = pipe_data["backups_dir"], \
                                                                      runcode = pipe_data["run_code"], \
                                                                      ossep = os.sep, \
-                                                                     filename = mod_t + ".py"))
-
-        # Build module name:
-        # 1. take dir found in search
-        # 2. split it by CWD and take 2nd part,  i.e. remove cwd from dir name...
-        # 3. partition by os.sep to remove leading os.sep
-        # 4. replace remaining os.sep's by ".".
-        # 5. Add .
-        # Adding 'neatseq_flow' at begginning of module location.
-        retval = "neatseq_flow."+level[0].split(cls.Cwd)[1].partition(os.sep)[2].replace(os.sep,".") + "." + mod_t
-        module_loc = level[0] + os.sep + mod_t + ".py"
+                                                                     filename = step + ".py"))
 
         return retval, module_loc
 
@@ -237,7 +172,8 @@ class Step(object):
         # beginning with module= and instance=, according to awk regular expression definitions!
         self.jid_name_sep = ".."
 
-        # TODO: Set use_provenance to True only if and step has "stop_and_show" defined.
+        # Provenance is recorded as a log of the changes made by the step, so it is cheap to keep it on.
+        # See modules/provenance.py
         self.use_provenance = True
 
         # -----------------------------
@@ -281,6 +217,15 @@ class Step(object):
        
         self.jid_list = []        # Initialize a list to store the list of jids of the current step
         self.glob_jid_list = []   # An experimental feature to enable shorter depend lists
+        self.ancestor_jid_index = None  # jids of all ancestors. Built on first use. See get_ancestor_jid_index()
+        # When not None, writes to files shared by all steps are stored here instead of being done.
+        # Used when building in parallel. See write_deferred()
+        self.deferred_writes = None
+        # Buffered writer for the index files (see modules/index_writer.py). Set by the workflow creating the step.
+        # If None, index lines are written directly.
+        self.index_writer = None
+        # Profiler timing the phases of script building (see modules/profiler.py). Set by the workflow when profiling.
+        self.profiler = NullProfiler()
 
         # The following line defines A list of jids from current step that all other steps should depend on.
         # Is used to add a prelimanry step, equivalent to the "wrapping up" step that is dependent on all previous
@@ -346,6 +291,12 @@ They are set automatically or module is not defined to use them""".format(parame
         
         # Create a list for filenames to register with md5sum for each script:
         self.stamped_files = list()
+
+        # Low level scripts to submit in bundles or as an array job. None when submitting each script on its own
+        # (see submit_task_scripts())
+        self.task_scripts = None
+        # Index of the samples in each level of the grouping categories. Built on first use (see get_grouping_index())
+        self.grouping_index = None
         # self.stamped_dirs = list()
 
         # Create a dictionary storing the step name and names of sub-scripts
@@ -445,64 +396,26 @@ Dependencies: {depends}""".format(name=self.name,
 ## Comprison methods
     
     def __lt__(self,other):
-        """ A step is _lt_ than 'other' if it is in 'other's list of dependencies or if it has a shorter dependency list.
-            Is used by the sort function to sort the steps in a correct running order
+        """ A step is _lt_ than 'other' if it has a shorter dependency list or, for equal lengths, a smaller name.
+            Since a step always has a longer dependency list than any step in it, a step is always _lt_ than the steps
+            depending on it, making this a consistent total order in correct running order.
             A side effect is that parallel branches are sorted top-down rather than branch-wise.
-            You can redefine the 'sort' method in Pipeline class to change this behaviour.
+            PLC_main sorts by the equivalent topological order. See sort_step_list() there.
         """
-        #print self.pipe_data["step_order"]
-        if self.name in other.get_depend_list():
-            return True
-        if other.name in self.get_depend_list():
-            return False
-        #=======================================================================
-        # print "in __lt__: other index %s (%s)\nself index %s (%s)\n" % (self.pipe_data["step_order"].index(other.name), other.name, self.pipe_data["step_order"].index(self.name),self.name)
-        # # Returning order by order in param file:
-        # if self.pipe_data["step_order"].index(other.name) > self.pipe_data["step_order"].index(self.name):
-        #     return True
-        # if self.pipe_data["step_order"].index(other.name) < self.pipe_data["step_order"].index(self.name):
-        #     return False
-        #=======================================================================
-         
-        if len(self.get_depend_list()) < len(other.get_depend_list()):
-            return True
-        if len(self.get_depend_list()) > len(other.get_depend_list()):
-            return False
-        if self.get_step_name() < other.get_step_name():
-            return True
-        if self.get_step_name() > other.get_step_name():
-            return False
-        return NotImplemented 
-        
+        return self.get_sort_key() < other.get_sort_key()
+
     def __gt__(self,other):
         """ See doc string for __lt__
         """
 
-        return not self.__lt__(other)
-        # if self.name in other.get_depend_list():
-        #     return False
-        # if other.name in self.get_depend_list():
-        #     return True
-        # #=======================================================================
-        # # # Returning order by order in param file:
-        # # print "in __gt__: other index %s (%s)\nself index %s (%s)\n" % (self.pipe_data["step_order"].index(other.name), other.name, self.pipe_data["step_order"].index(self.name),self.name)
-        # # if self.pipe_data["step_order"].index(other.name) > self.pipe_data["step_order"].index(self.name):
-        # #     return False
-        # # if self.pipe_data["step_order"].index(other.name) < self.pipe_data["step_order"].index(self.name):
-        # #     return True
-        # #=======================================================================
-        #
-        # if len(self.get_depend_list()) > len(other.get_depend_list()):
-        #     return True
-        # if len(self.get_depend_list()) < len(other.get_depend_list()):
-        #     return False
-        # if self.get_step_name() > other.get_step_name():
-        #     return True
-        # if self.get_step_name() < other.get_step_name():
-        #     return False
-        # return NotImplemented 
-        
-        
+        return self.get_sort_key() > other.get_sort_key()
+
+    def get_sort_key(self):
+        """ Returns the key used for ordering steps. See __lt__
+        """
+
+        return len(self.get_depend_list()), self.get_step_name()
+
     def finalize_contruction(self):
         """ Put all stuff that needs to be done after init, sorting and number setting.
             Called for each step in main.
@@ -579,12 +492,19 @@ Dependencies: {depends}""".format(name=self.name,
         # 3. For each base:
         #    a. add {base.name:base.sample_data} to base_sample_data
         #    b. Update base_sample_data with a DEEPCOPY of the base.get_base_sample_data()
-        if not self.base_step_list:
-            return dict()
+        # Current version:
+        # Walking the ancestors depth first, each ancestor is added once, in the order of the recursive version.
+        # Instead of a deepcopy, each step gets a SampleDataLayer over the ancestor's sample_data, so that
+        # modifications do not reach the ancestor.
         base_sample_data = dict()
-        for step_obj in self.base_step_list:
-            base_sample_data[step_obj.get_step_name()] = deepcopy(step_obj.sample_data)
-            base_sample_data.update(deepcopy(step_obj.get_base_sample_data()))
+        steps_to_add = list(reversed(self.base_step_list)) if self.base_step_list else list()
+        while steps_to_add:
+            step_obj = steps_to_add.pop()
+            if step_obj.get_step_name() in base_sample_data:
+                continue
+            base_sample_data[step_obj.get_step_name()] = SampleDataLayer([step_obj.sample_data])
+            if step_obj.base_step_list:
+                steps_to_add.extend(reversed(step_obj.base_step_list))
         return base_sample_data
 
         # # Create a dictionary containing the sample data of the bases
@@ -658,8 +578,8 @@ Dependencies: {depends}""".format(name=self.name,
             # print smpdt
             # print "\n\n"
             if (k in sample_data):
-                if (isinstance(sample_data[k], dict) 
-                        and isinstance(other_sample_data[k], dict)):
+                if (isinstance(sample_data[k], Mapping)
+                        and isinstance(other_sample_data[k], Mapping)):
                     sample_data[k] = self.sample_data_merge(sample_data[k], other_sample_data[k], other_step_name)
                 else:
                     # For list of active samples, merge the lists:
@@ -683,29 +603,30 @@ Dependencies: {depends}""".format(name=self.name,
         # Preparing dict to store sample_data of bases:
         # This is not usually used but might be handy when you need more than one bam, for instance (see below)
 
+        # Instead of copying, sample_data is a SampleDataLayer on top of the original sample_data (for Import) or the
+        # sample_data of the base steps. Changes to the layer are kept in the layer only. See sample_data_layer.py
         if sample_data is not None:     # When passing sample_data (i.e. for Import)
-            # Copying sample_data. Just '=' would create a kind of reference
-            self.sample_data = deepcopy(sample_data)
+            self.sample_data = SampleDataLayer([sample_data])
             # # Also starting a new provenance dictionary
             if self.use_provenance:
                 self.create_provenance()
-                self.sample_data_original = deepcopy(self.sample_data)
+                self.sample_data_original = SampleDataLayer([sample_data])
         else:   # Extract sample_data from base steps:
-            self.sample_data = dict()
+            # Merge sample_data from all base steps.
+            base_sample_data_list = [base_step.get_sample_data() for base_step in self.base_step_list]
+            self.sample_data = SampleDataLayer(base_sample_data_list)
+            if self.pipe_data["verbose"] and len(self.base_step_list) > 1:
+                # Check not discarding values from the secondary bases
+                for key, base_name in find_merge_conflicts(base_sample_data_list,
+                                                           [base_step.get_step_name()
+                                                            for base_step
+                                                            in self.base_step_list]):
+                    self.write_warning("There is a difference from %s in key %s\n" % (base_name, key))
+
             if self.use_provenance:
-                self.provenance = dict()
-            for base_step in self.base_step_list:
-                # Merge sample_data from all base steps.
-                # Function sample_data_merge uses deepcopy as well
-                self.sample_data = self.sample_data_merge(self.get_sample_data(),
-                                                          base_step.get_sample_data(),
-                                                          base_step.get_step_name())
-
-                if self.use_provenance:
-                    self.provenance = self.sample_data_merge(self.get_provenance(),
-                                                             base_step.get_provenance(),
-                                                             base_step.get_step_name())
-                    self.sample_data_original = deepcopy(self.sample_data)
+                self.create_provenance()
+                # A second layer over the bases, untouched by the step, stands for the sample_data before the step:
+                self.sample_data_original = SampleDataLayer(base_sample_data_list)
 
         # This part is experimental and not 100% complete. Changes will probably occur in the future.
         # 1. Convert "exclude_sample_list" to "sample_list":
@@ -779,7 +700,7 @@ Dependencies: {depends}""".format(name=self.name,
         #     raise AssertionExcept("sample_list must be string or list in stash_sample_list()")
 
         # Removing unused sample slots from sample_data
-        old_samples = list(set(self.sample_data["samples"]) - set(sample_list))
+        old_samples = SampleList(self.sample_data["samples"]) - sample_list
         for sample in old_samples:
             self.sample_data.pop(sample)
 
@@ -851,18 +772,37 @@ Dependencies: {depends}""".format(name=self.name,
         
         return self.jid_list
         
+    def get_ancestor_jid_index(self):
+        """ Returns a dict with the jids and the globbed jids of all ancestor steps, each listed once.
+            The index is built once, from the indices of the base steps, the first time it is required.
+            By then, the bases are done building their scripts, so their jid lists are complete.
+        """
+
+        if self.ancestor_jid_index is None:
+            jids = []
+            glob_jids = []
+            seen = set()
+            seen_glob = set()
+            for base_step in (self.base_step_list or []):
+                base_index = base_step.get_ancestor_jid_index()
+                for jid in itertools.chain(base_step.get_jid_list(), base_index["jids"]):
+                    if jid not in seen:
+                        seen.add(jid)
+                        jids.append(jid)
+                for jid in itertools.chain(base_step.get_glob_jid_list(), base_index["glob_jids"]):
+                    if jid not in seen_glob:
+                        seen_glob.add(jid)
+                        glob_jids.append(jid)
+            self.ancestor_jid_index = {"jids": jids, "glob_jids": glob_jids}
+
+        return self.ancestor_jid_index
+
     def get_dependency_jid_list(self):
         """ Returns the list of jids of all base steps
-            Recursion. beware!
+            The list is shared by all callers. Do not modify it!
         """
-        
-        depend_jid_list = []
-        
-        if self.base_step_list:
-            for base_step in self.base_step_list:
-                depend_jid_list += (base_step.get_jid_list() + base_step.get_dependency_jid_list())
 
-        return depend_jid_list
+        return self.get_ancestor_jid_index()["jids"]
 
     def get_glob_jid_list(self):
         """ Return list of jids
@@ -882,26 +822,18 @@ Dependencies: {depends}""".format(name=self.name,
                                                        runid=self.pipe_data["run_code"])
 
     def get_dependency_glob_jid_list(self):
-        """ Returns the list of jids of all base steps
-            Recursion. beware!
+        """ Returns the list of globbed jids of all base steps
+            The list is shared by all callers. Do not modify it!
         """
 
-        glob_depend_jid_list = []
-
-        if self.base_step_list:
-            for base_step in self.base_step_list:
-                glob_depend_jid_list += (base_step.get_glob_jid_list() + base_step.get_dependency_glob_jid_list())
-
-        return list(set(glob_depend_jid_list))
+        return self.get_ancestor_jid_index()["glob_jids"]
 
     def import_ScriptConstructor(self, level): #modname, classname):
-        """Returns a class of "classname" from module "modname". 
+        """Returns the script constructor class of the executor for level (high, low or kill).
+           The classes are resolved once per workflow. See modules/script_constructor_registry.py
         """
 
-        level = level.lower().capitalize()
-        modname = "neatseq_flow.script_constructors.scriptconstructor{executor}".format(executor=self.pipe_data["Executor"])
-        classname = "{level}ScriptConstructor{executor}".format(level=level, executor=self.pipe_data["Executor"])  #SGE"
-        return getattr(importlib.import_module(modname), classname)
+        return get_script_constructors(self.pipe_data).get_class(level)
 
         
     def create_low_level_script(self):
@@ -941,8 +873,12 @@ Dependencies: {depends}""".format(name=self.name,
         # Clear stamped files list
         self.stamped_files = list()
 
-        # Add child command execution lines to main script:
-        self.main_script_obj.write_command(self.main_script_obj.get_child_command(self.child_script_obj))
+        # Add child command execution lines to main script.
+        # With bundles or array jobs, the script is submitted by submit_task_scripts()
+        if self.task_scripts is not None:
+            self.task_scripts.append(self.child_script_obj)
+        else:
+            self.main_script_obj.write_command(self.main_script_obj.get_child_command(self.child_script_obj))
 
         # Adding to qsub_names_dict:
         self.qsub_names_dict["low_qsubs"].append(self.child_script_obj.script_id)
@@ -952,6 +888,102 @@ Dependencies: {depends}""".format(name=self.name,
         
         self.child_script_obj.__del__()
 
+    def use_array_jobs(self):
+        """ Returns True if the low level scripts of the step are to be submitted as a single array job.
+            Set with 'array_jobs' in the step parameters, or for all steps in the global parameters.
+            Array jobs are supported by executors defining an array script constructor (SGE and SLURM),
+            and only for bash scripts.
+        """
+        array_jobs = self.params.get("array_jobs", self.pipe_data.get("array_jobs", False))
+        if isinstance(array_jobs, str):
+            array_jobs = array_jobs.upper() not in ["FALSE", "NO", ""]
+        if not array_jobs:
+            return False
+
+        if not get_script_constructors(self.pipe_data).has_class("array"):
+            if "array_jobs" in self.params:
+                sys.stderr.write("WARNING: In {step}: Executor {executor} does not support array jobs. "
+                                 "Ignoring 'array_jobs'.\n".format(step=self.get_step_name(),
+                                                                    executor=self.pipe_data["Executor"]))
+            return False
+        if self.shell != "bash":
+            sys.stderr.write("WARNING: In {step}: Array jobs are supported only for bash scripts. "
+                             "Ignoring 'array_jobs'.\n".format(step=self.get_step_name()))
+            return False
+        return True
+
+    def get_bundle_params(self):
+        """ Returns the number of low level scripts to run in each bundle, and the number of scripts of a bundle to run
+            at a time, as set with 'bundle' and 'bundle_parallel' in the step parameters.
+            The number of scripts per bundle is None if the scripts are not bundled.
+        """
+        bundle_params = list()
+        for param, default in [("bundle", None), ("bundle_parallel", 1)]:
+            value = self.params.get(param, default)
+            if value is None:
+                bundle_params.append(value)
+                continue
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = 0
+            if value < 1:
+                raise AssertionExcept("'{param}' must be a positive integer".format(param=param),
+                                      step=self.get_step_name())
+            bundle_params.append(value)
+
+        return tuple(bundle_params)
+
+    def submit_task_scripts(self):
+        """ Submit the low level scripts created by build_scripts() in bundles ('bundle' parameter) and/or as the tasks
+            of a single array job ('array_jobs' parameter).
+            The bundle and array scripts execute the low level scripts listed in their task table. The low level scripts
+            are unchanged, so each of them writes its own log lines and updates the run index.
+        """
+
+        tasks, self.task_scripts = self.task_scripts, None
+        if not tasks:
+            return
+
+        # Bundles and arrays depend on the same jobs as their tasks.
+        # They are not added to jid_list: Dependent jobs wait for the tasks.
+        self.dependency_jid_list = self.preliminary_jids + self.get_dependency_jid_list()
+        self.dependency_glob_jid_list = self.preliminary_jids + self.get_dependency_glob_jid_list()
+
+        bundle_size, bundle_parallel = self.get_bundle_params()
+        if bundle_size:
+            bundles = [tasks[ind:ind + bundle_size] for ind in range(0, len(tasks), bundle_size)]
+            # A single script is not bundled:
+            tasks = [self.create_task_script("bundle", bundle, "bundle%d" % (num + 1), parallel=bundle_parallel)
+                     if len(bundle) > 1
+                     else bundle[0]
+                     for num, bundle in enumerate(bundles)]
+
+        if len(tasks) > 1 and self.use_arrays:
+            tasks = [self.create_task_script("array", tasks, "array")]
+
+        for task in tasks:
+            self.main_script_obj.write_command(self.main_script_obj.get_task_command(task))
+
+    def create_task_script(self, level, tasks, name, **kwargs):
+        """ Create a script of type level ("bundle" or "array") executing the low level scripts in tasks.
+            name is added to the step name to create the script name.
+        """
+
+        self.spec_script_name = self.jid_name_sep.join([self.step, self.name, name])
+
+        getTaskClass = self.import_ScriptConstructor(level=level)
+        task_script_obj = getTaskClass(master=self, tasks=tasks, **kwargs)
+
+        task_script_obj.write_script()
+
+        # Adding job name and path to script and run indices
+        self.add_job_script_run_indices(task_script_obj)
+
+        task_script_obj.__del__()
+
+        return task_script_obj
+
     def create_preliminary_script(self):
         """ Create a script that will run before all other low level scripts commence
 
@@ -1079,16 +1111,39 @@ Dependencies: {depends}""".format(name=self.name,
         self.wrap_script_obj.__del__()
 
 
+    def append_to_shared_file(self, filename, text):
+        """ Append text to a file shared by all steps, such as the script and run indices.
+            If writes are deferred, the text is stored and written by write_deferred().
+            Otherwise, the text is passed to the index writer, which writes it when the step is done.
+        """
+        if self.deferred_writes is not None:
+            self.deferred_writes.append(("append", filename, text))
+        elif self.index_writer is not None:
+            self.index_writer.write(filename, text)
+        else:
+            with open(filename, "a") as script_fh:
+                script_fh.write(text)
+
+    def write_deferred(self):
+        """ Do the writes to shared files stored while deferred_writes was set, in their original order,
+            and stop deferring writes.
+        """
+        deferred_writes, self.deferred_writes = self.deferred_writes, None
+        for write in deferred_writes or []:
+            if write[0] == "append":
+                self.append_to_shared_file(write[1], write[2])
+            elif write[0] == "main_kill_commands":
+                self.main_script_obj.main_script_kill_commands(write[1])
+
     def add_job_script_run_indices(self, script_obj):
         """ Add current script to script_index and run_index files
         """
-        with open(self.pipe_data["script_index"], "a") as script_fh:
-            script_fh.write("{qsub_name}\t{script_name}\n".format(qsub_name   = script_obj.script_id,
-                                                                  script_name = script_obj.script_path))
-        with open(self.pipe_data["run_index"], "a") as script_fh:
-            if script_obj.level == "high":
-                script_fh.write("\n----\n")
-            script_fh.write("# {qsub_name}\n".format(qsub_name   = script_obj.script_id))
+        self.append_to_shared_file(self.pipe_data["script_index"],
+                                   "{qsub_name}\t{script_name}\n".format(qsub_name   = script_obj.script_id,
+                                                                          script_name = script_obj.script_path))
+        self.append_to_shared_file(self.pipe_data["run_index"],
+                                   ("\n----\n" if script_obj.level == "high" else "") +
+                                   "# {qsub_name}\n".format(qsub_name   = script_obj.script_id))
         
     def add_depend_index_entry(self):
         """
@@ -1096,11 +1151,11 @@ Dependencies: {depends}""".format(name=self.name,
         :return:
         """
 
-        pass
-        with open(self.pipe_data["depend_index"], "a") as script_fh:
-            for jid in self.dependency_glob_jid_list:
-                script_fh.write("{depend_jid}\t{my_jid}\n".format(my_jid= self.child_script_obj.script_id,
-                                                                  depend_jid= jid))
+        self.append_to_shared_file(self.pipe_data["depend_index"],
+                                   "".join(["{depend_jid}\t{my_jid}\n".format(my_jid= self.child_script_obj.script_id,
+                                                                              depend_jid= jid)
+                                            for jid
+                                            in self.dependency_glob_jid_list]))
 
 
     def create_scripts_dir(self):
@@ -1133,7 +1188,10 @@ Dependencies: {depends}""".format(name=self.name,
         self.spec_script_name = self.jid_name_sep.join([self.step,self.name])
 
         # Add qdel command to main qdel script:
-        self.main_script_obj.main_script_kill_commands(self.kill_script_filename_main)
+        if self.deferred_writes is not None:
+            self.deferred_writes.append(("main_kill_commands", self.kill_script_filename_main))
+        else:
+            self.main_script_obj.main_script_kill_commands(self.kill_script_filename_main)
 
         self.dependency_jid_list = self.get_dependency_jid_list()   # + self.preliminary_jids
         self.dependency_glob_jid_list = self.get_dependency_glob_jid_list()
@@ -1152,6 +1210,10 @@ Dependencies: {depends}""".format(name=self.name,
         # Adding qsub_name and script path to script_index and run_index
         self.add_job_script_run_indices(self.main_script_obj)
 
+        # With bundles or array jobs, the low level scripts are collected here and submitted by submit_task_scripts():
+        self.use_arrays = self.use_array_jobs()
+        self.task_scripts = list() if self.use_arrays or self.get_bundle_params()[0] else None
+
     def close_high_level_script(self):
         """ Create the high (i.e. 2nd) level scripts, which are the scripts that run the 3rd level scripts for the step
         """
@@ -1173,13 +1235,19 @@ Dependencies: {depends}""".format(name=self.name,
                 self.create_high_level_script()
 
                 # Add a preliminary script if it is defined in the step specific module
-                self.create_preliminary_script()
+                with self.profiler.phase("create_preliminary_script", "step", step=self.get_step_name()):
+                    self.create_preliminary_script()
 
                 # Create actual scripts: NOTE: This function is defined in the individual step files!
-                self.build_scripts()
+                with self.profiler.phase("build_scripts", "step", step=self.get_step_name()):
+                    self.build_scripts()
+
+                # Submit the low level scripts in bundles or as an array job, if required
+                self.submit_task_scripts()
 
                 # Add a wrapping up script if it is defined in the step specific module
-                self.create_wrapping_up_script()
+                with self.profiler.phase("create_wrapping_up_script", "step", step=self.get_step_name()):
+                    self.create_wrapping_up_script()
                 
                 # Add closing lines to the high level script
                 # self.main_script_obj.get_script_postamble()
@@ -1197,7 +1265,8 @@ Dependencies: {depends}""".format(name=self.name,
         # self.main_pl_obj.global_sample_data[self.get_step_name()] = deepcopy(self.sample_data)
         # Updating provenance data:
         if self.use_provenance:
-            self.update_provenance()
+            with self.profiler.phase("update_provenance", "step", step=self.get_step_name()):
+                self.update_provenance()
 
         if "stop_and_show" in self.params:
             print(self.get_stop_and_show_message())
@@ -1219,19 +1288,20 @@ Module path: {path}
                          step=self.get_step_step(),
                          path=self.path)
 
+        provenance = self.get_provenance() if self.use_provenance else None
         if "project_data" in self.sample_data:  # If no project data exists, skip this
             if self.use_provenance:
                 # Creating string of project data including provenance
                 try:
                     project_slots_text = "\n".join(["- {key} ({prov})".
                                                    format(key=key,
-                                                          prov="->".join(self.provenance["project_data"][key]))
+                                                          prov="->".join(provenance["project_data"][key]))
                                                     for key
                                                     in list(self.sample_data["project_data"].keys())])
                 except KeyError:
                     # print "~~~~~~~~~~~~~~~~ %s ~~~~~" % self.get_step_name()
                     # print self.sample_data["project_data"].keys()
-                    # print self.provenance["project_data"].keys()
+                    # print provenance["project_data"].keys()
                     # print "~~~~~~~~~~~~~~~~~~~~~"
                     raise # AssertionExcept("Weird error!")
 
@@ -1250,11 +1320,11 @@ Project slots:
 
         if self.sample_data["samples"]:  # Sample list may be empty if only project data was passed!
             if self.use_provenance:
-                all_samples = set(self.provenance.keys()) - {"project_data"}
-                uniq_prov_list = list(set([json.dumps(self.provenance[sample], sort_keys=True)
+                all_samples = set(provenance.keys()) - {"project_data"}
+                uniq_prov_list = list(set([json.dumps(provenance[sample], sort_keys=True)
                                            for sample
                                            in all_samples]))
-                prov_dict = {sample: json.dumps(self.provenance[sample], sort_keys=True)
+                prov_dict = {sample: json.dumps(provenance[sample], sort_keys=True)
                              for sample
                              in all_samples}
                 uniq_sample_lists = [[sample
@@ -1271,9 +1341,9 @@ Project slots:
                                                 format(samples=", ".join(sorted(value)),  #
                                                        slots="\n".join(["- {key} ({prov})".
                                                                        format(key=key,
-                                                                              prov="->".join(self.provenance[value[0]][key]))
+                                                                              prov="->".join(provenance[value[0]][key]))
                                                                         for key
-                                                                        in self.provenance[value[0]]]))
+                                                                        in provenance[value[0]]]))
                                                  for value
                                                  in uniq_sample_lists])
             else:
@@ -1489,6 +1559,8 @@ Sample slots:
         ret_dict = dict()
         try:
             ret_dict["sample_data"] = self.get_sample_data()
+            if isinstance(ret_dict["sample_data"], SampleDataLayer):
+                ret_dict["sample_data"] = ret_dict["sample_data"].to_dict()
             # ret_dict["base_sample_data"] = self.get_base_sample_data()
         except AttributeError:
             ret_dict["sample_data"] = None
@@ -1603,6 +1675,8 @@ Sample slots:
                     self.write_warning("You provided extra 'conda' parameters. They will be ignored!")
                 
                 # print self.params["conda"]
+                # Imported here, so that yaml is loaded only when needed
+                from .modules.parse_param_data import manage_conda_params
                 try:
                     self.params["conda"] = manage_conda_params(self.params["conda"])
                 except Exception as raisedex:
@@ -1635,26 +1709,32 @@ Sample slots:
         return list(set(step_params)-set(["redir_params","qsub_params","base", "module",
                                           "sample_list", "exclude_sample_list", "script_path"]))
 
+    def get_grouping_index(self):
+        """
+        Returns the grouping index of the step's samples (see grouping_index.py).
+        The index is built on first call, and again whenever the step's sample list changes.
+        :return: GroupingIndex
+        """
+        samples = self.sample_data["samples"]
+        if self.grouping_index is None or not self.grouping_index.is_current(samples):
+            self.grouping_index = GroupingIndex(self.sample_data, samples)
+        return self.grouping_index
+
     def get_category_levels(self, category):
         """
 
         :param: category
         :return: List of levels in category
         """
-        try:
-            return list({self.sample_data[sample]["..grouping.."][category]
-                         for sample
-                         in self.sample_data["samples"]})
-        except KeyError:
+        grouping_index = self.get_grouping_index()
+        if not grouping_index.has_category(category):
             pp(self.sample_data)
             raise AssertionExcept("Category {cat} not defined for all samples".format(cat=category))
+        return grouping_index.get_levels(category)
 
     def get_samples_in_category_level(self, category, cat_level):
 
-        return [sample
-                for sample
-                in self.sample_data["samples"]
-                if self.sample_data[sample]["..grouping.."][category] == cat_level]
+        return self.get_grouping_index().get_samples(category, cat_level)
 
 
     def create_group_slots(self, category):
@@ -1674,103 +1754,42 @@ Sample slots:
 
     def update_provenance(self):
         """
-        Creates and updates a self.sample_data shadow dict with the formation history of each slot
+        Adds the changes the step made to its sample_data to the step's provenance change log
         :return:
         """
 
-        # Samples added in current step
-        for sample in [sample
-                       for sample
-                       in self.sample_data["samples"]
-                       if sample not in self.sample_data_original["samples"]]:
-            # Collect keys for sample from provenance (or create provenance for sample)...
-            all_keys = list()
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
-            else:
-                self.provenance[sample] = dict()
-            # ... and from current sample data
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data[sample].keys()))
-            # For all types, indicate creation in provenance by adding ">".step_name
-            for key in all_keys:
-                self.provenance[sample][key] = [">"+self.get_step_name()]
-
-        # Samples removed in current step: Same as above but indicate termination instead
-        for sample in [sample
-                       for sample
-                       in self.sample_data_original["samples"]
-                       if sample not in self.sample_data["samples"]]:
-            # print "sample -->", sample
-            all_keys = list()
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data_original[sample].keys()))
-            for key in all_keys:
-                self.provenance[sample][key].append(self.get_step_name()+"|")
-
-        # Get samples that were not added or removed, + project_data:
-        sample_and_proj_list = list(set(self.sample_data["samples"]) &
-                                    set(self.sample_data_original["samples"]) |
-                                    set(["project_data"]))
-
-        for sample in sample_and_proj_list:
-            all_keys = list()
-            # Collect all types ever defined for sample: (1) From provenance, (2) from sample_data, (3) from original sample data
-            if sample in self.provenance:
-                all_keys = itertools.chain(all_keys,list(self.provenance[sample].keys()))
-            if sample in self.sample_data:
-                all_keys = itertools.chain(all_keys,list(self.sample_data[sample].keys()))
-            if sample in self.sample_data_original:
-                all_keys = itertools.chain(all_keys,list(self.sample_data_original[sample].keys()))
-
-            # Gey unique keys!
-            all_keys = list(set(all_keys))
-            for key in all_keys:
-                # If key is in new sample_data:
-                if key in self.sample_data[sample]:
-                    # If key is not defined in provenance yet, define it.
-                    # (Not sure this is required, but who knows?
-                    if key not in self.provenance[sample]:
-                        self.provenance[sample][key] = []
-                    # And key is in old sample_data
-                    if key in self.sample_data_original[sample]:
-                        # If previously the key has bee removed (provenance ends with "|")
-                        if self.provenance[sample][key][-1][-1] == "|":    # laste character of last value in provenance is "|"
-                            self.provenance[sample][key].append(self.get_step_name())
-                        # If the key has changed during current step:
-                        elif self.sample_data[sample][key] != self.sample_data_original[sample][key]:
-                            # Add this step to type provenance
-                            self.provenance[sample][key].append(self.get_step_name())
-                        else:
-                            pass
-                    # If key is in current step (and not in original!)
-                    else: #key in self.sample_data[sample]:
-                        # Add step name to provenance with ">" indicating creation
-                        self.provenance[sample][key] = [">"+self.get_step_name()]
-                # If key is in original sample_data (but not in current!)
-                elif key in self.sample_data_original[sample]:  # And not in current!
-                    # Add step name to provenance with "|" indicating termination
-                    self.provenance[sample][key].append(self.get_step_name()+"|")
-                else:
-                    pass
+        from .modules.provenance import get_changes
+        self.provenance_log.extend(get_changes(self.sample_data, self.sample_data_original))
+        # The provenance dict is built again on the next call to get_provenance()
+        self.provenance = None
 
     def create_provenance(self):
         """
-        Create a provenance dict based on sample_data
+        Starts an empty provenance change log. The provenance of the slots defined before the step is taken from the
+        bases, or, for steps without bases, from the sample_data passed to the step.
         :return:
         """
 
-        self.provenance = dict()
-        # Get sample list and add "project_data":
-        sample_and_proj_list = deepcopy(self.sample_data["samples"])
-        sample_and_proj_list.append("project_data")
-        # For each sample, store
-        for sample in sample_and_proj_list:
-            self.provenance[sample] = {key:[">"+self.get_step_name()] for key in self.sample_data[sample]}
+        self.provenance_log = list()
+        self.provenance = None
 
     def get_provenance(self):
+        """
+        Returns the provenance dict ({sample: {slot: [step names]}}), building it from the change logs of the step
+        and its bases on first call.
+        :return:
+        """
+
+        if self.provenance is None:
+            from .modules.provenance import get_provenance
+            base_step_list = self.get_base_step_list()
+            self.provenance = get_provenance(self.get_step_name(),
+                                             [base_step.get_provenance()
+                                              for base_step
+                                              in base_step_list] if base_step_list else None,
+                                             self.provenance_log,
+                                             self.sample_data,
+                                             self.sample_data_original)
         return self.provenance
 
     def get_step_tag(self):
@@ -1804,19 +1823,14 @@ Sample slots:
         if type(sample_dict["category"]) not in [str, int]:
             raise AssertionExcept("Category must be a single value, not a list etc.")
 
+        grouping_index = self.get_grouping_index()
         # Check all samples have grouping data
-        bad_samples = [sample
-                       for sample
-                       in self.sample_data["samples"]
-                       if "..grouping.." not in self.sample_data[sample]]
+        bad_samples = grouping_index.ungrouped
         if bad_samples:
             raise AssertionExcept("For some reason, sample '{smp}' does not have "
                                   "grouping data".format(smp=", ".join(bad_samples)))
         # Check category is in all samples
-        bad_samples = [sample
-                       for sample
-                       in self.sample_data["samples"]
-                       if sample_dict["category"] not in self.sample_data[sample]["..grouping.."]]
+        bad_samples = grouping_index.get_samples_without(sample_dict["category"])
         if bad_samples:
             raise AssertionExcept(
                 "Sample '{smp}' does not have '{cat}' category".format(smp=", ".join(bad_samples),
@@ -1829,10 +1843,9 @@ Sample slots:
         if type(sample_dict["levels"]) == str:
             sample_dict["levels"] = [sample_dict["levels"]]
         # Check all levels exist in category
-        if not all(
-                [level in self.get_category_levels(sample_dict["category"]) for level in sample_dict["levels"]]):
-            bad_levels = ", ".join([level for level in sample_dict["levels"] if
-                                    level not in self.get_category_levels(sample_dict["category"])])
+        cat_levels = set(self.get_category_levels(sample_dict["category"]))
+        if not all([level in cat_levels for level in sample_dict["levels"]]):
+            bad_levels = ", ".join([level for level in sample_dict["levels"] if level not in cat_levels])
             raise AssertionExcept(step=self.get_step_name(),
                                   comment="Level '{lev}' is not defined for "
                                           "category '{cat}'".format(lev=bad_levels,
@@ -0,0 +1,381 @@
+""" Benchmarking workflow generation
+
+Synthesizes workflows of a given shape and size, generates their scripts with bin/neatseq_flow.py and records the
+wall time, the peak memory (RSS) and the number and size of the files written. Each workflow is generated in a
+separate process, so that the peak memory is that of a single generation.
+
+A configuration is defined by:
+
+* The shape of the workflow:
+
+  * ``linear``: Each step is based on the previous step.
+  * ``fanout``: All steps are based on a single step.
+  * ``diamond``: Pairs of steps based on the same step, joined by a step based on both.
+
+* The size, as STEPSxSAMPLESxTYPES: The number of steps (including Import), the number of samples and the number of
+  file types per sample in the sample file.
+* The executor: Local, SGE, SLURM etc.
+
+The workflows use the Import, Generic, samtools and merge_table modules. The first step after Import is a Generic step
+creating the bam and table files required by the samtools and merge_table steps.
+
+The results are saved as JSON. Comparing them with the results of a previous run (the baseline) reports the
+configurations whose time, memory or output grew by more than a given fraction, or whose number of files changed.
+See bin/neatseq_flow_benchmark.py.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import yaml
+
+
+FORMAT = "NeatSeq-Flow benchmark"
+FORMAT_VERSION = 1
+
+SHAPES = ["linear", "fanout", "diamond"]
+
+# A fixed run ID, so that the scripts written have the same size in every run
+RUN_ID = "20000101000000"
+
+# File types in the sample file, and the extension of their files. Types not recognized by Import are imported as is.
+FILE_TYPES = [("Forward", ".fq.gz"), ("Reverse", ".fq.gz"), ("Single", ".fq.gz")]
+
+# Metrics compared with the baseline. An increase by more than the tolerance is a regression.
+COMPARED_METRICS = ["wall_time", "peak_rss", "bytes"]
+
+
+def parse_size(size):
+    """ Converts a size string, STEPSxSAMPLESxTYPES (e.g. 10x100x2), to a tuple of ints.
+    """
+    match = re.match(r"^(\d+)x(\d+)x(\d+)$", size.strip())
+    if not match:
+        raise ValueError("Size '{size}' is not in the STEPSxSAMPLESxTYPES format, e.g. 10x100x2".format(size=size))
+    steps, samples, file_types = (int(value) for value in match.groups())
+    if steps < 2 or samples < 1 or file_types < 1:
+        raise ValueError("Size '{size}' must have at least 2 steps, 1 sample and 1 file type".format(size=size))
+    return steps, samples, file_types
+
+
+def get_config_name(shape, steps, samples, file_types, executor):
+    return "{shape}-{steps}x{samples}x{types}-{executor}".format(shape=shape,
+                                                                  steps=steps,
+                                                                  samples=samples,
+                                                                  types=file_types,
+                                                                  executor=executor)
+
+
+def get_file_types(file_types):
+    """ Returns a list of file_types (type, extension) tuples
+    """
+    types = FILE_TYPES[:file_types]
+    types.extend(("type{num}".format(num=num), ".txt") for num in range(len(types) + 1, file_types + 1))
+    return types
+
+
+def make_sample_file(filename, samples, file_types):
+    """ Writes a tabular sample file with samples samples, each with one file of each of file_types types
+    """
+    types = get_file_types(file_types)
+    with open(filename, "w") as sample_fh:
+        sample_fh.write("Title\tBenchmark\n\n")
+        sample_fh.write("#Type\tPath\nNucleotide\t/benchmark/reference.fasta\n\n")
+        sample_fh.write("#SampleID\tType\tPath\n")
+        for num in range(1, samples + 1):
+            for file_type, ext in types:
+                sample_fh.write("Sample{num}\t{type}\t/benchmark/Sample{num}_{type}{ext}\n".format(num=num,
+                                                                                                  type=file_type,
+                                                                                                  ext=ext))
+
+
+def make_step(kind, bases, input_type):
+    """ Returns the parameters of a step.
+
+    :param kind: "generic" (creates bam and table files from input_type), "samtools", "merge_table" or "join" (a
+                 generic step creating a new table from the table of its bases).
+    :param bases: List of base step names
+    :param input_type: The file type used by the first generic step
+    """
+    base = bases[0] if len(bases) == 1 else bases
+    if kind == "generic":
+        return {"module": "Generic",
+                "base": base,
+                "script_path": "mapper",
+                "scope": "sample",
+                "inputs": {"-i": {"File_Type": input_type}},
+                "outputs": {"-o": {"File_Type": "bam", "suffix": ".bam"},
+                            "-t": {"File_Type": "table", "suffix": ".tab"}}}
+    if kind == "samtools":
+        return {"module": "samtools",
+                "base": base,
+                "script_path": "samtools",
+                "scope": "sample",
+                "view": "-buh -q 30",
+                "sort": None,
+                "index": None}
+    if kind == "merge_table":
+        return {"module": "merge_table",
+                "base": base,
+                "script_path": None,
+                "type": "table"}
+    if kind == "join":
+        return {"module": "Generic",
+                "base": base,
+                "script_path": "joiner",
+                "scope": "sample",
+                "inputs": {"-t": {"File_Type": "table"}},
+                "outputs": {"-o": {"File_Type": "table", "suffix": ".tab"}}}
+    raise ValueError("Unknown step kind '{kind}'".format(kind=kind))
+
+
+def make_step_params(shape, steps):
+    """ Returns the Step_params of a workflow of the given shape with steps steps, as an ordered list of
+        (name, params) tuples.
+    """
+    if shape not in SHAPES:
+        raise ValueError("Unknown shape '{shape}'. Use one of: {shapes}".format(shape=shape, shapes=", ".join(SHAPES)))
+    # Forward is always the first file type in the sample file:
+    input_type = "fastq.F"
+    step_list = [("Import_files", {"module": "Import", "script_path": None}),
+                 ("Generic_1", make_step("generic", ["Import_files"], input_type))]
+    # Kinds of the other steps, in turn:
+    kinds = ["samtools", "merge_table", "join"]
+
+    def add_step(kind, bases):
+        name = "{kind}_{num}".format(kind=kind, num=len(step_list))
+        step_list.append((name, make_step(kind, bases, input_type)))
+        return name
+
+    last = "Generic_1"
+    while len(step_list) < steps:
+        if shape == "linear":
+            last = add_step(kinds[len(step_list) % len(kinds)], [last])
+        elif shape == "fanout":
+            add_step(kinds[len(step_list) % len(kinds)], ["Generic_1"])
+        elif steps - len(step_list) >= 3:
+            # A diamond: two steps based on the last join, and a join based on both
+            left = add_step("samtools", [last])
+            right = add_step("join", [last])
+            last = add_step("join", [left, right])
+        else:
+            last = add_step("join", [last])
+    return step_list[:steps]
+
+
+def make_param_file(filename, shape, steps, executor):
+    """ Writes the parameter file of a workflow
+    """
+    params = {"Global_params": {"Executor": executor,
+                                "Qsub_q": "benchmark.q",
+                                "Qsub_opts": "-V -cwd",
+                                "Default_wait": 10}}
+    # Written step by step, to keep the order of the steps and of the samtools programs
+    with open(filename, "w") as param_fh:
+        yaml.safe_dump(params, param_fh, default_flow_style=False)
+        param_fh.write("Step_params:\n")
+        for name, step_params in make_step_params(shape, steps):
+            param_fh.write("    {name}:\n".format(name=name))
+            for key, value in step_params.items():
+                param_fh.write("        " +
+                               yaml.safe_dump({key: value}, default_flow_style=False).
+                               rstrip("\n").replace("\n", "\n        ") +
+                               "\n")
+
+
+def count_files(directory):
+    """ Returns the number of files in directory, and their total size in bytes
+    """
+    files = 0
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(directory):
+        for file_name in file_names:
+            files += 1
+            size += os.path.getsize(os.path.join(dir_path, file_name))
+    return files, size
+
+
+def run_generation(command, log_file):
+    """ Runs command, with its output written to log_file.
+
+    :return: A tuple: (return code, wall time in seconds, peak RSS in bytes or None if not available)
+    """
+    start = time.perf_counter()
+    with open(log_file, "w") as log_fh:
+        process = subprocess.Popen(command, stdout=log_fh, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            # The resource usage of this child only
+            _, status, usage = os.wait4(process.pid, 0)
+            wall_time = time.perf_counter() - start
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+            wall_time = time.perf_counter() - start
+            peak_rss = None
+    return process.returncode, wall_time, peak_rss
+
+
+def run_config(shape, steps, samples, file_types, executor, work_dir, repeats=1, nsf_args=None):
+    """ Generates the workflow of a configuration repeats times.
+
+    :return: The result dict. The wall time is the shortest of the repeats and the peak RSS the largest.
+    """
+    name = get_config_name(shape, steps, samples, file_types, executor)
+    config_dir = os.path.join(work_dir, name)
+    workflow_dir = os.path.join(config_dir, "workflow")
+    if os.path.isdir(config_dir):
+        shutil.rmtree(config_dir)
+    os.makedirs(workflow_dir)
+    sample_file = os.path.join(config_dir, "samples.nsfs")
+    param_file = os.path.join(config_dir, "params.yaml")
+    make_sample_file(sample_file, samples, file_types)
+    make_param_file(param_file, shape, steps, executor)
+
+    nsf_script = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))),
+                              "bin",
+                              "neatseq_flow.py")
+    command = [sys.executable, nsf_script,
+               "-s", sample_file,
+               "-p", param_file,
+               "-d", workflow_dir,
+               "-r", RUN_ID] + list(nsf_args or [])
+
+    result = {"name": name,
+              "shape": shape,
+              "steps": steps,
+              "samples": samples,
+              "file_types": file_types,
+              "executor": executor,
+              "repeats": repeats}
+    for repeat in range(repeats):
+        # Starting from an empty workflow directory every time:
+        shutil.rmtree(workflow_dir)
+        os.makedirs(workflow_dir)
+        log_file = os.path.join(config_dir, "neatseq_flow.log")
+        returncode, wall_time, peak_rss = run_generation(command, log_file)
+        with open(log_file, "r") as log_fh:
+            succeeded = returncode == 0 and "Finished successfully" in log_fh.read()
+        if not succeeded:
+            result["status"] = "failed"
+            result["log"] = log_file
+            return result
+        result["wall_time"] = min(wall_time, result.get("wall_time", wall_time))
+        if peak_rss is not None:
+            result["peak_rss"] = max(peak_rss, result.get("peak_rss", peak_rss))
+    result["status"] = "ok"
+    result["files"], result["bytes"] = count_files(workflow_dir)
+    return result
+
+
+def run_benchmark(shapes, sizes, executors, output, work_dir=None, repeats=1, nsf_args=None, keep=False,
+                  stream=None):
+    """ Runs all configurations and writes the results to output.
+
+    :param sizes: List of STEPSxSAMPLESxTYPES strings
+    :param work_dir: Directory for the workflows. By default, a temporary directory, removed when done.
+    :param keep: Keep the workflows in work_dir. The workflows of failed configurations are always kept.
+    :return: The results dict
+    """
+    stream = stream if stream is not None else sys.stderr
+    parsed_sizes = [parse_size(size) for size in sizes]
+    for shape in shapes:
+        if shape not in SHAPES:
+            raise ValueError("Unknown shape '{shape}'. Use one of: {shapes}".format(shape=shape,
+                                                                                  shapes=", ".join(SHAPES)))
+    temp_dir = None
+    if work_dir is None:
+        temp_dir = work_dir = tempfile.mkdtemp(prefix="nsf_benchmark_")
+    results = list()
+    try:
+        for shape in shapes:
+            for steps, samples, file_types in parsed_sizes:
+                for executor in executors:
+                    result = run_config(shape, steps, samples, file_types, executor, work_dir, repeats, nsf_args)
+                    stream.write(format_result(result) + "\n")
+                    results.append(result)
+                    if not keep and result["status"] == "ok":
+                        shutil.rmtree(os.path.join(work_dir, result["name"]))
+    finally:
+        # The workflows of failed configurations are kept, for their logs
+        if temp_dir is not None and not keep and all(result["status"] == "ok" for result in results):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    benchmark = {"format": FORMAT,
+                 "format_version": FORMAT_VERSION,
+                 "neatseq_flow_version": __version__,
+                 "python": platform.python_version(),
+                 "platform": sys.platform,
+                 "results": sorted(results, key=lambda result: result["name"])}
+    with open(output, "w") as output_fh:
+        json.dump(benchmark, output_fh, indent=1, sort_keys=True)
+        output_fh.write("\n")
+    return benchmark
+
+
+def format_result(result):
+    if result["status"] != "ok":
+        return "{name:<40} FAILED (see {log})".format(**result)
+    return "{name:<40} {time:>9.3f}s {memory:>12} {files:>8} files {size:>14} bytes".format(
+        name=result["name"],
+        time=result["wall_time"],
+        memory="%.1f MB" % (result["peak_rss"] / 1024.0 / 1024.0) if "peak_rss" in result else "-",
+        files=result["files"],
+        size=result["bytes"])
+
+
+def compare_results(benchmark, baseline, tolerance=0.25, stream=None):
+    """ Compares benchmark results with baseline results, reporting regressions to stream (default: stdout).
+
+    A regression is a failed configuration, a change in the number of files written, or an increase by more than
+    tolerance (a fraction) in one of COMPARED_METRICS. Configurations missing from either results are reported,
+    but are not regressions.
+
+    :return: The number of regressions
+    """
+    stream = stream if stream is not None else sys.stdout
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    regressions = 0
+    for result in benchmark["results"]:
+        name = result["name"]
+        if name not in baseline_results:
+            stream.write("{name}: not in baseline\n".format(name=name))
+            continue
+        base_result = baseline_results.pop(name)
+        if result["status"] != "ok":
+            stream.write("{name}: REGRESSION: generation failed\n".format(name=name))
+            regressions += 1
+            continue
+        if base_result["status"] != "ok":
+            stream.write("{name}: failed in baseline\n".format(name=name))
+            continue
+        if result["files"] != base_result["files"]:
+            stream.write("{name}: REGRESSION: files: {base} -> {new}\n".format(name=name,
+                                                                              base=base_result["files"],
+                                                                              new=result["files"]))
+            regressions += 1
+        for metric in COMPARED_METRICS:
+            if metric not in result or not base_result.get(metric):
+                continue
+            ratio = float(result[metric]) / base_result[metric]
+            if ratio > 1 + tolerance:
+                stream.write("{name}: REGRESSION: {metric}: {base} -> {new} ({ratio:+.0%})\n".
+                             format(name=name,
+                                    metric=metric,
+                                    base=base_result[metric],
+                                    new=result[metric],
+                                    ratio=ratio - 1))
+                regressions += 1
+    for name in sorted(baseline_results):
+        stream.write("{name}: missing from results\n".format(name=name))
+    return regressions
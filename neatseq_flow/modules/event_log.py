@@ -0,0 +1,191 @@
+""" The structured event log of a workflow
+
+By default, log_echo and func_trap (see CC.helper_funcs.sh) write the Started and Finished lines of every job to the
+workflow log file (logs/log_<run_code>.txt) while holding a lock on the file, so that lines written by concurrent jobs
+are not mixed. When many jobs start and finish together, they queue up on the lock. When 'event_log: jsonl' is set in
+the global parameters, the jobs append their events to logs/log_<run_code>.jsonl instead, without a lock: Every event
+is a single JSON line, written with a single write to the file opened for appending, so lines written concurrently
+are never interleaved. (This holds for a local file system. NFS does not guarantee it for appends from several nodes.)
+
+Every event holds:
+
+    time        The time of the event, in seconds since the epoch, with microsecond resolution
+    event       Started or Finished
+    module, instance, job, level, host, jobid, maxvmem
+                As in the log file
+    status      OK, ERROR or TERMINATED
+    exit_code   The exit code of the job (Finished events only). 130, 143 and 140 for SIGINT, SIGTERM and SIGUSR2
+    duration    The time since the job started, in seconds (Finished events of jobs whose start was logged)
+
+The log file read by the monitor and by logs/log_file_plotter.R is produced from the events with this module
+(scripts/NSF_event_log.sh):
+
+    event_log.py --events <log.jsonl> --log_file <log.txt> [--follow [--interval SECONDS]]
+
+The lines of the events are written after the header of the log file, replacing the lines already there. With
+--follow, the lines of new events are appended as they are written, until interrupted.
+
+The module is executed as a script by the workflow, and must not import anything but the standard library.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+
+# The last line of the header of the log file (see create_log_file() in PLC_main.py):
+LOG_COLUMNS = "Timestamp\tEvent\tModule\tInstance\tJob name\tLevel\tHost\tJob ID\tMax mem\tStatus"
+LOG_TIME_FORMAT = "%d/%m/%Y %H:%M:%S"
+# The exit codes of the jobs terminated by the signals trapped by func_trap:
+SIGNAL_EXIT_CODES = {"INT": 130, "TERM": 143, "SIGUSR2": 140}
+
+
+def format_log_line(event):
+    """ Returns the log file line of an event, as written by log_echo and func_trap
+    """
+    color = "32" if event.get("status") == "OK" else "31"
+    return "\t".join([time.strftime(LOG_TIME_FORMAT, time.localtime(float(event["time"]))),
+                      event["event"],
+                      event.get("module", ""),
+                      event.get("instance", ""),
+                      event.get("job", ""),
+                      event.get("level", ""),
+                      event.get("host", ""),
+                      str(event.get("jobid", "")),
+                      str(event.get("maxvmem", "-")),
+                      "\033[0;{color}m{status}\033[m".format(color=color, status=event.get("status", ""))])
+
+
+def make_event(event, module, instance, job, level, host, jobid, maxvmem="-", status="OK", exit_code=None,
+               duration=None):
+    """ Returns an event, with the fields in the order written by event_echo
+    """
+    record = dict(time=round(time.time(), 6),
+                  event=event,
+                  module=module,
+                  instance=instance,
+                  job=job,
+                  level=level,
+                  host=host,
+                  jobid=jobid,
+                  maxvmem=maxvmem,
+                  status=status)
+    if exit_code is not None:
+        record["exit_code"] = exit_code
+    if duration is not None:
+        record["duration"] = round(duration, 6)
+    return record
+
+
+def append_event(path, record):
+    """ Appends an event to the event log, with a single write
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    event_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(event_fd, line)
+    finally:
+        os.close(event_fd)
+
+
+def read_events(path, offset=0):
+    """ Returns the events written to the event log after offset, and the offset following them.
+        A last line without a newline is being written, and is left for the next read.
+    """
+    events = list()
+    try:
+        with open(path, "rb") as events_fh:
+            events_fh.seek(offset)
+            data = events_fh.read()
+    except IOError:
+        return events, offset
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line.decode("utf-8")))
+        except ValueError:
+            sys.stderr.write("WARNING: Skipping malformed event in {path}: {line}\n".
+                             format(path=path, line=line.decode("utf-8", "replace")))
+    return events, offset + end
+
+
+def read_log_header(log_file):
+    """ Returns the header of the log file, up to and including the line of the column names
+    """
+    header = list()
+    with open(log_file) as log_fh:
+        for line in log_fh:
+            header.append(line)
+            if line.rstrip("\n") == LOG_COLUMNS:
+                return "".join(header)
+    raise ValueError("Log file {log} has no header line".format(log=log_file))
+
+
+def convert(events_path, log_file):
+    """ Writes the lines of the events to the log file, after its header. Returns the offset of the events read.
+    """
+    header = read_log_header(log_file)
+    events, offset = read_events(events_path)
+    # Writing to a temporary file and renaming, so that the monitor never reads a partial log file:
+    temp_fh, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(log_file)), suffix=".tmp")
+    try:
+        with os.fdopen(temp_fh, "w") as log_fh:
+            log_fh.write(header)
+            log_fh.write("".join(format_log_line(event) + "\n" for event in events))
+        os.chmod(temp_path, 0o666 & ~get_umask())
+        os.replace(temp_path, log_file)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return offset
+
+
+def follow(events_path, log_file, interval=1.0):
+    """ Converts the events, and then appends the lines of new events to the log file as they are written
+    """
+    offset = convert(events_path, log_file)
+    while True:
+        time.sleep(interval)
+        events, offset = read_events(events_path, offset)
+        if events:
+            with open(log_file, "a") as log_fh:
+                log_fh.write("".join(format_log_line(event) + "\n" for event in events))
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the log file of a NeatSeq-Flow workflow from its event log")
+    parser.add_argument("--events", required=True, help="The event log (log_<run_code>.jsonl)")
+    parser.add_argument("--log_file", required=True, help="The log file (log_<run_code>.txt)")
+    parser.add_argument("--follow", action="store_true", help="Keep appending the lines of new events")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between reads, with --follow")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.follow:
+            follow(args.events, args.log_file, args.interval)
+        else:
+            convert(args.events, args.log_file)
+    except (IOError, ValueError) as err:
+        sys.exit(str(err))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+""" An index of the samples in the levels of the grouping categories
+
+The grouping data of a sample is stored in its "..grouping.." slot, as a {category: level} dict (see
+parse_grouping_file() in parse_sample_data.py). Finding the levels of a category, or the samples in a level, requires
+reading the grouping data of every sample. A GroupingIndex reads it once, and keeps the samples in each level of each
+category, in the order of the sample list.
+
+An index is built for a specific sample list. is_current() tells whether the sample list was changed since the index
+was built (see the version of SampleList in sample_list.py). Note that changes made to the grouping data of a sample
+already in the sample list are not detected.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+from .sample_data_layer import get_value
+from .sample_list import SampleList
+
+
+class GroupingIndex(object):
+    """ A category -> level -> samples index of the grouping data of a sample list
+    """
+
+    def __init__(self, sample_data, samples):
+        """
+        :param sample_data: The sample_data (a dict or a SampleDataLayer) containing the samples' grouping data
+        :param samples: The sample list to index
+        """
+        self.samples = samples
+        self.version = getattr(samples, "version", None)
+        self.ungrouped = SampleList()   # Samples without grouping data
+        self.levels = dict()            # {category: {level: SampleList of samples}}
+        self.category_samples = dict()  # {category: SampleList of samples having the category}
+
+        for sample in samples:
+            # get_value() is used so that reading the index does not copy the slots into a SampleDataLayer
+            if sample not in sample_data or "..grouping.." not in get_value(sample_data, sample):
+                self.ungrouped.append(sample)
+                continue
+            grouping = get_value(get_value(sample_data, sample), "..grouping..")
+            for category in grouping:
+                level = get_value(grouping, category)
+                self.levels.setdefault(category, dict()).setdefault(level, SampleList()).append(sample)
+                self.category_samples.setdefault(category, SampleList()).append(sample)
+
+    def is_current(self, samples):
+        """ Returns True if the index was built for samples, and samples was not changed since.
+            Lists that have no version (i.e. are not SampleLists) are never current.
+        """
+        return samples is self.samples and self.version is not None and samples.version == self.version
+
+    def has_category(self, category):
+        """ Returns True if all samples have a level for category
+        """
+        return len(self.category_samples.get(category, ())) == len(self.samples)
+
+    def get_samples_without(self, category):
+        """ Returns the list of samples that do not have a level for category
+        """
+        category_samples = self.category_samples.get(category, ())
+        return [sample for sample in self.samples if sample not in category_samples]
+
+    def get_levels(self, category):
+        """ Returns the list of levels of category, in order of first appearance in the sample list
+        """
+        return list(self.levels.get(category, dict()))
+
+    def get_samples(self, category, level):
+        """ Returns the list of samples in level of category.
+            Raises KeyError if category is not defined for all samples.
+        """
+        if not self.has_category(category):
+            raise KeyError(category)
+        return list(self.levels.get(category, dict()).get(level, ()))
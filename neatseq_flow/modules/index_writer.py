@@ -0,0 +1,30 @@
+""" A buffered writer for the index files shared by all steps
+
+The steps add lines to script_index, run_index and depend_index for every script they create. Instead of opening
+and closing the files for every line, the lines are collected by an IndexWriter and written to each file in a
+single write when the step is done. The content and order of the lines are not changed.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+class IndexWriter(object):
+    """ Collects text to append to files and appends it on flush()
+    """
+
+    def __init__(self):
+        self.buffers = dict()   # {filename: [text, ...]}, in order of first write
+
+    def write(self, filename, text):
+        """ Store text for appending to filename
+        """
+        self.buffers.setdefault(filename, list()).append(text)
+
+    def flush(self):
+        """ Append the stored text to the files, one write per file
+        """
+        buffers, self.buffers = self.buffers, dict()
+        for filename, text_list in buffers.items():
+            with open(filename, "a") as index_fh:
+                index_fh.write("".join(text_list))
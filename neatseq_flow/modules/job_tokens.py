@@ -0,0 +1,301 @@
+""" job_limit tokens for the Local executor
+
+With 'job_limit', the high level scripts used to call wait_limit before starting every low level job, which re-read
+run_index and the job_limit file every few seconds until less than 'limit' jobs were running. For the Local executor,
+the limit is now applied with a pool of tokens owned by a daemon per run: A low level job is started only when it gets
+one of the 'limit' tokens, and holds it until it exits. The jobs waiting for a token are blocked on the daemon's
+socket, without polling, and the first of them is released as soon as a running job exits.
+
+NSF_exec.sh gets the token when the job's dependencies are done, before it reserves the job's resources and starts the
+job with runlock (see get_token in CC.helper_funcs.sh). It runs this module as a coprocess:
+
+    python job_tokens.py --socket <socket> --job_limit <job_limit file> hold --lock <lock file> <job name>
+
+which waits for a token, prints 'ok' when it gets it, and keeps the connection to the daemon open while the job runs.
+The connection is the token. NSF_exec.sh locks the lock file (with flock) on file descriptor TOKEN_FD before it starts
+this module, and the job inherits the descriptor. This module waits for the lock, which is released when the job exits,
+however it exits, and then closes the connection. (Processes started by the job in the background inherit the
+descriptor too, so the token is returned when the last of them exits.) Jobs other than low level jobs get 'ok' without
+a token. While waiting, the job is marked as 'hold' in run_index, as while waiting for its dependencies, and is killed
+by the kill scripts as such.
+
+The daemon is started by the first job, and exits when it has had no tokens taken and no jobs waiting for IDLE_TIMEOUT
+seconds. The limit is read from the job_limit file (e.g. 'limit=10 sleep=60'. The sleep time is not used) whenever
+the file is changed, so editing the file changes the limit of the running workflow. While jobs are waiting, the file
+is checked every TOKEN_CHECK_INTERVAL seconds. Setting the limit to 0 holds all the jobs which have not started yet.
+
+    python job_tokens.py --socket <socket> --job_limit <job_limit file> status
+
+lists the jobs holding tokens and the jobs waiting for them.
+
+The module is executed as a script by the workflow, and must not import anything but the standard library (and
+local_scheduler.py, which is in the same directory).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import signal
+import socket
+import argparse
+import selectors
+import subprocess
+from collections import OrderedDict
+
+try:
+    from .local_scheduler import IDLE_TIMEOUT, CONNECT_TIMEOUT, JobLimit, is_low_level, connect, receive_line, \
+        send_request
+except ImportError:
+    # Executed as a script
+    from local_scheduler import IDLE_TIMEOUT, CONNECT_TIMEOUT, JobLimit, is_low_level, connect, receive_line, \
+        send_request
+
+
+# Seconds between checks for changes in the job_limit file, while jobs are waiting for tokens:
+TOKEN_CHECK_INTERVAL = 1
+# The file descriptor of the token in the job. Above the ones used by the helper functions (see CC.helper_funcs.sh):
+TOKEN_FD = 230
+
+
+class TokenPool(object):
+    """ The tokens of a run. The connections of the jobs holding tokens are kept open until the jobs exit.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.job_limit = JobLimit(args.job_limit)
+        self.waiting = OrderedDict()    # {connection: job name}, in the order of arrival
+        self.holders = dict()           # {connection: job name}
+        self.idle_since = time.time()
+
+    def log(self, message):
+        sys.stdout.write("{date}\t{message}\n".format(date=time.strftime("%d/%m/%Y %H:%M:%S"), message=message))
+        sys.stdout.flush()
+
+    def grant(self):
+        """ Gives tokens to the waiting jobs, in the order of arrival, while there are free tokens
+        """
+        limit = self.job_limit.get_limit()
+        while self.waiting and (limit is None or len(self.holders) < limit):
+            conn, name = self.waiting.popitem(last=False)
+            try:
+                conn.sendall((json.dumps({"ok": True}) + "\n").encode("utf-8"))
+            except OSError:
+                self.close(conn)
+                continue
+            self.holders[conn] = name
+
+    def close(self, conn):
+        """ Closes the connection of a job, returning its token or removing it from the waiting jobs
+        """
+        self.waiting.pop(conn, None)
+        self.holders.pop(conn, None)
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+
+    def handle_connection(self, conn):
+        """ Reads the request of a new connection
+        """
+        conn.settimeout(10)
+        try:
+            request = json.loads(receive_line(conn))
+            command = request.get("command")
+        except Exception as err:
+            command = None
+            response = {"ok": False, "error": "Bad request: {err}".format(err=err)}
+        if command == "acquire":
+            conn.setblocking(False)
+            # Readable only when the job closes the connection (i.e. exits):
+            self.selector.register(conn, selectors.EVENT_READ, "job")
+            self.waiting[conn] = request["job"]
+            return
+        if command == "status":
+            lines = ["running\t{name}".format(name=name) for name in self.holders.values()] + \
+                    ["waiting\t{name}".format(name=name) for name in self.waiting.values()]
+            lines.append("Tokens taken: {taken}/{limit}".format(taken=len(self.holders),
+                                                                limit=self.job_limit.get_limit()))
+            response = {"ok": True, "message": "\n".join(lines)}
+        elif command is not None:
+            response = {"ok": False, "error": "Unknown command {command}".format(command=command)}
+        try:
+            conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+        conn.close()
+
+    def run(self, listener):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(listener, selectors.EVENT_READ, "listener")
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        while True:
+            timeout = TOKEN_CHECK_INTERVAL if self.waiting else IDLE_TIMEOUT
+            for key, mask in self.selector.select(timeout):
+                if key.data == "listener":
+                    try:
+                        conn, address = listener.accept()
+                    except OSError:
+                        continue
+                    self.handle_connection(conn)
+                else:
+                    try:
+                        data = key.fileobj.recv(1024)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data = b""
+                    if not data:
+                        self.close(key.fileobj)
+            self.grant()
+            if self.waiting or self.holders:
+                self.idle_since = time.time()
+            elif time.time() - self.idle_since >= IDLE_TIMEOUT:
+                self.log("No jobs for {sec} seconds. Exiting".format(sec=IDLE_TIMEOUT))
+                break
+
+
+# -------------------------------------------------------------------
+# Client side
+
+
+def start_daemon(args):
+    """ Starts the daemon in a session of its own
+    """
+    daemon_args = [sys.executable, os.path.realpath(__file__), "--socket", args.socket]
+    if args.job_limit:
+        daemon_args += ["--job_limit", args.job_limit]
+    with open(os.path.splitext(args.socket)[0] + ".log", "a") as daemon_log:
+        subprocess.Popen(daemon_args + ["daemon"],
+                         stdin=subprocess.DEVNULL,
+                         stdout=daemon_log,
+                         stderr=daemon_log,
+                         cwd="/",
+                         start_new_session=True)
+
+
+def acquire(args):
+    """ Waits for a token. Returns the connection holding it.
+    """
+    request = (json.dumps({"command": "acquire", "job": args.job, "pid": os.getpid()}) + "\n").encode("utf-8")
+    deadline = time.time() + CONNECT_TIMEOUT
+    last_start = 0
+    while True:
+        conn = connect(args.socket)
+        if conn is None:
+            if time.time() > deadline:
+                sys.exit("Failed getting a job_limit token for {job}: The token daemon did not start. See {log}".
+                         format(job=args.job, log=os.path.splitext(args.socket)[0] + ".log"))
+            # Starting the daemon again every few seconds, in case the new daemon found an exiting one still holding
+            # the lock (see run_daemon())
+            if time.time() - last_start > 2:
+                start_daemon(args)
+                last_start = time.time()
+            time.sleep(0.1)
+            continue
+        try:
+            conn.sendall(request)
+            # Blocks until the token is given:
+            response = receive_line(conn)
+        except OSError:
+            response = ""
+        if not response:
+            # The daemon exited before giving the token. Starting again:
+            conn.close()
+            deadline = time.time() + CONNECT_TIMEOUT
+            continue
+        response = json.loads(response)
+        if not response["ok"]:
+            sys.exit("Failed getting a job_limit token for {job}: {error}".format(job=args.job,
+                                                                                 error=response["error"]))
+        return conn
+
+
+def hold(args):
+    """ Waits for a token if the job is a low level job, and prints 'ok'. Then holds the token until the lock on the
+        job's lock file is released, i.e. until the job and the processes it started have exited.
+    """
+    # Killed with the job by the kill scripts. Removing the lock file on the way out:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    conn = None
+    try:
+        conn = acquire(args) if is_low_level(args.job) else None
+        sys.stdout.write("ok\n")
+        sys.stdout.flush()
+        if conn is not None:
+            with open(args.lock, "a") as lock_fh:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+    finally:
+        if os.path.exists(args.lock):
+            os.remove(args.lock)
+        if conn is not None:
+            conn.close()
+
+
+def run_daemon(args):
+    # Only one daemon per socket. Exiting if another daemon holds the lock:
+    lock_fh = open(args.socket + ".lock", "a")
+    try:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return
+        raise
+    os.chdir(os.path.dirname(args.socket) or ".")
+    socket_name = os.path.basename(args.socket)
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_name)
+    listener.listen(128)
+    pool = TokenPool(args)
+    pool.log("Token daemon started (pid {pid})".format(pid=os.getpid()))
+    try:
+        pool.run(listener)
+    finally:
+        listener.close()
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+        lock_fh.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="job_limit tokens for NeatSeq-Flow's Local executor")
+    parser.add_argument("--socket", required=True, help="The daemon's socket")
+    parser.add_argument("--job_limit", help="The job_limit file")
+    commands = parser.add_subparsers(dest="command")
+    hold_parser = commands.add_parser("hold", help="Wait for a token, print 'ok' and hold the token until the lock "
+                                                   "on the lock file is released")
+    hold_parser.add_argument("--lock", required=True, help="The job's lock file, locked by the job while it runs")
+    hold_parser.add_argument("job", help="The job name")
+    commands.add_parser("status", help="List the jobs holding and waiting for tokens")
+    commands.add_parser("daemon", help="Run the daemon")
+    args = parser.parse_args(argv)
+
+    if args.command == "hold":
+        hold(args)
+    elif args.command == "daemon":
+        run_daemon(args)
+    elif args.command == "status":
+        response = send_request(args.socket, {"command": "status"})
+        if response is None:
+            print("The token daemon is not running")
+        elif not response["ok"]:
+            sys.exit(response["error"])
+        else:
+            print(response["message"])
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
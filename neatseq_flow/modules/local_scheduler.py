@@ -0,0 +1,901 @@
+""" A scheduler daemon for the Local executor
+
+By default, every job of a Local run is started by its own NSF_exec.sh process, which waits for the job's dependencies
+by reading run_index.txt every 3 seconds. When 'local_scheduler' is set in the global parameters, NSF_exec.sh passes the
+job to a single scheduler daemon per run instead, and returns as soon as the job is registered:
+
+    python local_scheduler.py <options> submit <job name> <stdout file> <stderr file>
+
+The daemon is started by the first submission, and exits when it has had no jobs for IDLE_TIMEOUT seconds.
+It keeps the jobs waiting for their dependencies in memory, indexed by the dependencies, and starts a job as soon as
+its dependencies are done. It is notified when a job it started exits (SIGCHLD), so it does not poll the jobs.
+
+The daemon keeps the behaviour of NSF_exec.sh:
+
+- The dependencies of a job are read from the '#$ -hold_jid' line of its script, and the script path from script_index.
+- A dependency is waited for while it is active, i.e. waiting or running in the daemon, or, for jobs not started by the
+  daemon (e.g. the tasks of a bundle, see scriptconstructor.py), while its line in run_index is not commented out.
+- The jobs are marked in run_index as 'hold' while waiting and as 'PID' when running (with the pid, the number of
+  slots requested with '-pe' and the memory requested, in MB). The scripts mark themselves as done in run_index, as before. A job that exits without
+  doing so is marked as done by the daemon, with its exit status.
+- 'Started' lines are written to the log file when a job is queued, as NSF_exec.sh does. With 'event_log: jsonl', the
+  events are appended to the event log instead (see event_log.py, passed with --event_log).
+- Waiting jobs are killed (marked 'killed' in run_index) when the run_index.killall file is created by the kill script,
+  or when run_index is deleted. The running jobs are killed by the kill scripts, as before. Each job is started in a
+  session of its own, so that killing its process group kills only the job.
+- With 'job_limit', low level jobs are started only when less than 'limit' low level jobs are running. The limit is
+  read again whenever the job_limit file is changed.
+- A job is started only when the node has the CPUs ('#$ -pe' line) and memory ('#$ -mem' line, in MB) it requests
+  free, counting the jobs running in the daemon and the other jobs marked as running in run_index. The capacity of
+  the node is passed with --cpus and --mem, and is by default the number of CPUs available to the process and the
+  total memory in /proc/meminfo. A job requesting more than the capacity is started when it would fit on an idle node.
+
+With 'run_state: sqlite', the jobs are tracked in the run state database instead of run_index (see run_state.py, passed
+with --run_state). run_index is written from the database when the daemon exits, as well as by the script marking the
+last active job as done.
+
+Besides 'submit', the following commands are sent to a running daemon: 'cancel <prefix>' kills the waiting jobs whose
+name starts with prefix (used by the step kill scripts), and 'status' lists the waiting and running jobs.
+
+The module is executed as a script by the workflow, and must not import anything but the standard library (and
+run_state.py and event_log.py, which are in the same directory).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import re
+import math
+import json
+import time
+import fcntl
+import errno
+import signal
+import socket
+import argparse
+import selectors
+import subprocess
+from collections import OrderedDict
+
+try:
+    from . import event_log
+except ImportError:
+    # Executed as a script
+    import event_log
+
+
+# Seconds without jobs after which the daemon exits:
+IDLE_TIMEOUT = 60
+# Seconds between checks for the killall file and for changes in run_index and job_limit made by others:
+HOUSEKEEPING_INTERVAL = 5
+# Seconds a client waits for a newly started daemon to accept connections:
+CONNECT_TIMEOUT = 30
+# Separator between the parts of job names (step..name..sample..run_code), see PLC_step.py:
+JID_NAME_SEP = ".."
+
+# Memory units, in MB:
+MEM_UNITS = {"b": 1.0 / 1024 ** 2, "k": 1.0 / 1024, "m": 1, "g": 1024, "t": 1024 ** 2, "p": 1024 ** 3}
+
+
+def is_low_level(name):
+    """ Returns True for low level job names, i.e. with a sample (or other sub-step) part, as counted by wait_limit
+    """
+    return name.count(JID_NAME_SEP) >= 3
+
+
+def parse_mem_size(size, default_unit="m"):
+    """ Returns a memory size such as '4G', '512mb' or '2.5GiB' in MB (rounded up), or None if it can't be parsed.
+        Sizes without a unit are in default_unit ('b' for bytes, 'k', 'm', 'g', ...).
+    """
+    match = re.match(r"^\s*([0-9]*\.?[0-9]+)\s*([kmgtp]?)(i?b)?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        return None
+    unit = match.group(2).lower() or ("b" if match.group(3) else default_unit.lower())
+    return int(math.ceil(float(match.group(1)) * MEM_UNITS[unit]))
+
+
+def get_node_capacity(cpus=None, mem=None):
+    """ Returns the number of CPUs and the memory (in MB) of the node. Values not passed are detected: The CPUs
+        available to the process (as with nproc) and MemTotal in /proc/meminfo. The memory is None if it is unknown.
+    """
+    if not cpus:
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 1
+    if not mem:
+        mem = None
+        try:
+            with open("/proc/meminfo") as meminfo_fh:
+                for line in meminfo_fh:
+                    if line.startswith("MemTotal:"):
+                        mem = int(line.split()[1]) // 1024
+                        break
+        except OSError:
+            pass
+    return cpus, mem
+
+
+def get_leading_number(text):
+    """ Returns the number at the start of the last word of text (e.g. 4 for '#$ -pe shared 4'), or 0
+    """
+    words = text.split()
+    match = re.match("[0-9]+", words[-1]) if words else None
+    return int(match.group(0)) if match else 0
+
+
+def read_script_header(script_path):
+    """ Returns the dependencies (from '#$ -hold_jid' lines), the number of slots (from '#$ -pe' lines) and the memory
+        in MB (from '#$ -mem' lines) of a script
+    """
+    hold_jids = list()
+    slots = 0
+    mem = 0
+    with open(script_path) as script_fh:
+        for line in script_fh:
+            if line.startswith("#$ -hold_jid"):
+                fields = line.split(" ")
+                if len(fields) > 2:
+                    hold_jids.extend(jid for jid in fields[2].strip().split(",") if jid)
+            elif line.startswith("#$ -pe"):
+                slots = get_leading_number(line)
+            elif line.startswith("#$ -mem"):
+                mem = get_leading_number(line)
+    return hold_jids, slots, mem
+
+
+class RunIndex(object):
+    """ The run_index file, shared with the scripts, which update it with locksed (see CC.helper_funcs.sh)
+        Lines of active jobs begin with the job name. Lines of other jobs are commented out.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat_key = None
+        self.active = set()
+        self.resources = dict()     # {name: (slots, mem)} of the running jobs
+
+    def get_stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def changed(self):
+        """ Returns True if the file changed since it was last read
+        """
+        return self.get_stat_key() != self.stat_key
+
+    def get_active(self):
+        """ Returns the names of the active jobs. The file is read again only if it was changed.
+        """
+        stat_key = self.get_stat_key()
+        if stat_key != self.stat_key:
+            active = set()
+            resources = dict()
+            try:
+                with open(self.path) as index_fh:
+                    for line in index_fh:
+                        if line.strip() and not line.startswith("#"):
+                            fields = line.split()
+                            active.add(fields[0])
+                            # Running jobs: name, PID, pid, slots and memory, as in Checkresources (CC.helper_funcs.sh)
+                            if len(fields) > 3 and fields[1] == "PID":
+                                resources[fields[0]] = (get_leading_number(fields[3]),
+                                                        get_leading_number(fields[4]) if len(fields) > 4 else 0)
+            except OSError:
+                pass
+            self.active = active
+            self.resources = resources
+            self.stat_key = stat_key
+        return self.active
+
+    def get_resources(self):
+        """ Returns the slots and memory of the running jobs, a {name: (slots, mem)} dict
+        """
+        self.get_active()
+        return self.resources
+
+    def update(self, lines):
+        """ Replaces the lines of the jobs in lines, a {job name: (new line, only if active)} dict, in a single pass.
+            Holds the lock used by locksed, and replaces the file like 'sed -i' does.
+        """
+        with open(self.path + ".lock", "a") as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as index_fh:
+                    old_lines = index_fh.readlines()
+            except OSError:
+                return
+            new_lines = list()
+            for line in old_lines:
+                match = re.match(r"(#\s*)?(\S+)", line)
+                if match and match.group(2) in lines:
+                    new_line, only_active = lines[match.group(2)]
+                    if not (only_active and match.group(1)):
+                        line = new_line + "\n"
+                new_lines.append(line)
+            temp_path = "{path}.{pid}.tmp".format(path=self.path, pid=os.getpid())
+            with open(temp_path, "w") as temp_fh:
+                temp_fh.writelines(new_lines)
+            os.chmod(temp_path, os.stat(self.path).st_mode & 0o7777)
+            os.replace(temp_path, self.path)
+
+
+class RunStateIndex(object):
+    """ The run state database (see run_state.py), used like a RunIndex. The existence of the run_index file is still
+        checked, so that deleting it stops the waiting jobs, as before.
+    """
+
+    def __init__(self, db_path, path):
+        # Imported here, because sqlite3 is needed only with --run_state:
+        try:
+            from . import run_state
+        except ImportError:
+            # Executed as a script
+            import run_state
+        self.path = path
+        self.run_state = run_state.RunState(db_path)
+        self.version = None
+        self.active = set()
+        self.resources = dict()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def changed(self):
+        """ Returns True if the database was changed by others since it was last read
+        """
+        return self.run_state.get_version() != self.version
+
+    def get_active(self):
+        version = self.run_state.get_version()
+        if version != self.version:
+            self.active = set(self.run_state.get_active())
+            self.resources = self.run_state.get_resources()
+            self.version = version
+        return self.active
+
+    def get_resources(self):
+        self.get_active()
+        return self.resources
+
+    def update(self, lines):
+        self.run_state.update(lines)
+        # The version changes only with the changes made by other connections. Reading again next time:
+        self.version = None
+
+    def export(self):
+        """ Writes the run state to the run_index file
+        """
+        self.run_state.export_text(self.path)
+
+
+class ScriptIndex(object):
+    """ The script_index file: The script path of each job. Read again if it was changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat_key = None
+        self.scripts = dict()
+
+    def get_script(self, name):
+        stat = os.stat(self.path)
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key != self.stat_key:
+            scripts = dict()
+            with open(self.path) as index_fh:
+                for line in index_fh:
+                    fields = line.split()
+                    if len(fields) >= 2:
+                        # As in NSF_exec.sh, the last path defined for the job is used
+                        scripts[fields[0]] = fields[1]
+            self.scripts = scripts
+            self.stat_key = stat_key
+        return self.scripts.get(name)
+
+
+class JobLimit(object):
+    """ The job_limit file, with a line such as 'limit=1000 sleep=60'. Read again if it was changed.
+        Only the limit is used by the daemon.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat_key = None
+        self.limit = None
+
+    def get_limit(self):
+        """ Returns the maximal number of running low level jobs, or None for no limit
+        """
+        if not self.path:
+            return None
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return self.limit
+        stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat_key != self.stat_key:
+            with open(self.path) as limit_fh:
+                match = re.search("limit=([0-9]+)", limit_fh.read())
+            self.limit = int(match.group(1)) if match else None
+            self.stat_key = stat_key
+        return self.limit
+
+
+class Job(object):
+    """ A job submitted to the daemon
+    """
+
+    def __init__(self, name, script_path, hold_jids, slots, mem, request):
+        self.name = name
+        self.script_path = script_path
+        self.hold_jids = hold_jids
+        self.slots = slots
+        self.mem = mem
+        self.stdout = request["stdout"]
+        self.stderr = request["stderr"]
+        self.cwd = request.get("cwd")
+        self.env = request.get("env")
+        self.queue_pid = request.get("pid", os.getpid())   # The pid logged for the queued job, i.e. of the client
+        self.low_level = is_low_level(name)
+        self.blockers = set()   # The dependencies managed by the daemon which are still active
+        self.proc = None
+        self.started = None     # The time the job was queued, for the duration in the event log
+
+    @property
+    def module(self):
+        return self.name.split(JID_NAME_SEP)[0]
+
+    @property
+    def instance(self):
+        return self.name.split(JID_NAME_SEP)[1]
+
+
+class Scheduler(object):
+    """ The scheduler daemon
+    """
+
+    def __init__(self, args):
+        self.args = args
+        if args.run_state:
+            self.run_index = RunStateIndex(args.run_state, args.run_index)
+        else:
+            self.run_index = RunIndex(args.run_index)
+        self.script_index = ScriptIndex(args.script_index)
+        self.job_limit = JobLimit(args.job_limit)
+        self.cpus, self.mem = get_node_capacity(args.cpus, args.mem)
+        self.hostname = socket.gethostname()
+
+        self.jobs = dict()              # {name: Job} The waiting and running jobs
+        self.dependents = dict()        # {name: set of names of the waiting jobs depending on it}
+        self.ready = OrderedDict()      # {name: Job} Waiting jobs with no active dependencies, in order of submission
+        self.external_blocked = dict()  # {name: Job} Waiting jobs held only by jobs not managed by the daemon
+        self.running = dict()           # {name: Job}
+        self.running_low = 0            # Number of running low level jobs, for job_limit
+        self.used_slots = 0             # Slots and memory of the jobs running in the daemon
+        self.used_mem = 0
+        self.index_lines = dict()       # Lines to update in run_index, see RunIndex.update()
+        self.idle_since = time.time()
+
+    # -------------------------------------------------------------------
+    # Logging
+
+    def log(self, message):
+        sys.stdout.write("{date}\t{message}\n".format(date=time.strftime("%d/%m/%Y %H:%M:%S"), message=message))
+        sys.stdout.flush()
+
+    def write_log_line(self, job, event, status, exit_code=None):
+        """ Writes a line for the queued job to the workflow log file, in the format of log_echo in CC.helper_funcs.sh,
+            or, with --event_log, appends the event to the event log (see event_log.py)
+        """
+        duration = None
+        if event == "Started":
+            job.started = time.time()
+        elif job.started is not None:
+            duration = time.time() - job.started
+        record = event_log.make_event(event, job.module, job.instance, job.name, "Queue", self.hostname,
+                                      str(job.queue_pid),
+                                      status=status,
+                                      exit_code=exit_code,
+                                      duration=duration)
+        if self.args.event_log:
+            event_log.append_event(self.args.event_log, record)
+            return
+        with open(self.args.log_file + ".lock", "a") as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            with open(self.args.log_file, "a") as log_fh:
+                log_fh.write(event_log.format_log_line(record) + "\n")
+
+    def write_job_output(self, job, text):
+        try:
+            with open(job.stdout, "a") as stdout_fh:
+                stdout_fh.write(text)
+        except OSError:
+            pass
+
+    # -------------------------------------------------------------------
+    # Job state
+
+    def is_active(self, name):
+        """ Returns True if job name is waiting or running, in the daemon or, for other jobs, in run_index
+            (including the changes to run_index not written yet)
+        """
+        if name in self.jobs:
+            return True
+        if name in self.index_lines:
+            return not self.index_lines[name][0].startswith("#")
+        return name in self.run_index.get_active()
+
+    def submit(self, request):
+        """ Registers a job. Returns an error message, or None if the job was registered.
+        """
+        name = request["job"]
+        if name in self.jobs:
+            return "Job {name} is already {state}".format(name=name,
+                                                          state="running" if name in self.running else "waiting")
+        try:
+            script_path = self.script_index.get_script(name)
+        except OSError as err:
+            return "Can't read script index: {err}".format(err=err)
+        if not script_path:
+            return "Job {name} not found in script index {index}".format(name=name, index=self.args.script_index)
+        try:
+            hold_jids, slots, mem = read_script_header(script_path)
+        except OSError as err:
+            return "Can't read script {path}: {err}".format(path=script_path, err=err)
+
+        job = Job(name, script_path, hold_jids, slots, mem, request)
+        # The output files are created (and emptied) now, as when redirecting the output of NSF_exec.sh
+        try:
+            for path in [job.stdout, job.stderr]:
+                open(path, "w").close()
+        except OSError as err:
+            return "Can't create job output file: {err}".format(err=err)
+        self.write_job_output(job, "Running job:  {name}\nRunning script:  {path}\n".format(name=name,
+                                                                                          path=script_path))
+        # Jobs requesting more than the node has would never start. They are started when the node is idle instead:
+        if job.slots > self.cpus:
+            self.write_job_output(job, "The job requests {slots} CPUs, but only {cpus} are available. Waiting for all "
+                                       "of them to be free.\n".format(slots=job.slots, cpus=self.cpus))
+            job.slots = self.cpus
+        if self.mem and job.mem > self.mem:
+            self.write_job_output(job, "The job requests {req}MB memory, but only {mem}MB are available. Waiting for "
+                                       "all of it to be free.\n".format(req=job.mem, mem=self.mem))
+            job.mem = self.mem
+        self.write_log_line(job, "Started", "OK")
+
+        if self.killall_requested():
+            self.kill_job(job, "{path}.killall file exists. Not running job.\n".format(path=self.args.run_index))
+            return None
+
+        self.jobs[name] = job
+        self.index_lines[name] = ("{name}\thold".format(name=name), False)
+        # The job now holds the jobs depending on it:
+        for dependent in self.dependents.get(name, ()):
+            dependent_job = self.jobs[dependent]
+            dependent_job.blockers.add(name)
+            self.ready.pop(dependent, None)
+            self.external_blocked.pop(dependent, None)
+        for hold_jid in job.hold_jids:
+            self.dependents.setdefault(hold_jid, set()).add(name)
+            if hold_jid in self.jobs:
+                job.blockers.add(hold_jid)
+        if not job.blockers:
+            self.check_external(job)
+        self.log("Queued {name}".format(name=name))
+        return None
+
+    def check_external(self, job):
+        """ Called when the jobs managed by the daemon no longer hold job. Moves it to the ready queue, unless it is
+            held by jobs not managed by the daemon (i.e. active in run_index).
+        """
+        if any(self.is_active(hold_jid) for hold_jid in job.hold_jids):
+            self.external_blocked[job.name] = job
+        else:
+            self.external_blocked.pop(job.name, None)
+            self.ready[job.name] = job
+
+    def get_used_resources(self):
+        """ Returns the slots and memory used by the running jobs: The jobs running in the daemon, and the other jobs
+            marked as running in run_index
+        """
+        used_slots, used_mem = self.used_slots, self.used_mem
+        for name, (slots, mem) in self.run_index.get_resources().items():
+            if name not in self.jobs and name not in self.index_lines:
+                used_slots += slots
+                used_mem += mem
+        return used_slots, used_mem
+
+    def start_ready_jobs(self):
+        """ Starts the ready jobs, in order of submission, as long as job_limit and the free resources allow.
+            Jobs that don't fit are skipped, so that smaller jobs submitted later may start.
+        """
+        if not self.ready:
+            return
+        limit = self.job_limit.get_limit()
+        used_slots, used_mem = self.get_used_resources()
+        for name in list(self.ready):
+            job = self.ready[name]
+            if limit is not None and job.low_level and self.running_low >= limit:
+                continue
+            if used_slots + job.slots > self.cpus or (self.mem and used_mem + job.mem > self.mem):
+                continue
+            del self.ready[name]
+            self.start_job(job)
+            if job.proc is not None:
+                used_slots += job.slots
+                used_mem += job.mem
+
+    def start_job(self, job):
+        shell = "csh" if "csh" in job.script_path else "bash"
+        try:
+            with open(job.stdout, "a") as stdout_fh, open(job.stderr, "a") as stderr_fh:
+                job.proc = subprocess.Popen([shell, job.script_path],
+                                            stdin=subprocess.DEVNULL,
+                                            stdout=stdout_fh,
+                                            stderr=stderr_fh,
+                                            cwd=job.cwd if job.cwd and os.path.isdir(job.cwd) else None,
+                                            env=job.env,
+                                            start_new_session=True)
+        except OSError as err:
+            self.log("Failed starting {name}: {err}".format(name=job.name, err=err))
+            self.write_job_output(job, "Failed starting script: {err}\n".format(err=err))
+            self.index_lines[job.name] = ("# {name}\tERROR".format(name=job.name), False)
+            self.finish_job(job)
+            return
+        self.running[job.name] = job
+        if job.low_level:
+            self.running_low += 1
+        self.used_slots += job.slots
+        self.used_mem += job.mem
+        self.index_lines[job.name] = ("{name}\tPID\t{pid}\t{slots}\t{mem}".format(name=job.name,
+                                                                                   pid=job.proc.pid,
+                                                                                   slots=job.slots,
+                                                                                   mem=job.mem), False)
+        self.log("Started {name} (pid {pid})".format(name=job.name, pid=job.proc.pid))
+
+    def reap_jobs(self):
+        """ Called on SIGCHLD. Handles the jobs that exited.
+        """
+        for job in list(self.running.values()):
+            returncode = job.proc.poll()
+            if returncode is None:
+                continue
+            del self.running[job.name]
+            if job.low_level:
+                self.running_low -= 1
+            self.used_slots -= job.slots
+            self.used_mem -= job.mem
+            self.log("Finished {name} (exit status {code})".format(name=job.name, code=returncode))
+            # Scripts mark themselves as done in run_index. Marking scripts that didn't (e.g. killed with SIGKILL):
+            state = "done" if returncode == 0 else ("TERMINATED" if returncode < 0 else "ERROR")
+            self.index_lines[job.name] = ("# {name}\t{state}".format(name=job.name, state=state), True)
+            self.finish_job(job)
+
+    def finish_job(self, job):
+        """ Removes a job that is no longer active, and releases the jobs waiting for it
+        """
+        del self.jobs[job.name]
+        for hold_jid in job.hold_jids:
+            dependents = self.dependents.get(hold_jid)
+            if dependents is not None:
+                dependents.discard(job.name)
+                if not dependents:
+                    del self.dependents[hold_jid]
+        for dependent in self.dependents.get(job.name, ()):
+            dependent_job = self.jobs[dependent]
+            dependent_job.blockers.discard(job.name)
+            if not dependent_job.blockers and dependent_job.proc is None:
+                self.check_external(dependent_job)
+
+    def kill_job(self, job, message):
+        """ Kills a waiting job, as NSF_exec.sh does when run_index.killall exists
+        """
+        self.write_job_output(job, message)
+        # NSF_exec.sh kills itself with SIGTERM:
+        self.write_log_line(job, "Finished", "TERMINATED", event_log.SIGNAL_EXIT_CODES["TERM"])
+        self.index_lines[job.name] = ("# {name}\tkilled".format(name=job.name), False)
+        self.log("Killed {name}".format(name=job.name))
+
+    def cancel(self, prefix, message):
+        """ Kills the waiting jobs whose name starts with prefix. Returns the number of jobs killed.
+        """
+        waiting = [job for job in self.jobs.values() if job.proc is None and job.name.startswith(prefix)]
+        for job in waiting:
+            self.ready.pop(job.name, None)
+            self.external_blocked.pop(job.name, None)
+            self.kill_job(job, message)
+        for job in waiting:
+            self.finish_job(job)
+        self.flush_index()
+        return len(waiting)
+
+    def killall_requested(self):
+        return os.path.exists(self.args.run_index + ".killall")
+
+    def flush_index(self):
+        """ Writes the pending run_index changes
+        """
+        if self.index_lines:
+            lines, self.index_lines = self.index_lines, dict()
+            self.run_index.update(lines)
+
+    # -------------------------------------------------------------------
+    # Requests
+
+    def handle_request(self, request):
+        command = request.get("command")
+        if command == "submit":
+            error = self.submit(request)
+            return {"ok": error is None, "error": error}
+        if command == "cancel":
+            count = self.cancel(request["prefix"],
+                                "Job killed by the kill script. Stopping waiting job.\n")
+            return {"ok": True, "message": "Killed {count} waiting jobs".format(count=count)}
+        if command == "status":
+            lines = ["{state}\t{name}".format(state="running" if job.proc else "waiting", name=name)
+                     for name, job in self.jobs.items()]
+            used_slots, used_mem = self.get_used_resources()
+            lines.append("CPUs used: {used}/{cpus}. Memory used: {used_mem}/{mem} MB".
+                         format(used=used_slots, cpus=self.cpus, used_mem=used_mem, mem=self.mem or "-"))
+            return {"ok": True, "message": "\n".join(lines) if self.jobs else "No jobs"}
+        return {"ok": False, "error": "Unknown command {command}".format(command=command)}
+
+    def serve_connection(self, conn):
+        conn.settimeout(10)
+        try:
+            request = json.loads(receive_line(conn))
+            response = self.handle_request(request)
+        except Exception as err:
+            response = {"ok": False, "error": "Bad request: {err}".format(err=err)}
+        try:
+            conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+        conn.close()
+
+    # -------------------------------------------------------------------
+    # Main loop
+
+    def housekeeping(self):
+        """ Handles changes made by others: The killall file, deletion of run_index and changes in run_index
+        """
+        waiting = [job for job in self.jobs.values() if job.proc is None]
+        if waiting and self.killall_requested():
+            self.cancel("", "{path}.killall file created. Stopping all waiting jobs. \n"
+                            "Make sure you delete the file before re-running!\n".format(path=self.args.run_index))
+        elif waiting and not self.run_index.exists():
+            self.cancel("", "{path} file deleted. Stopping all waiting jobs\n".format(path=self.args.run_index))
+        elif self.external_blocked and self.run_index.changed():
+            for job in list(self.external_blocked.values()):
+                self.check_external(job)
+
+    def run(self, listener):
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ, "listener")
+
+        # Exiting jobs are signalled through a pipe, so that the main loop wakes up on SIGCHLD
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        selector.register(wakeup_read, selectors.EVENT_READ, "wakeup")
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            while True:
+                timeout = HOUSEKEEPING_INTERVAL if self.jobs else IDLE_TIMEOUT
+                for key, mask in selector.select(timeout):
+                    if key.data == "listener":
+                        try:
+                            conn, address = listener.accept()
+                        except OSError:
+                            continue
+                        self.serve_connection(conn)
+                    else:
+                        try:
+                            while os.read(wakeup_read, 1024):
+                                pass
+                        except OSError:
+                            pass
+                # Jobs may exit without the signal being caught, e.g. while being started. Checking on every pass:
+                self.reap_jobs()
+                self.housekeeping()
+                self.start_ready_jobs()
+                self.flush_index()
+                if self.jobs:
+                    self.idle_since = time.time()
+                elif time.time() - self.idle_since >= IDLE_TIMEOUT:
+                    self.log("No jobs for {sec} seconds. Exiting".format(sec=IDLE_TIMEOUT))
+                    break
+        finally:
+            # Jobs still waiting are killed. Running jobs are not affected.
+            if any(job.proc is None for job in self.jobs.values()):
+                self.cancel("", "Scheduler stopped. Stopping waiting job.\n")
+            self.flush_index()
+            if self.args.run_state and self.run_index.exists():
+                self.run_index.export()
+
+
+# -------------------------------------------------------------------
+# Client side
+
+
+def receive_line(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode("utf-8")
+
+
+def connect(socket_path):
+    """ Returns a socket connected to the daemon, or None if it is not running.
+        Connecting through the socket's directory, since socket paths are limited to about 100 characters.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    cwd = os.open(".", os.O_RDONLY)
+    try:
+        os.chdir(os.path.dirname(socket_path) or ".")
+        conn.connect(os.path.basename(socket_path))
+    except OSError:
+        conn.close()
+        return None
+    finally:
+        os.fchdir(cwd)
+        os.close(cwd)
+    return conn
+
+
+def send_request(socket_path, request):
+    """ Sends a request to the daemon and returns the response, or None if the daemon is not running
+    """
+    conn = connect(socket_path)
+    if conn is None:
+        return None
+    try:
+        conn.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        response = receive_line(conn)
+    except OSError:
+        return None
+    finally:
+        conn.close()
+    # An empty response means the daemon exited before handling the request
+    return json.loads(response) if response else None
+
+
+def start_daemon(args):
+    """ Starts the daemon in a session of its own, with the options of this client
+    """
+    daemon_args = [sys.executable, os.path.realpath(__file__),
+                   "--socket", args.socket,
+                   "--run_index", args.run_index,
+                   "--script_index", args.script_index,
+                   "--log_file", args.log_file]
+    if args.event_log:
+        daemon_args += ["--event_log", args.event_log]
+    if args.job_limit:
+        daemon_args += ["--job_limit", args.job_limit]
+    if args.run_state:
+        daemon_args += ["--run_state", args.run_state]
+    if args.cpus:
+        daemon_args += ["--cpus", str(args.cpus)]
+    if args.mem:
+        daemon_args += ["--mem", str(args.mem)]
+    with open(os.path.splitext(args.socket)[0] + ".log", "a") as daemon_log:
+        subprocess.Popen(daemon_args + ["daemon"],
+                         stdin=subprocess.DEVNULL,
+                         stdout=daemon_log,
+                         stderr=daemon_log,
+                         cwd="/",
+                         start_new_session=True)
+
+
+def submit(args):
+    request = {"command": "submit",
+               "job": args.job,
+               "stdout": os.path.abspath(args.stdout),
+               "stderr": os.path.abspath(args.stderr),
+               "cwd": os.getcwd(),
+               "env": dict(os.environ),
+               "pid": os.getpid()}
+    response = send_request(args.socket, request)
+    deadline = time.time() + CONNECT_TIMEOUT
+    last_start = 0
+    while response is None and time.time() < deadline:
+        # Starting the daemon again every few seconds, in case the new daemon found an exiting one still holding
+        # the lock (see run_daemon())
+        if time.time() - last_start > 2:
+            start_daemon(args)
+            last_start = time.time()
+        time.sleep(0.1)
+        response = send_request(args.socket, request)
+    if response is None:
+        sys.exit("Failed submitting {job}: The scheduler daemon did not start. See {log}".
+                 format(job=args.job, log=os.path.splitext(args.socket)[0] + ".log"))
+    if not response["ok"]:
+        sys.exit("Failed submitting {job}: {error}".format(job=args.job, error=response["error"]))
+
+
+def run_daemon(args):
+    # Only one daemon per socket. Exiting if another daemon holds the lock:
+    lock_fh = open(args.socket + ".lock", "a")
+    try:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return
+        raise
+    os.chdir(os.path.dirname(args.socket) or ".")
+    socket_name = os.path.basename(args.socket)
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_name)
+    listener.listen(128)
+    scheduler = Scheduler(args)
+    scheduler.log("Scheduler started (pid {pid})".format(pid=os.getpid()))
+    try:
+        scheduler.run(listener)
+    finally:
+        listener.close()
+        if os.path.exists(socket_name):
+            os.remove(socket_name)
+        lock_fh.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scheduler daemon for NeatSeq-Flow's Local executor")
+    parser.add_argument("--socket", required=True, help="The daemon's socket")
+    parser.add_argument("--run_index", required=True, help="The run_index file")
+    parser.add_argument("--script_index", required=True, help="The script_index file")
+    parser.add_argument("--log_file", required=True, help="The workflow log file")
+    parser.add_argument("--event_log", help="The event log, if the events are written to it instead of the log file")
+    parser.add_argument("--job_limit", help="The job_limit file")
+    parser.add_argument("--run_state", help="The run state database, if used instead of run_index")
+    parser.add_argument("--cpus", type=int, help="The number of CPUs of the node (default: detected)")
+    parser.add_argument("--mem", type=int, help="The memory of the node, in MB (default: detected)")
+    commands = parser.add_subparsers(dest="command")
+    submit_parser = commands.add_parser("submit", help="Submit a job")
+    submit_parser.add_argument("job", help="The job name")
+    submit_parser.add_argument("stdout", help="The job's stdout file")
+    submit_parser.add_argument("stderr", help="The job's stderr file")
+    cancel_parser = commands.add_parser("cancel", help="Kill the waiting jobs whose name starts with prefix")
+    cancel_parser.add_argument("prefix", help="The job name prefix")
+    commands.add_parser("status", help="List the waiting and running jobs")
+    commands.add_parser("daemon", help="Run the daemon")
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        submit(args)
+    elif args.command == "daemon":
+        run_daemon(args)
+    elif args.command in ("cancel", "status"):
+        request = {"command": args.command}
+        if args.command == "cancel":
+            request["prefix"] = args.prefix
+        response = send_request(args.socket, request)
+        if response is None:
+            print("The scheduler daemon is not running")
+        elif not response["ok"]:
+            sys.exit(response["error"])
+        else:
+            print(response["message"])
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
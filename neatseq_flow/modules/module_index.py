@@ -0,0 +1,194 @@
+""" An index of the step modules available in the module paths
+
+Finding a module used to require walking all module paths for every step instance, which is slow on network file
+systems. The ModuleIndex walks each path once and stores the .py files found, by directory. The index can be saved
+to a JSON file and reused by later runs, as long as the modification times of the indexed directories have not
+changed (adding, removing or renaming a file or sub-directory changes the modification time of its directory).
+The results of reading the files for --list_modules are kept with the modification time and size of each file, since
+editing a file does not change the modification time of its directory.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import re
+import json
+
+
+# Change this when the structure of the saved index changes:
+INDEX_FORMAT = 2
+
+
+class ModuleIndex(object):
+    """ Maps module names to import names and file locations, for the user module paths and the bundled modules
+    """
+
+    def __init__(self, module_paths, bundled_path, cache_file=None):
+        """
+        :param module_paths: List of user-defined module paths (module_path in the Global parameters), in search order.
+        :param bundled_path: The directory containing the neatseq_flow package. Searched after the user paths.
+        :param cache_file: Optional file to load the index from and save it to.
+        """
+        self.cache_file = cache_file
+        self.dirty = False
+
+        # Normalizing the user paths and checking they exist:
+        self.module_paths = list()
+        for module_path_raw in module_paths:
+            # Remove trainling '/' from dir name. For some reason that botches things up!
+            module_path = module_path_raw.rstrip(os.sep)
+            # Expanding '~' and returning full path
+            module_path = os.path.realpath(os.path.expanduser(module_path))
+            # Check the dir exists:
+            if not os.path.isdir(module_path):
+                sys.stderr.write("WARNING: Path %s from module_path does not exist. Skipping...\n" % module_path)
+                continue
+            if module_path not in self.module_paths:
+                self.module_paths.append(module_path)
+        self.bundled_path = bundled_path
+
+        self.index = self.load_cache()
+        for path in self.module_paths + [self.bundled_path]:
+            if not self.is_current(path):
+                self.index[path] = self.walk_path(path)
+                self.dirty = True
+
+        self.modules = self.make_module_dict()
+
+    def load_cache(self):
+        """ Returns the saved index, or an empty one if it does not exist or is unreadable.
+        """
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return dict()
+        try:
+            with open(self.cache_file, "r") as cache_fh:
+                cached = json.load(cache_fh)
+        except (IOError, OSError, ValueError):
+            return dict()
+        if not isinstance(cached, dict) or cached.get("format") != INDEX_FORMAT:
+            return dict()
+        return cached.get("paths", dict())
+
+    def save(self):
+        """ Writes the index to the cache file, if it has changed and the file's directory exists.
+        """
+        if not self.dirty or not self.cache_file or not os.path.isdir(os.path.dirname(self.cache_file)):
+            return
+        paths = {path: self.index[path] for path in self.module_paths + [self.bundled_path]}
+        temp_file = "{file}.{pid}".format(file=self.cache_file, pid=os.getpid())
+        try:
+            with open(temp_file, "w") as cache_fh:
+                json.dump({"format": INDEX_FORMAT, "paths": paths}, cache_fh)
+            # Replacing in one step, so that concurrent runs never read a partial file
+            os.replace(temp_file, self.cache_file)
+        except (IOError, OSError) as err:
+            sys.stderr.write("WARNING: Unable to save module index to %s (%s)\n" % (self.cache_file, err))
+        else:
+            self.dirty = False
+
+    def is_current(self, path):
+        """ Checks that the saved entry for path exists and that none of its directories has changed since it was
+            indexed.
+        """
+        if path not in self.index:
+            return False
+        try:
+            for directory, mtime in self.index[path]["dirs"].items():
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return False
+        except (OSError, KeyError, TypeError, AttributeError):
+            return False
+        return True
+
+    @staticmethod
+    def walk_path(path):
+        """ Walks path and returns its index entry.
+
+        The entry contains the modification times of all directories in path, and a list of the .py files in them,
+        in os.walk order, each as [directory, module name, whether the directory contains an __init__.py].
+        """
+
+        def walkerr(err):
+            """ Helper function for os.walk below. Catches errors during walking and reports on them.
+            """
+            print("WARNING: Error while searching for modules:")
+            print(err)
+
+        entry = {"dirs": dict(), "files": list(), "step_classes": dict()}
+        for dir_path, dir_names, file_names in os.walk(path, onerror=walkerr):
+            # Not descending into python's bytecode caches:
+            dir_names[:] = [dir_name for dir_name in dir_names if dir_name != "__pycache__"]
+            entry["dirs"][dir_path] = os.stat(dir_path).st_mtime_ns
+            has_init = "__init__.py" in file_names
+            for file_name in file_names:
+                if file_name.endswith(".py"):
+                    entry["files"].append([dir_path, file_name[:-len(".py")], has_init])
+        if not entry["dirs"]:
+            sys.stderr.write("WARNING: Module path {mod_path} seems to be empty! Possibly issue with "
+                             "permissions...\n".format(mod_path=path))
+        return entry
+
+    def make_module_dict(self):
+        """ Creates a dict of {module name: (import name, module file)}, keeping the first module found for each name.
+
+        In user paths, only files in directories containing an __init__.py are used, to avoid finding modules in
+        non-active directories.
+        """
+        modules = dict()
+        for path in self.module_paths:
+            for dir_path, module, has_init in self.index[path]["files"]:
+                if has_init and module not in modules:
+                    import_name = (dir_path.split(path)[1].partition(os.sep)[2].replace(os.sep, ".") +
+                                   "." + module).lstrip(".")
+                    modules[module] = (import_name, dir_path + os.sep + module + ".py")
+        for dir_path, module, has_init in self.index[self.bundled_path]["files"]:
+            if module not in modules:
+                # Adding 'neatseq_flow' at begginning of module location.
+                import_name = "neatseq_flow." + \
+                              dir_path.split(self.bundled_path)[1].partition(os.sep)[2].replace(os.sep, ".") + \
+                              "." + module
+                modules[module] = (import_name, dir_path + os.sep + module + ".py")
+        return modules
+
+    def find_module(self, module):
+        """ Returns a tuple (import name, module file, module path) for module, or None if it is not indexed.
+            module path is the user module path containing the module, or None for bundled modules.
+        """
+        if module not in self.modules:
+            return None
+        import_name, module_file = self.modules[module]
+        for path in self.module_paths:
+            if module_file.startswith(path + os.sep):
+                return import_name, module_file, path
+        return import_name, module_file, None
+
+    def list_modules(self):
+        """ Returns a dict of {module name: [directory names]} for the files defining a 'Step_' class of the same name.
+            Used by --list_modules. The files are read again only if their modification time or size has changed
+            since they were last listed.
+        """
+        module_list = dict()
+        for path in self.module_paths + [self.bundled_path]:
+            # {module file: [modification time, size, whether it defines the Step_ class]}
+            step_classes = self.index[path].setdefault("step_classes", dict())
+            for dir_path, module, has_init in self.index[path]["files"]:
+                module_file = dir_path + os.sep + module + ".py"
+                try:
+                    stat = os.stat(module_file)
+                    file_key = [stat.st_mtime_ns, stat.st_size]
+                except OSError:
+                    file_key = [None, None]
+                if step_classes.get(module_file, [None])[:2] != file_key:
+                    try:
+                        with open(module_file, "r") as pyt_fh:
+                            has_step = bool(re.search("class Step_%s" % module, pyt_fh.read()))
+                    except (IOError, OSError, UnicodeDecodeError):
+                        has_step = False
+                    step_classes[module_file] = file_key + [has_step]
+                    self.dirty = True
+                if step_classes[module_file][2]:
+                    module_list.setdefault(module, list()).append(dir_path.split(os.sep)[-1])
+        return module_list
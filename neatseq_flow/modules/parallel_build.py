@@ -0,0 +1,251 @@
+""" Building the step scripts in parallel, one DAG level at a time
+
+The steps of a level depend only on steps of previous levels, so they can be built concurrently. Each level is
+built in a pool of forked processes. The workers inherit the state of the workflow, build their step, and return
+the step's new state, which is merged back into the step object in the main process.
+
+To keep the output identical to a serial build:
+
+* Writes to files shared by all steps (the indices, the main kill script) are deferred in the workers and done by the
+  main process in the serial step order. See Step.write_deferred().
+* The workers' stdout and stderr are captured and printed in the serial step order as well.
+* A step that fails in a worker is rebuilt serially, so that errors are reported as they always were.
+
+Parallel building requires the 'fork' start method, i.e. it is not available on Windows.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import io
+import os
+import sys
+import pickle
+
+from .sample_data_layer import SampleDataLayer
+
+
+# The workflow being built. Set before forking the workers, which inherit it.
+_WORKFLOW = None
+
+
+class SharedObjectPickler(pickle.Pickler):
+    """ Pickles references to objects shared with the main process by id, instead of by value.
+        The workers are forked, so the ids of objects that existed before forking are the same in both processes.
+    """
+
+    def __init__(self, file, shared):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+
+    def persistent_id(self, obj):
+        if isinstance(obj, io.IOBase):
+            # Script file handles can't be pickled. Making sure their content is written:
+            if not obj.closed:
+                obj.flush()
+            return "closed_file"
+        if id(obj) in self.shared:
+            return id(obj)
+        return None
+
+
+class SharedObjectUnpickler(pickle.Unpickler):
+    """ Resolves the references pickled by SharedObjectPickler
+    """
+
+    def __init__(self, file, shared):
+        pickle.Unpickler.__init__(self, file)
+        self.shared = shared
+
+    def persistent_load(self, pid):
+        if pid == "closed_file":
+            closed_file = open(os.devnull, "w")
+            closed_file.close()
+            return closed_file
+        return self.shared[pid]
+
+
+def register_shared(obj, shared):
+    """ Adds obj, and the sample_data containers reachable from it, to the shared objects dict ({id: object})
+    """
+    objects_to_add = [obj]
+    while objects_to_add:
+        obj = objects_to_add.pop()
+        if id(obj) in shared:
+            continue
+        if isinstance(obj, SampleDataLayer):
+            objects_to_add.extend(obj._parents)
+            objects_to_add.extend(obj._local.values())
+        elif isinstance(obj, dict):
+            objects_to_add.extend(obj.values())
+        elif not isinstance(obj, list):
+            continue
+        shared[id(obj)] = obj
+
+
+def get_step_levels(step_list):
+    """ Groups the steps by level: Steps without bases are in level 0. Other steps are one level above their highest
+        base. step_list must be sorted so that each step comes after its bases.
+
+    :return: List of lists of step indices in step_list, in step_list order.
+    """
+    step_index = {step_n.get_step_name(): ind for ind, step_n in enumerate(step_list)}
+    step_level = list()
+    levels = list()
+    for ind, step_n in enumerate(step_list):
+        base_name_list = step_n.get_base_step_name()
+        level = 1 + max(step_level[step_index[base_name]] for base_name in base_name_list) \
+            if base_name_list \
+            else 0
+        step_level.append(level)
+        if level == len(levels):
+            levels.append(list())
+        levels[level].append(ind)
+    return levels
+
+
+def flush_step_files(step_n):
+    """ Writes the buffered content of the script files opened for step_n, so that a forked worker does not inherit
+        (and write again) content already written in the main process.
+    """
+    for value in list(vars(step_n).values()):
+        if hasattr(value, "__dict__"):
+            for attr in list(vars(value).values()):
+                if isinstance(attr, io.IOBase) and not attr.closed:
+                    attr.flush()
+
+
+def build_step_in_worker(ind):
+    """ Builds step ind of the workflow in a worker process.
+
+    :return: A tuple: (ind, pickled state of the step or None if building failed, the profiler events recorded in the
+             worker, captured stdout, captured stderr)
+    """
+    step_n = _WORKFLOW.step_list[ind]
+    # The profiler is inherited from the main process. Returning only the events of this step:
+    events = getattr(_WORKFLOW.profiler, "events", list())
+    first_event = len(events)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+    step_n.deferred_writes = list()
+    try:
+        _WORKFLOW.make_step_scripts(step_n)
+        state = io.BytesIO()
+        SharedObjectPickler(state, _WORKFLOW.shared_objects).dump(vars(step_n))
+        state = state.getvalue()
+    except BaseException:
+        # The step will be rebuilt in the main process, which will report the problem
+        state = None
+    finally:
+        output = (sys.stdout.getvalue(), sys.stderr.getvalue())
+        sys.stdout, sys.stderr = stdout, stderr
+    return (ind, state, events[first_event:]) + output
+
+
+def build_scripts_parallel(workflow, processes):
+    """ Builds the scripts of workflow's steps, building the steps of each level in parallel.
+
+    :param workflow: The NeatSeqFlow object. Must define step_list, build_step(), make_step_scripts(),
+                     restore_step(), write_step_output(), print_step_name(), sample_data, pipe_data, index_writer
+                     and profiler.
+    :param processes: Number of processes to use
+    """
+    global _WORKFLOW
+
+    # Imported here, so that serial builds don't pay for importing multiprocessing
+    import multiprocessing
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        sys.stderr.write("WARNING: Parallel building is not supported on this platform. Building serially.\n")
+        context = None
+
+    built = dict()      # The output of steps built in the workers, by index, until it is written
+    failed = list()     # Indices of steps to rebuild in the main process
+    next_ind = 0        # Index of the next step to output, in serial order
+
+    workflow.shared_objects = dict()
+    register_shared(workflow.sample_data, workflow.shared_objects)
+    register_shared(workflow.pipe_data, workflow.shared_objects)
+    workflow.shared_objects[id(workflow.index_writer)] = workflow.index_writer
+    workflow.shared_objects[id(workflow.profiler)] = workflow.profiler
+    for step_n in workflow.step_list:
+        workflow.shared_objects[id(step_n)] = step_n
+    _WORKFLOW = workflow
+    try:
+        for level in (get_step_levels(workflow.step_list) if context else []):
+            if level == [next_ind]:
+                # A single step, next in order: Nothing to gain from a worker
+                step_n = workflow.step_list[next_ind]
+                workflow.print_step_name(step_n)
+                workflow.build_step(step_n)
+                register_shared(step_n.sample_data, workflow.shared_objects)
+                next_ind += 1
+                continue
+            # Steps that have not changed since the previous run are restored instead of built:
+            for ind in list(level):
+                if workflow.restore_step(workflow.step_list[ind]):
+                    register_shared(workflow.step_list[ind].sample_data, workflow.shared_objects)
+                    built[ind] = ("", "")
+                    level.remove(ind)
+            for ind in level:
+                flush_step_files(workflow.step_list[ind])
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            results = list()
+            if level:
+                pool = context.Pool(min(processes, len(level)))
+                try:
+                    results = pool.map(build_step_in_worker, level, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            for ind, state, events, stdout, stderr in results:
+                if hasattr(workflow.profiler, "events"):
+                    workflow.profiler.events.extend(events)
+                if state is None:
+                    failed.append(ind)
+                    continue
+                step_n = workflow.step_list[ind]
+                state = SharedObjectUnpickler(io.BytesIO(state), workflow.shared_objects).load()
+                # Updating params in place, because the same dict is referenced by param_data:
+                step_n.params.clear()
+                step_n.params.update(state.pop("params"))
+                vars(step_n).update(state)
+                register_shared(step_n.sample_data, workflow.shared_objects)
+                built[ind] = (stdout, stderr)
+
+            # Writing the output of the steps built so far, in serial order:
+            while next_ind in built:
+                write_step_output(workflow, workflow.step_list[next_ind], *built.pop(next_ind))
+                next_ind += 1
+
+            if failed:
+                break
+    finally:
+        _WORKFLOW = None
+        workflow.shared_objects = None
+
+    # Finishing serially: Writing the output of the steps already built and building the others
+    for ind in range(next_ind, len(workflow.step_list)):
+        step_n = workflow.step_list[ind]
+        if ind in built:
+            write_step_output(workflow, step_n, *built.pop(ind))
+            continue
+        if ind in failed:
+            # The worker has written some of the step's scripts. Starting over with new script files:
+            step_n.finalize_contruction()
+        workflow.print_step_name(step_n)
+        workflow.build_step(step_n)
+
+
+def write_step_output(workflow, step_n, stdout, stderr):
+    """ Writes the output of a step built in a worker: The messages it printed and its deferred writes.
+    """
+    workflow.print_step_name(step_n)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    workflow.write_step_output(step_n)
@@ -0,0 +1,116 @@
+""" Caching parsed parameter files
+
+Parsing a large parameter file (loading the YAML and interpolating the variables) takes time, and the same files are
+often parsed again and again, e.g. when the workflow is generated repeatedly while it is being edited. With a cache,
+the parsed and interpolated parameter structure is saved to disk, keyed by a hash of the content of the parameter
+files and of the parsing code. The next time the same files are parsed, the structure is loaded from the cache.
+
+Only the structure read from the files is cached. The checks and conversions that depend on the environment (e.g.
+testing that the module paths exist and reading the conda environment variables) are done on every run.
+
+The cache directory is passed with --param_cache. By default, it is $NSF_CACHE_DIR, or neatseq_flow in the user's
+cache directory ($XDG_CACHE_HOME or ~/.cache). Only the most recent MAX_ENTRIES parsed files are kept.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import pickle
+import hashlib
+import tempfile
+
+import yaml
+
+from .step_cache import hash_files
+
+
+# Change this when the structure of the cached records changes:
+CACHE_FORMAT = 1
+# Maximal number of cached parameter files:
+MAX_ENTRIES = 50
+
+
+def get_default_cache_dir():
+    """ Returns the default cache directory
+    """
+    if os.environ.get("NSF_CACHE_DIR"):
+        return os.environ["NSF_CACHE_DIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "neatseq_flow")
+
+
+class ParamCache(object):
+    """ An on-disk cache of parsed parameter files
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: The cache directory. Parsed files are stored in its 'params' sub-directory.
+        """
+        self.cache_dir = os.path.join(os.path.realpath(os.path.expanduser(cache_dir or get_default_cache_dir())),
+                                      "params")
+        # The parsing code and the YAML version are part of the key, so that changing them invalidates the cache:
+        module_dir = os.path.dirname(os.path.realpath(__file__))
+        self.code_hash = hash_files([os.path.join(module_dir, "parse_param_data.py"),
+                                     os.path.join(module_dir, "var_interpol_defs.py")])
+
+    def get_key(self, text):
+        """ Returns the cache key of the text of the parameter files
+        """
+        digest = hashlib.sha256()
+        digest.update(("%s\n%s\n%s\n" % (CACHE_FORMAT, yaml.__version__, self.code_hash)).encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def load(self, key):
+        """ Returns the record cached for key, or None if there is none (or it can't be read)
+        """
+        try:
+            with open(self.get_path(key), "rb") as cache_fh:
+                record = pickle.load(cache_fh)
+        except Exception:
+            return None
+        # Marking as recently used, for pruning:
+        try:
+            os.utime(self.get_path(key), None)
+        except OSError:
+            pass
+        return record
+
+    def save(self, key, record):
+        """ Saves record for key. Failing to write the cache is not an error, since it is only a speed-up.
+        """
+        temp_path = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, mode=0o700)
+            # Writing to a temporary file and renaming, so that concurrent runs never read a partial record:
+            temp_fh, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(temp_fh, "wb") as cache_fh:
+                pickle.dump(record, cache_fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.get_path(key))
+            self.prune()
+        except Exception:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def prune(self):
+        """ Removes all but the MAX_ENTRIES most recently used records
+        """
+        entries = [os.path.join(self.cache_dir, file_name)
+                   for file_name
+                   in os.listdir(self.cache_dir)
+                   if file_name.endswith(".pkl")]
+        if len(entries) <= MAX_ENTRIES:
+            return
+        entries.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+        for path in entries[MAX_ENTRIES:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
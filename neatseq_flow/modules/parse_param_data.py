@@ -10,7 +10,8 @@ __version__ = "1.6.0"
 import os, sys, re, yaml
 from pprint import pprint as pp
 import collections
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+from copy import deepcopy
 
 ######################## From here: https://gist.github.com/pypt/94d747fe5180851196eb
 from yaml.constructor import ConstructorError
@@ -24,6 +25,11 @@ except ImportError:
 
 from neatseq_flow.modules.parse_sample_data import remove_comments, check_newlines
 
+STR_TAG = yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG
+SEQ_TAG = yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG
+MAP_TAG = yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG
+MERGE_TAG = "tag:yaml.org,2002:merge"
+
 STEP_PARAMS_SINGLE_VALUE = ['module','redirects']
 
 # The keys are the supported executors. The values - a str list of parameters that NeatSeq-Flow sets independently
@@ -43,8 +49,9 @@ EXECUTORS_Q_INFO = \
      "SLURMnew": "squeue",
      "Local"   : "-"}
 
-def parse_param_file(filename):
+def parse_param_file(filename, param_cache=None):
     """Parses a file from filename
+    param_cache: A ParamCache for caching the parsed files (see param_cache.py), or None
     """
     file_conts = []
 
@@ -62,7 +69,7 @@ def parse_param_file(filename):
     check_newlines(file_conts)
 
     try:
-        return get_param_data_YAML(file_conts)
+        return get_param_data_YAML(file_conts, param_cache)
         # pp(get_param_data_YAML(file_conts))
     # Note: For some reason, yaml returns the error line number as double the actual line number.
     # I couldn't figure out why. Therefore, dividing by 2 and extracting the problematic line manually.
@@ -93,14 +100,95 @@ def parse_param_file(filename):
         raise
 
 def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+    """ Loads YAML from stream, keeping the order of mappings (as object_pairs_hook objects) and raising a
+        ConstructorError for duplicate keys.
+    """
+    return yaml.load(stream, get_ordered_loader(Loader, object_pairs_hook))
+
+
+# Ordered loader classes, by (Loader, object_pairs_hook):
+ORDERED_LOADERS = dict()
+
+
+def get_ordered_loader(Loader=yaml.Loader, object_pairs_hook=OrderedDict):
+    """ Returns a Loader class for ordered_load(). The class is created on first call for every Loader.
+    """
+    if (Loader, object_pairs_hook) in ORDERED_LOADERS:
+        return ORDERED_LOADERS[(Loader, object_pairs_hook)]
+
     class OrderedLoader(Loader):
-        pass
+
+        def construct_document(self, node):
+            """ Constructs the document without going through construct_object() for the plain mappings, sequences
+                and strings, which make up most of a parameter file. Other nodes (numbers, booleans, tagged nodes
+                etc.) are constructed by the Loader's constructors.
+            """
+            data = self.construct_ordered(node)
+            # As done by construct_document() of the base constructor:
+            while self.state_generators:
+                state_generators = self.state_generators
+                self.state_generators = []
+                for generator in state_generators:
+                    for dummy in generator:
+                        pass
+            self.constructed_objects = {}
+            self.recursive_objects = {}
+            self.deep_construct = False
+            return data
+
+        def construct_ordered(self, node):
+            if node in self.constructed_objects:    # Aliases are constructed once
+                return self.constructed_objects[node]
+            if node.tag == STR_TAG and isinstance(node, yaml.ScalarNode):
+                return node.value
+            if node.tag == SEQ_TAG and isinstance(node, yaml.SequenceNode):
+                data = list()
+                self.constructed_objects[node] = data
+                data.extend(self.construct_ordered(child) for child in node.value)
+                return data
+            if node.tag == MAP_TAG and isinstance(node, yaml.MappingNode):
+                if node in self.recursive_objects:
+                    raise ConstructorError(None, None, "found unconstructable recursive node", node.start_mark)
+                self.recursive_objects[node] = None
+                merged_num = 0      # Number of pairs copied from mappings merged with '<<'
+                merge_keys = [key_node for key_node, value_node in node.value if key_node.tag == MERGE_TAG]
+                if merge_keys:
+                    # flatten_mapping() puts the pairs of the merged mappings before the other pairs:
+                    explicit_num = len(node.value) - len(merge_keys)
+                    self.flatten_mapping(node)
+                    merged_num = len(node.value) - explicit_num
+                keys = set()        # The keys set in the mapping itself, which must be unique
+                key_index = dict()  # {key: position in pairs}
+                pairs = list()
+                for num, (key_node, value_node) in enumerate(node.value):
+                    key = self.construct_ordered(key_node)
+                    value = self.construct_ordered(value_node)
+                    if num >= merged_num:
+                        if key in keys:
+                            raise ConstructorError("while constructing a mapping", node.start_mark,
+                                                   "found duplicate key (%s)" % key, key_node.start_mark)
+                        keys.add(key)
+                    if key in key_index:
+                        # A merged value, overridden by a later one, as in the Loader's constructors:
+                        pairs[key_index[key]] = (key, value)
+                    else:
+                        key_index[key] = len(pairs)
+                        pairs.append((key, value))
+                data = object_pairs_hook(pairs)
+                self.constructed_objects[node] = data
+                del self.recursive_objects[node]
+                return data
+            return self.construct_object(node)
+
     def construct_mapping(loader, node, deep=False, upper_key=None):
         ##########
         # Detecting duplicate keys. From: https://gist.github.com/pypt/94d747fe5180851196eb
         mapping = {}
 
         for key_node, value_node in node.value:
+            if key_node.tag == MERGE_TAG:
+                # Merge keys ('<<') are handled by flatten_mapping() below
+                continue
             # import pdb;
             # pdb.set_trace()
             key = loader.construct_object(key_node, deep=deep)
@@ -115,13 +203,16 @@ def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
         loader.flatten_mapping(node)
 
         return object_pairs_hook(loader.construct_pairs(node))
+    # Used for mappings within nodes constructed by the Loader's constructors (e.g. in a !!set):
     OrderedLoader.add_constructor(
         yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
         construct_mapping)
-    return yaml.load(stream, OrderedLoader)
+    ORDERED_LOADERS[(Loader, object_pairs_hook)] = OrderedLoader
+    return OrderedLoader
 
-def get_param_data_YAML(filelines):
+def get_param_data_YAML(filelines, param_cache=None):
     """ Parse YAML-formatted parameter files
+        param_cache: A ParamCache for caching the parsed files (see param_cache.py), or None
     """
     def convert_param_format(param_dict):  # Gets the step part of the params dict
         yamlnames = [name for name in param_dict]
@@ -200,33 +291,48 @@ def get_param_data_YAML(filelines):
     #filelines = remove_comments(filelines)
     
     # Convert all tabs to 4 spaces. Tabs do not work well with YAML!
-    filelines = [re.sub("\t","    ",line) for line in filelines]
+    filelines = [line.replace("\t","    ") for line in filelines]
     
     # Read params with pyyaml package:
     # yaml_params = yaml.load("\n".join(filelines),  Loader=yaml.SafeLoader)
     # yaml_params = yaml.safe_load("\n".join(filelines))
 
-    yaml_params = ordered_load("\n".join(filelines),Loader=Loader)
+    param_text = "\n".join(filelines)
+    # The parsed and interpolated params are cached by the content of the files (see param_cache.py):
+    cached = None
+    if param_cache is not None:
+        cache_key = param_cache.get_key(param_text)
+        cached = param_cache.load(cache_key)
+
+    if cached is not None:
+        yaml_params = cached["params"]
+        if cached["vars"] is not None:
+            # Repeating the warnings on the variables
+            from .var_interpol_defs import test_vars
+            test_vars(cached["vars"])
+    else:
+        yaml_params = ordered_load(param_text,Loader=Loader)
 
-    usr_step_order = list(yaml_params["Step_params"].keys())
-    
-    # If there is a Variables section, interpolate any appearance of the variables in the params
-    if "Vars" in list(yaml_params.keys()):
-        
-        # Prepare the bunch for variable interpolation:
-        from munch import Munch
-        from .var_interpol_defs import make_interpol_func, walk, test_vars
-        
-        test_vars(yaml_params["Vars"])
-        variables_bunch = Munch.fromDict({"Vars":yaml_params["Vars"]})
-        # print variables_bunch
-        f_interpol = make_interpol_func(variables_bunch)
+        # If there is a Variables section, interpolate any appearance of the variables in the params
+        raw_vars = None
+        if "Vars" in list(yaml_params.keys()):
+
+            # Prepare the variables lookup table for interpolation:
+            from .var_interpol_defs import make_interpol_func, walk, test_vars
+
+            test_vars(yaml_params["Vars"])
+            raw_vars = deepcopy(yaml_params["Vars"])
+            f_interpol = make_interpol_func(yaml_params["Vars"])
 
-        # Actual code to run when 'Vars' exists:
-        # Walk over params dict and interpolate strings:
+            # Actual code to run when 'Vars' exists:
+            # Walk over params dict and interpolate strings:
 
-        yaml_params = walk(node=yaml_params,variables_bunch=variables_bunch, callback= f_interpol)
+            yaml_params = walk(node=yaml_params, callback= f_interpol)
 
+        if param_cache is not None:
+            param_cache.save(cache_key, {"params": yaml_params, "vars": raw_vars})
+
+    usr_step_order = list(yaml_params["Step_params"].keys())
 
     param_data = dict()
 
@@ -301,9 +407,12 @@ def param_data_testing_step_wise(param_data):
 
     names = reduce(lambda x, y: x+y, [list(param_data[step].keys()) for step in list(param_data.keys())])
 
-    if len(set([nam for nam in names if names.count(nam) > 1])) > 0:
+    # Counting once, since names.count() for every name takes time quadratic in the number of steps
+    name_counts = Counter(names)
+    duplicate_names = set([nam for nam in names if name_counts[nam] > 1])
+    if len(duplicate_names) > 0:
         
-        issue_warning += "%s. Duplicate values for the following step names: %s.\n" % (issue_count,",".join(set([nam for nam in names if names.count(nam) > 1])))
+        issue_warning += "%s. Duplicate values for the following step names: %s.\n" % (issue_count,",".join(duplicate_names))
         issue_count += 1
         
     # If one of parameter values is a list, create warning - multiple definitions of a param
@@ -8,6 +8,8 @@ __version__ = "1.6.0"
 
 
 import os, sys
+import gzip
+import itertools
 from urllib.parse import urlparse
 
 import csv 
@@ -16,6 +18,8 @@ from io import StringIO
 from pprint import pprint as pp
 import re
 
+from .sample_list import SampleList
+
 
 
 def remove_comments(filelines):
@@ -48,23 +52,41 @@ def check_newlines(filelines):
     if lines_with_CRs:
         raise Exception("Issues in samples", "The sample and parameter files must not contain carriage returns. Convert newlines to UNIX style!\n")
 
+def open_sample_file(filename):
+    """ Opens a sample file for reading lines. Gzipped files are decompressed on the fly
+    """
+    with open(filename, "rb") as fileh:
+        magic = fileh.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(filename, "rt", encoding='utf-8')
+    return open(filename, encoding='utf-8')
+
+
+def read_sample_files(filenames):
+    """ Yields the lines of the sample files, one at a time, checking that they do not contain carriage returns
+    """
+    for filename in filenames:
+        with open_sample_file(filename) as fileh:
+            for line in fileh:
+                check_newlines((line,))
+                yield line
+
+
 def parse_sample_file(filename):
     """Parses a file from filename
+    filename may be a comma-separated list of files. The files are read as one file, in the order given.
     """
-    file_conts = []
-
-    filenames = filename.split(",")
-    for filename_raw in filenames:
+    filenames = []
+    for filename_raw in filename.split(","):
         # Expanding '~' and returning full path 
         filename = os.path.realpath(os.path.expanduser(filename_raw))
 
         if not os.path.isfile(filename):
             raise Exception("Issues in samples", "Sample file %s does not exist.\n" % filename)
-        with open(filename, encoding='utf-8') as fileh:
-            file_conts += fileh.readlines()
-                
-    check_newlines(file_conts)
-    sample_data = get_sample_data(file_conts)
+        filenames.append(filename)
+
+    # The lines are parsed as they are read, so the files are never held in memory in full.
+    sample_data = get_sample_data(read_sample_files(filenames))
     # check_sample_constancy(sample_data)  # Letting user use both zipped and unzipped files. Not recommended
     
     # pp(sample_data)
@@ -73,6 +95,7 @@ def parse_sample_file(filename):
         
 def get_sample_data(filelines):
     """return lines relevant to the sample data, if exist
+    filelines can be any iterable of lines, e.g. a list or an open file
     """
 
     # This is a stub from when we supported a different sample_data format.
@@ -103,26 +126,18 @@ def get_tabular_sample_data(filelines):
     raw_data = get_tabular_sample_data_lines(filelines)
     sample_data = dict()
 
-    if "Sample_data" in raw_data:
-        sample_names = set([fileline[0] for fileline in raw_data["Sample_data"]])
-    else:
-        sample_names = []
-    
+    # The sample lines are already grouped by sample name, in order of appearance.
+    sample_names = list(raw_data["Sample_data"].keys())
+
     # Add a list of sample names to sample_data
-    sample_data["samples"] = sorted(sample_names)  
+    sample_data["samples"] = SampleList(sorted(sample_names))
 
-    # pp(raw_data["Sample_data"])     
     for sample in sample_names:
-        # Parse lines for a single sample.
-        # Get the lines that have the sample name in first column and extract data from them
-        # with parse_tabular_sample_data()
+        # Parse lines for a single sample with parse_tabular_sample_data()
         # Note: Sample name is removed from element 0 (line[1:]) so that function
         # parse_tabular_sample_data() can be used for project wide table, too.
 
-        sample_lines = [line[1:]
-                        for line
-                        in raw_data["Sample_data"]
-                        if line[0]==sample]
+        sample_lines = raw_data["Sample_data"][sample]
         # Checking sample name does not have a space in it
         if re.search(pattern=" ", string=sample):
             raise Exception("Issues in samples", "Sample name should not contain a space! ('{sample}')".
@@ -158,19 +173,82 @@ def get_tabular_sample_data(filelines):
     
 
     return sample_data
-    
+
+
+# The first field of a line (empty if the line starts with white space), and blank lines:
+FIRST_FIELD_RE = re.compile("\S*")
+BLANK_LINE_RE = re.compile("^\s+$")
+
+
+def get_block_rows(block, head_ind_list):
+    """ Returns the rows of a table in a block of consecutive lines.
+        block is the list of lines in the block, from the first header line on, with comments and empty lines removed.
+        head_ind_list is the list of indices in block of the lines following each header.
+        The rows following each header, up to the end of the block or to a "STOP_HERE" line, are returned. Rows
+        following more than one header are returned once per header.
+    """
+    rows = []
+    for head_ind in head_ind_list:
+        lines = block[head_ind:]
+        try:
+            lines = lines[0:lines.index("STOP_HERE")]
+        except ValueError:
+            pass
+        # Read CSV data with csv package.
+        reader = csv.reader(StringIO("\n".join(lines)), dialect='excel-tab')
+        rows.extend(reader)
+    return rows
+
+
 def get_tabular_sample_data_lines(filelines):
     """ Get sample data from "Tabular" sample data lines
         Will keep one line beginning with "Title" and all consecutive lines from "#SampleID" till first blank line
         
         The reason for this is that the user should have the option of embedding the sample file in the parameter file.
         This way, all line except the title and the consecutive sample lines will be discarded
+
+        The lines are read in a single pass, so filelines can be an iterator. The sample lines are returned in
+        "Sample_data" as a dict of lists of rows, by sample name (the sample name is removed from the rows).
     """
 
     return_results = {}
-    
-    # filelines = remove_comments(filelines)
-    title_line = remove_comments([line for line in filelines if re.split("\s+", line, maxsplit=1)[0] == "Title"])
+
+    title_line = []
+    sample_control = []
+    sample_rows = dict()
+    project_rows = []
+    # The current block of consecutive lines, from the first "#SampleID" or "#Type" header on, and the indices in the
+    # block of the lines following each header:
+    block = []
+    sample_head_ind = []
+    type_head_ind = []
+    for line in itertools.chain(filelines, [None]):   # None closes the last block
+        if line is None or BLANK_LINE_RE.match(line):
+            for row in get_block_rows(block, sample_head_ind):
+                sample_rows.setdefault(row[0], []).append(row[1:])
+            project_rows.extend(get_block_rows(block, type_head_ind))
+            block = []
+            sample_head_ind = []
+            type_head_ind = []
+            continue
+
+        first_field = FIRST_FIELD_RE.match(line).group()
+        if first_field == "Title":
+            title_line.append(line)
+        elif first_field == "Sample_Control":
+            sample_control.append(line)
+        elif first_field.lower() == "#sampleid":
+            sample_head_ind.append(len(block))
+        elif first_field.lower() == "#type":
+            type_head_ind.append(len(block))
+
+        if sample_head_ind or type_head_ind:
+            # Remove comments, empty lines and trailing white space (as done by remove_comments()):
+            line = line.partition("#")[0]
+            if line.strip():
+                block.append(line.rstrip())
+
+    title_line = remove_comments(title_line)
     
     # Check there is only one title line (title is a list of length 1)
     if len(title_line)>1:   
@@ -195,50 +273,10 @@ def get_tabular_sample_data_lines(filelines):
         sys.stderr.write("The title contains white spaces. Converting to underscores. (%s)\n" % title)
     return_results["Title"] = title
 
-    # Looking for contiguous blocks beginning with #SampleID and #Type.
-    # First, getting index of blank lines:
-    blank_ind = [ind for (ind,param_l) in list(enumerate(filelines)) if re.match("^\s+$", param_l)]
-    blank_ind.append(len(filelines))
-    
-    # looking for range begining with "#SampleID" till first blank line:
-    # Index of header line:
-    head_ind_list = [ind
-                for (ind,param_l)
-                in list(enumerate(filelines))
-                if re.split("\s+", param_l, maxsplit=1)[0].lower() == "#sampleid"]
-
-    # if head_ind:  # A line beginning with '#SampleID' exists.
-    return_results["Sample_data"] = []
-    for head_ind in head_ind_list:
-        # Range of lines to keep: from header index till first blank line
-        lines_range = list(range(head_ind,min([ind for ind in blank_ind if ind>head_ind])))
-        # Read CSV data with csv package. Store in return_results
-        linedata = StringIO("\n".join(remove_comments([filelines[i] for i in lines_range])))
-        reader = csv.reader(linedata, dialect='excel-tab')
-        return_results["Sample_data"].extend([row for row in reader])
-
-    # looking for range begining with "#Type" till first blank line:
-    # Index of header line:
-    head_ind_list = [ind
-                     for (ind,param_l)
-                     in list(enumerate(filelines))
-                     if re.split("\s+", param_l, maxsplit=1)[0].lower() == "#type"]
-
-    # if head_ind:  # A line beginning with '#Type' exists.
-    return_results["Project_data"] = []
-    for head_ind in head_ind_list:
+    return_results["Sample_data"] = sample_rows
+    return_results["Project_data"] = project_rows
 
-        # Range of lines to keep: from header index till first blank line
-        lines_range = list(range(head_ind,min([ind for ind in blank_ind if ind>head_ind])))
-
-        linedata = StringIO("\n".join(remove_comments([filelines[i] for i in lines_range])))
-        reader = csv.reader(linedata, dialect='excel-tab')
-        return_results["Project_data"].extend([row for row in reader])
-
-    # print(return_results["Project_data"])
-    # sys.exit()
     # Extract Sample_Control lines:
-    sample_control = [line for line in filelines if re.split("\s+", line, maxsplit=1)[0] == "Sample_Control"]
     sample_control = remove_comments(sample_control)
 
     if sample_control and not "Sample_data" in return_results:
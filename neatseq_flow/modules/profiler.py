@@ -0,0 +1,154 @@
+""" Timing the phases of workflow generation
+
+A Profiler records the duration of named phases (parsing, making the step instances, building each step's scripts
+etc.) and the peak memory at the end of each phase. The phases are saved as a trace file in the Chrome trace event
+format, which can be opened in chrome://tracing or https://ui.perfetto.dev, and the slowest phases are summarized on
+stderr.
+
+When not profiling, the workflow and the steps use a NullProfiler, which does nothing.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import json
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. Peak memory is not reported.
+    resource = None
+
+
+def get_peak_memory(children=False):
+    """ Returns the peak resident memory of the process (or of its terminated child processes), in bytes.
+        Returns None if it is not available.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+def format_memory(memory):
+    return "{mb:.1f} MB".format(mb=memory / 1024.0 / 1024.0) if memory is not None else "not available"
+
+
+class ProfilerPhase(object):
+    """ A context manager recording one phase in a Profiler
+    """
+
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        end = time.perf_counter()
+        args = dict(self.args)
+        peak_memory = get_peak_memory()
+        if peak_memory is not None:
+            args["peak_memory"] = peak_memory
+        self.profiler.events.append({"name": self.name,
+                                     "cat": self.category,
+                                     "ph": "X",
+                                     "ts": (self.start - self.profiler.start_time) * 1e6,
+                                     "dur": (end - self.start) * 1e6,
+                                     "pid": os.getpid(),
+                                     "tid": 0,
+                                     "args": args})
+        return False
+
+
+class Profiler(object):
+    """ Records the phases of workflow generation
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.events = list()    # Complete ('X') events of the Chrome trace event format
+
+    def phase(self, name, category="workflow", **args):
+        """ Returns a context manager timing the phase 'name'. args are stored with the phase, e.g. the step name.
+        """
+        return ProfilerPhase(self, name, category, args)
+
+    def get_trace(self):
+        """ Returns the phases as a dict in the Chrome trace event format
+        """
+        events = list(self.events)
+        events.append({"name": "NeatSeqFlow",
+                       "cat": "workflow",
+                       "ph": "X",
+                       "ts": 0,
+                       "dur": (time.perf_counter() - self.start_time) * 1e6,
+                       "pid": os.getpid(),
+                       "tid": 0,
+                       "args": {}})
+        for pid in sorted(set(event["pid"] for event in events)):
+            events.append({"name": "process_name",
+                           "ph": "M",
+                           "pid": pid,
+                           "tid": 0,
+                           "args": {"name": "neatseq_flow" if pid == os.getpid() else "build worker %d" % pid}})
+        return {"traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"peak_memory": get_peak_memory(),
+                              "peak_memory_children": get_peak_memory(children=True)}}
+
+    def write_trace(self, filename):
+        """ Writes the phases to filename in the Chrome trace event format
+        """
+        with open(filename, "w") as trace_fh:
+            json.dump(self.get_trace(), trace_fh)
+
+    def write_summary(self, top=20, stream=None):
+        """ Writes the total time, the peak memory and the 'top' slowest phases to stream (default: stderr)
+        """
+        stream = stream if stream is not None else sys.stderr
+        trace = self.get_trace()
+        events = sorted((event for event in trace["traceEvents"] if event["ph"] == "X"),
+                        key=lambda event: event["dur"],
+                        reverse=True)
+        stream.write("Profile:\n--------\n")
+        stream.write("Peak memory: %s\n" % format_memory(trace["otherData"]["peak_memory"]))
+        if trace["otherData"]["peak_memory_children"]:
+            stream.write("Peak memory of child processes: %s\n" %
+                         format_memory(trace["otherData"]["peak_memory_children"]))
+        stream.write("Slowest phases:\n")
+        for event in events[:top]:
+            stream.write("{dur:>10.3f}s  {name}{step}\n".format(dur=event["dur"] / 1e6,
+                                                                name=event["name"],
+                                                                step=" [%s]" % event["args"]["step"]
+                                                                     if "step" in event["args"]
+                                                                     else ""))
+
+
+class NullProfiler(object):
+    """ A profiler that records nothing. Used when not profiling.
+    """
+
+    def phase(self, name, category="workflow", **args):
+        return NULL_PHASE
+
+
+class NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+NULL_PHASE = NullPhase()
@@ -0,0 +1,132 @@
+""" Recording the provenance of sample_data slots
+
+The provenance of a slot is the list of steps that created, changed or removed it, as printed by stop_and_show, e.g.
+">Import->trim_gal->merge1|" (">" marks creation and "|" marks removal).
+
+Instead of keeping a full provenance dict per step, each step keeps a change log: the list of changes it made to
+sample_data, found by comparing its sample_data with the sample_data of its bases. Since a step's sample_data is a
+SampleDataLayer over the sample_data of its bases, only the slots the step wrote have to be compared (see
+get_changed_keys() in sample_data_layer.py). A change is a tuple (event, sample, value):
+
+* ("add_sample", sample, slots): sample was added to the sample list. All its slots are created by the step.
+* ("remove_sample", sample, slots): sample was removed from the sample list. All its slots are removed by the step.
+* ("create", sample, slot), ("change", sample, slot) and ("remove", sample, slot) for slots of the other samples and
+  of project_data.
+
+The provenance dict is built from the change logs only when it is required, by get_provenance().
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .sample_data_layer import get_value, get_changed_keys
+
+
+def get_slots(sample_data, sample):
+    """ Returns the list of slots of sample in sample_data, or an empty list if the sample is not defined
+    """
+    if sample not in sample_data:
+        return list()
+    return list(get_value(sample_data, sample))
+
+
+def get_changes(sample_data, original):
+    """ Returns the list of changes turning original (the sample_data before the step) into sample_data
+    """
+    changes = list()
+    samples = get_value(sample_data, "samples")
+    original_samples = get_value(original, "samples")
+    sample_set = set(samples)
+    original_sample_set = set(original_samples)
+
+    for sample in samples:
+        if sample not in original_sample_set:
+            changes.append(("add_sample", sample, get_slots(sample_data, sample)))
+    for sample in original_samples:
+        if sample not in sample_set:
+            changes.append(("remove_sample",
+                            sample,
+                            get_slots(original, sample) if sample in sample_data else list()))
+
+    # Samples that were neither added nor removed, and project_data:
+    kept = (sample_set & original_sample_set) | {"project_data"}
+    for sample in get_changed_keys(sample_data, original)[0]:
+        if sample not in kept or sample not in original:
+            continue
+        slots = get_value(sample_data, sample)
+        original_slots = get_value(original, sample)
+        if not isinstance(slots, Mapping) or not isinstance(original_slots, Mapping):
+            continue
+        keys, deleted = get_changed_keys(slots, original_slots)
+        for slot in keys:
+            if slot not in original_slots:
+                changes.append(("create", sample, slot))
+            elif get_value(slots, slot) != get_value(original_slots, slot):
+                changes.append(("change", sample, slot))
+        for slot in deleted:
+            changes.append(("remove", sample, slot))
+    return changes
+
+
+def get_provenance(step_name, base_provenance_list, changes, sample_data, original):
+    """ Returns the provenance dict ({sample: {slot: [step names]}}) of a step.
+
+    :param step_name: The name of the step
+    :param base_provenance_list: The provenance dicts of the step's bases, or None for a step without bases.
+    :param changes: The step's change log
+    :param sample_data: The step's sample_data
+    :param original: The sample_data before the step, i.e. the merged sample_data of the bases
+    """
+    if base_provenance_list is None:
+        # All slots in the original sample_data were created by the step:
+        provenance = {sample: {slot: [">" + step_name] for slot in get_value(original, sample)}
+                      for sample in list(get_value(original, "samples")) + ["project_data"]
+                      if sample in original}
+    else:
+        # For slots defined in more than one base, the provenance from the first base defining the slot is used
+        provenance = dict()
+        for base_provenance in base_provenance_list:
+            for sample, slots in base_provenance.items():
+                sample_provenance = provenance.setdefault(sample, dict())
+                for slot, slot_provenance in slots.items():
+                    if slot not in sample_provenance:
+                        sample_provenance[slot] = list(slot_provenance)
+
+    # Slots of kept samples that were removed in the first base defining them, but exist in the step's
+    # sample_data (i.e. were imported from another base), are re-added by the step:
+    re_added = set()
+    if base_provenance_list is not None:
+        kept = (set(get_value(sample_data, "samples")) & set(get_value(original, "samples"))) | {"project_data"}
+        for sample in kept:
+            if sample not in provenance or sample not in sample_data or sample not in original:
+                continue
+            slots = get_value(sample_data, sample)
+            original_slots = get_value(original, sample)
+            for slot, slot_provenance in provenance[sample].items():
+                if slot_provenance and slot_provenance[-1].endswith("|") and \
+                        slot in slots and slot in original_slots:
+                    slot_provenance.append(step_name)
+                    re_added.add((sample, slot))
+
+    for event, sample, value in changes:
+        sample_provenance = provenance.setdefault(sample, dict())
+        if event == "add_sample":
+            for slot in list(sample_provenance) + value:
+                sample_provenance[slot] = [">" + step_name]
+        elif event == "remove_sample":
+            for slot in list(sample_provenance) + [slot for slot in value if slot not in sample_provenance]:
+                sample_provenance.setdefault(slot, list()).append(step_name + "|")
+        elif event == "create":
+            sample_provenance[value] = [">" + step_name]
+        elif event == "change":
+            if (sample, value) not in re_added:
+                sample_provenance.setdefault(value, list()).append(step_name)
+        elif event == "remove":
+            sample_provenance.setdefault(value, list()).append(step_name + "|")
+    return provenance
@@ -0,0 +1,352 @@
+""" The run state of a workflow in an SQLite database
+
+By default, the state of the jobs of a Local or SLURM run is kept in objects/run_index.txt: Every change runs locksed
+(see CC.helper_funcs.sh), which locks the file and rewrites all of it with 'sed -i', and the waiting jobs read all of
+it every few seconds. When 'run_state: sqlite' is set in the global parameters, the state is kept in an SQLite database
+in WAL mode (objects/run_index.db) instead: A change updates a single row, found through the index on the job names,
+and readers are not blocked by the writers.
+
+The database holds the lines of run_index.txt, in order, so the format of the lines is kept: Active jobs are lines
+beginning with the job name, followed by the state and its data (e.g. 'name PID pid slots mem', tab separated), and
+other jobs are commented out (e.g. '# name done'). The active flag, the state and the resources of each job are kept
+in columns of their own, for the queries used by the scripts.
+
+The database is created from run_index.txt when the workflow is generated. The bash side uses this module as a
+command line tool (see the helper functions and scripts/NSF_run_state.sh):
+
+    run_state.py --db <db> [--run_index <run_index.txt>] <command>
+
+    sed EXPRESSION          Apply a locksed expression, e.g. 's:^\\(name\\).*:# \\1\\tdone:'
+                            With --run_index, run_index.txt is written when no active jobs remain
+    reserve EXPRESSION CPUS MAX_CPUS MEM MAX_MEM
+                            Apply the expression if the active jobs leave CPUS and MEM free (as Checkresources).
+                            Prints 1 if it was applied and 0 if not. MAX_MEM 0 means no memory limit.
+    active                  Print the names of the active jobs
+    lines PREFIX            Print the lines of the active jobs whose name starts with PREFIX
+    count STATE [--low]     Print the number of active jobs in STATE (only low level jobs, with --low)
+    queue TABLE [TABLE...]  Mark the jobs in the task tables (first column) as queued, if they are not active
+    clean                   Mark all jobs as inactive (as the run_index clean script)
+    import [FILE]           Create the database from a run_index text file
+    export [FILE]           Write the database to a run_index text file
+
+FILE is run_index.txt (--run_index) by default. The 'sed' command supports the expressions used by the scripts:
+'s:<pattern>:<replacement>:' where the pattern is '\\(name\\).*', optionally anchored with '^' (active jobs only) or
+preceded by '# ' (inactive jobs only). Names are matched exactly.
+
+The module is executed as a script by the workflow, and must not import anything but the standard library.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import sys
+import re
+import sqlite3
+import argparse
+
+
+# Seconds to wait for a lock held by another writer:
+BUSY_TIMEOUT = 600
+# Separator between the parts of job names (step..name..sample..run_code), see PLC_step.py:
+JID_NAME_SEP = ".."
+
+SED_RE = re.compile(r"^s:(\^|# )?\\\((.+?)\\\)\.\*\$?:(.*):$", re.DOTALL)
+LINE_RE = re.compile(r"^((?:#\s*)*)(\S+)")
+
+
+def parse_line(line):
+    """ Returns the name, active flag, state, slots and memory of a run_index line, or None for lines without a job
+        (blank lines and separators)
+    """
+    match = LINE_RE.match(line)
+    if not match or (not match.group(1) and match.group(2).startswith("-")):
+        return None
+    fields = line[match.end(1):].split()
+    numbers = [get_leading_number(field) for field in fields[3:5]] + [0, 0]
+    return {"name": fields[0],
+            "active": 0 if match.group(1) else 1,
+            "state": fields[1] if len(fields) > 1 else "",
+            "cpus": numbers[0] if len(fields) > 1 and fields[1] == "PID" else 0,
+            "mem": numbers[1] if len(fields) > 1 and fields[1] == "PID" else 0}
+
+
+def get_leading_number(text):
+    match = re.match("[0-9]+", text)
+    return int(match.group(0)) if match else 0
+
+
+def parse_sed(expression):
+    """ Returns the anchor ('^', '# ' or ''), the job name and the new line of a locksed expression
+    """
+    match = SED_RE.match(expression)
+    if not match:
+        raise ValueError("Unsupported run_index expression: {expr}".format(expr=expression))
+    anchor, name, replacement = match.group(1) or "", match.group(2), match.group(3)
+    # Replacement escapes, as sed does: \1 is the name, \t a tab and \n a newline
+    escapes = {"1": name, "t": "\t", "n": "\n"}
+    new_text = re.sub(r"\\(.)", lambda esc: escapes.get(esc.group(1), esc.group(1)), replacement)
+    return anchor, name, new_text
+
+
+class RunState(object):
+    """ The run state database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS run_index (
+                                 seq INTEGER PRIMARY KEY,
+                                 name TEXT UNIQUE,
+                                 active INTEGER NOT NULL DEFAULT 0,
+                                 state TEXT NOT NULL DEFAULT '',
+                                 cpus INTEGER NOT NULL DEFAULT 0,
+                                 mem INTEGER NOT NULL DEFAULT 0,
+                                 line TEXT NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS run_index_active ON run_index (active, state)")
+
+    def close(self):
+        self.conn.close()
+
+    def get_version(self):
+        """ Returns a number which changes whenever another connection changes the database
+        """
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # -------------------------------------------------------------------
+    # Changing the state
+
+    def set_line(self, name, line, anchor=None):
+        """ Replaces the line of job name. With anchor '^' only if the job is active, with '# ' only if it is not.
+            With an empty anchor, a comment at the beginning of the line is kept, as sed does.
+            Returns True if the line was replaced. Must be called within a transaction.
+        """
+        row = self.conn.execute("SELECT active, line FROM run_index WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return False
+        active, old_line = row
+        if (anchor == "^" and not active) or (anchor == "# " and active):
+            return False
+        if anchor == "":
+            line = LINE_RE.match(old_line).group(1) + line
+        fields = parse_line(line)
+        if fields is None or fields["name"] != name:
+            raise ValueError("Bad run_index line for {name}: {line}".format(name=name, line=line))
+        self.conn.execute("UPDATE run_index SET active = ?, state = ?, cpus = ?, mem = ?, line = ? WHERE name = ?",
+                          (fields["active"], fields["state"], fields["cpus"], fields["mem"], line, name))
+        return True
+
+    def sed(self, expression, run_index=None):
+        """ Applies a locksed expression. Returns True if a line was changed.
+            With run_index, the run_index text file is written when the expression marks the last active job as
+            inactive, i.e. once at the end of the run. Other changes are not written to the file (use the 'export'
+            command to write the current state), so that a change does not rewrite the whole file.
+        """
+        anchor, name, line = parse_sed(expression)
+        with Transaction(self.conn):
+            changed = self.set_line(name, line, anchor)
+            if changed and run_index and not self.has_active():
+                self.export_text(run_index)
+            return changed
+
+    def reserve(self, expression, cpus, max_cpus, mem, max_mem):
+        """ Applies expression if the active jobs leave cpus and mem free. max_mem 0 means no memory limit.
+            Returns True if the expression was applied.
+        """
+        anchor, name, line = parse_sed(expression)
+        with Transaction(self.conn):
+            used_cpus, used_mem = self.conn.execute("SELECT TOTAL(cpus), TOTAL(mem) FROM run_index "
+                                                    "WHERE active = 1").fetchone()
+            if used_cpus + cpus > max_cpus or (max_mem and used_mem + mem > max_mem):
+                return False
+            return self.set_line(name, line, anchor)
+
+    def update(self, lines):
+        """ Replaces the lines of the jobs in lines, a {job name: (new line, only if active)} dict, in a single
+            transaction (see RunIndex.update() in local_scheduler.py)
+        """
+        with Transaction(self.conn):
+            for name, (line, only_active) in lines.items():
+                self.set_line(name, line, "^" if only_active else None)
+
+    def queue(self, names):
+        """ Marks the jobs in names as queued, if they are not active
+        """
+        with Transaction(self.conn):
+            for name in names:
+                self.set_line(name, "{name}\tqueued".format(name=name), "# ")
+
+    def clean(self):
+        """ Marks all jobs as inactive, without state
+        """
+        with Transaction(self.conn):
+            self.conn.execute("UPDATE run_index SET active = 0, state = '', cpus = 0, mem = 0, line = '# ' || name "
+                              "WHERE name IS NOT NULL")
+
+    # -------------------------------------------------------------------
+    # Reading the state
+
+    def has_active(self):
+        """ Returns True if any job is active
+        """
+        return self.conn.execute("SELECT 1 FROM run_index WHERE active = 1 LIMIT 1").fetchone() is not None
+
+    def get_active(self):
+        """ Returns the names of the active jobs
+        """
+        return [name for (name,) in self.conn.execute("SELECT name FROM run_index WHERE active = 1")]
+
+    def get_resources(self):
+        """ Returns the slots and memory of the running jobs, a {name: (slots, mem)} dict
+        """
+        return dict((name, (cpus, mem))
+                    for name, cpus, mem
+                    in self.conn.execute("SELECT name, cpus, mem FROM run_index WHERE active = 1 AND state = 'PID'"))
+
+    def get_lines(self, prefix):
+        """ Returns the lines of the active jobs whose name starts with prefix
+        """
+        return [line for (line,) in self.conn.execute("SELECT line FROM run_index "
+                                                      "WHERE name >= ? AND name < ? AND active = 1 ORDER BY seq",
+                                                      (prefix, prefix + "\U0010ffff"))]
+
+    def count(self, state, low_level=False):
+        """ Returns the number of active jobs in state. With low_level, only low level jobs are counted.
+        """
+        query = "SELECT name FROM run_index WHERE active = 1 AND state = ?"
+        names = [name for (name,) in self.conn.execute(query, (state,))]
+        if low_level:
+            names = [name for name in names if name.count(JID_NAME_SEP) >= 3]
+        return len(names)
+
+    # -------------------------------------------------------------------
+    # Converting from and to run_index.txt
+
+    def import_text(self, path):
+        """ Replaces the content of the database with the lines of a run_index text file
+        """
+        with open(path) as index_fh:
+            lines = index_fh.read().splitlines()
+        with Transaction(self.conn):
+            self.conn.execute("DELETE FROM run_index")
+            for seq, line in enumerate(lines):
+                fields = parse_line(line) or {"name": None, "active": 0, "state": "", "cpus": 0, "mem": 0}
+                self.conn.execute("INSERT OR IGNORE INTO run_index (seq, name, active, state, cpus, mem, line) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (seq, fields["name"], fields["active"], fields["state"], fields["cpus"],
+                                   fields["mem"], line))
+
+    def export_text(self, path):
+        """ Writes the lines to a run_index text file. The file is replaced, so that readers never see part of it.
+        """
+        temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+        with open(temp_path, "w") as temp_fh:
+            for (line,) in self.conn.execute("SELECT line FROM run_index ORDER BY seq"):
+                temp_fh.write(line + "\n")
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+
+
+class Transaction(object):
+    """ A write transaction. The database is locked for writing when the transaction begins, so that the reads in the
+        transaction see the state it changes.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+def create_run_state(db_path, run_index):
+    """ Creates the database of a workflow from its run_index file, replacing an existing database
+    """
+    for path in [db_path, db_path + "-wal", db_path + "-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+    run_state = RunState(db_path)
+    try:
+        run_state.import_text(run_index)
+    finally:
+        run_state.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="The run state of a NeatSeq-Flow workflow")
+    parser.add_argument("--db", required=True, help="The run state database")
+    parser.add_argument("--run_index", help="The run_index text file, for import and export")
+    commands = parser.add_subparsers(dest="command")
+    sed_parser = commands.add_parser("sed", help="Apply a locksed expression")
+    sed_parser.add_argument("expression")
+    reserve_parser = commands.add_parser("reserve", help="Apply a locksed expression if there are free resources")
+    reserve_parser.add_argument("expression")
+    for resource in ["cpus", "max_cpus", "mem", "max_mem"]:
+        reserve_parser.add_argument(resource, type=int)
+    commands.add_parser("active", help="Print the names of the active jobs")
+    lines_parser = commands.add_parser("lines", help="Print the lines of the active jobs starting with prefix")
+    lines_parser.add_argument("prefix")
+    count_parser = commands.add_parser("count", help="Print the number of active jobs in state")
+    count_parser.add_argument("state")
+    count_parser.add_argument("--low", action="store_true", help="Count only low level jobs")
+    queue_parser = commands.add_parser("queue", help="Mark the jobs in the task tables as queued")
+    queue_parser.add_argument("tables", nargs="+")
+    commands.add_parser("clean", help="Mark all jobs as inactive")
+    for command in ["import", "export"]:
+        file_parser = commands.add_parser(command, help="{cmd} a run_index text file".format(cmd=command.title()))
+        file_parser.add_argument("file", nargs="?")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.command in ["import", "export"]:
+        args.file = args.file or args.run_index
+        if not args.file:
+            sys.exit("Pass the run_index file to {cmd}".format(cmd=args.command))
+        if args.command == "import":
+            create_run_state(args.db, args.file)
+            return
+    if not os.path.exists(args.db):
+        sys.exit("Run state database {db} does not exist".format(db=args.db))
+
+    run_state = RunState(args.db)
+    try:
+        if args.command == "sed":
+            run_state.sed(args.expression, args.run_index)
+        elif args.command == "reserve":
+            print(1 if run_state.reserve(args.expression, args.cpus, args.max_cpus, args.mem, args.max_mem) else 0)
+        elif args.command == "active":
+            sys.stdout.write("".join(name + "\n" for name in run_state.get_active()))
+        elif args.command == "lines":
+            sys.stdout.write("".join(line + "\n" for line in run_state.get_lines(args.prefix)))
+        elif args.command == "count":
+            print(run_state.count(args.state, args.low))
+        elif args.command == "queue":
+            names = list()
+            for table in args.tables:
+                with open(table) as table_fh:
+                    names.extend(line.split("\t")[0].strip() for line in table_fh if line.strip())
+            run_state.queue(names)
+        elif args.command == "clean":
+            run_state.clean()
+        elif args.command == "export":
+            run_state.export_text(args.file)
+    except ValueError as err:
+        sys.exit(str(err))
+    finally:
+        run_state.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+""" A copy-on-write container for step sample_data
+
+Every step used to start from a deepcopy of the merged sample_data of its bases, so building a workflow copied the
+full sample data once per step. A SampleDataLayer instead holds a list of parent mappings (the sample_data of the base
+steps) and stores only what the step changes. Lookups fall through to the parents, merging them with the same rules
+that were used for merging base sample_data dicts:
+
+* For a key defined in more than one parent, the value from the first parent defining it is used.
+* If that value is a dict, it is merged with the dicts found in the other parents for the same key.
+* The "samples" lists are united, keeping the samples in order of first appearance.
+
+The "samples" lists are stored as SampleLists, which have constant-time membership tests (see sample_list.py).
+
+Nested dicts are returned as layers as well, and lists are copied the first time they are read, so that modifying a
+returned value never changes the parents.
+
+Every layer caches the merged values of its parents and its key list, so that a lookup does not walk the ancestry
+again. A layer clears the caches of the layers stacked on it when one of its values is set, copied or deleted. Changes
+made to plain dicts used as parents, or in place to values already stored in a layer, are not tracked: As with the
+deepcopies, the sample_data of a step should not be changed after the steps based on it have been created.
+
+SampleDataLayer is a MutableMapping, not a dict. Check for sample_data containers with isinstance(value, Mapping).
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+from copy import deepcopy
+from weakref import WeakValueDictionary
+
+from .sample_list import SampleList
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+
+# Values of these types are returned as is, without copying them into the layer:
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, tuple, frozenset, type(None))
+# Marks keys not defined in a layer or its parents:
+_MISSING = object()
+
+
+class SampleDataLayer(MutableMapping):
+    """ A dict-like view of sample_data stacked on top of the sample_data of base steps.
+    """
+
+    def __init__(self, parents=None, data=None):
+        """
+        :param parents: A list of mappings (dicts or SampleDataLayers) in order of precedence.
+        :param data: An optional mapping of values to set in the new layer.
+        """
+        self._parents = list(parents) if parents else list()
+        self._local = dict()        # Values set in this layer or copied from the parents on first access
+        self._deleted = set()       # Keys defined in the parents and deleted in this layer
+        self._tail = dict()         # Keys added in this layer, in order of addition (values are unused)
+        self._merged = dict()       # The merged values of the parents, by key (_MISSING if not defined), once computed
+        self._keys = None           # The key list, once computed
+        self._children = WeakValueDictionary()  # {id: layer} The layers whose parents include this layer
+        self._register()
+        if data:
+            self.update(data)
+
+    def _register(self):
+        """ Registers the layer with its parent layers, so that they clear its cached view when they change
+        """
+        for parent in self._parents:
+            if isinstance(parent, SampleDataLayer):
+                parent.__dict__.setdefault("_children", WeakValueDictionary())[id(self)] = self
+
+    def _changed(self, key):
+        """ Clears the values cached for key by the layers stacked on this one, after the value of key in this layer
+            was set, copied or deleted.
+        """
+        for child in list(self._children.values()):
+            if key in child._local or key in child._deleted:
+                # The child's own value hides the change
+                continue
+            child._merged.pop(key, None)
+            child._keys = None
+            child._changed(key)
+
+    def _inherited(self, key):
+        """ Returns the value the parents define for key, merged according to the merge rules, or _MISSING.
+            Does not store anything in the layer. The value is cached until one of the parent layers changes it.
+        """
+        try:
+            return self._merged[key]
+        except KeyError:
+            pass
+        values = list()
+        for parent in self._parents:
+            value = parent._view(key) if isinstance(parent, SampleDataLayer) else parent.get(key, _MISSING)
+            if value is not _MISSING and all(value is not other for other in values):
+                values.append(value)
+        if not values:
+            merged = _MISSING
+        elif isinstance(values[0], Mapping):
+            merged = SampleDataLayer([value for value in values if isinstance(value, Mapping)])
+        elif key == "samples" and len(values) > 1:
+            merged = SampleList()
+            for value in values:
+                for sample in value:
+                    if sample not in merged:
+                        merged.append(sample)
+        else:
+            merged = values[0]
+        self._merged[key] = merged
+        return merged
+
+    def _view(self, key):
+        """ Returns the value for key, or _MISSING if it is not defined, without storing anything in the layer.
+        """
+        if key in self._local:
+            return self._local[key]
+        if key in self._deleted:
+            return _MISSING
+        return self._inherited(key)
+
+    def _value(self, key):
+        """ Returns the value for key without storing anything in the layer. Do not modify the returned value!
+        """
+        value = self._view(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def _key_list(self):
+        """ Returns the keys of the layer: the parent keys in merge order, followed by the keys added in this layer.
+            The list is cached until the keys of the layer or of one of the parent layers change. Do not modify it!
+        """
+        if self._keys is None:
+            keys = list()
+            seen = set()
+            for parent in self._parents:
+                for key in (parent._key_list() if isinstance(parent, SampleDataLayer) else parent):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if key not in self._deleted and key not in self._tail:
+                        keys.append(key)
+            keys.extend(self._tail)
+            self._keys = keys
+        return self._keys
+
+    def __getitem__(self, key):
+        value = self._value(key)
+        if key in self._local or isinstance(value, IMMUTABLE_TYPES):
+            return value
+        # Keep the value in this layer, so that changes made to it are kept and do not affect the parents:
+        if not isinstance(value, SampleDataLayer):
+            value = deepcopy(value)
+            if key == "samples" and isinstance(value, list) and not isinstance(value, SampleList):
+                value = SampleList(value)
+        self._local[key] = value
+        self._changed(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key == "samples" and isinstance(value, list) and not isinstance(value, SampleList):
+            value = SampleList(value)
+        if key in self._deleted:
+            # Re-adding a deleted key puts it at the end, as in a dict
+            self._deleted.discard(key)
+            self._tail[key] = None
+            self._keys = None
+        elif key not in self._local and key not in self._tail and self._inherited(key) is _MISSING:
+            self._tail[key] = None
+            self._keys = None
+        self._local[key] = value
+        self._changed(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._local.pop(key, None)
+        self._tail.pop(key, None)
+        if self._inherited(key) is not _MISSING:
+            self._deleted.add(key)
+        self._keys = None
+        self._changed(key)
+
+    def __contains__(self, key):
+        return self._view(key) is not _MISSING
+
+    def __iter__(self):
+        return iter(self._key_list())
+
+    def __len__(self):
+        return len(self._key_list())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self.to_dict(), memo)
+
+    def __getstate__(self):
+        # The caches and the references to the layers stacked on this one are not pickled:
+        state = self.__dict__.copy()
+        state["_merged"] = dict()
+        state["_keys"] = None
+        state.pop("_children", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("_children", WeakValueDictionary())
+        self._register()
+
+    def copy(self):
+        """ Returns a shallow copy as a dict, as dict.copy() does
+        """
+        return {key: self[key] for key in self}
+
+    def to_dict(self):
+        """ Returns the layer as nested dicts, e.g. for JSON serialization.
+            Lists are shared with the layers, so the returned dict should not be modified.
+        """
+        ret_dict = dict()
+        for key in self:
+            value = self._value(key)
+            if isinstance(value, SampleDataLayer):
+                value = value.to_dict()
+            elif isinstance(value, Mapping):
+                value = SampleDataLayer([value]).to_dict()
+            ret_dict[key] = value
+        return ret_dict
+
+
+def find_merge_conflicts(parents, names):
+    """ Lists the keys for which the parents define different values. Such values are hidden by the value of the
+        first parent defining the key when the parents are merged.
+
+    :param parents: A list of mappings, as passed to SampleDataLayer
+    :param names: A list of names for the parents (the base step names), in the same order
+    :return: A list of (key, name) tuples. Nested keys are reported by their own name.
+    """
+    conflicts = list()
+    merged = SampleDataLayer(parents)
+    for key in merged:
+        first = merged._value(key)
+        nested = list()
+        for parent, name in zip(parents, names):
+            if key not in parent:
+                continue
+            value = parent._value(key) if isinstance(parent, SampleDataLayer) else parent[key]
+            if isinstance(first, Mapping):
+                if isinstance(value, Mapping):
+                    nested.append((value, name))
+                else:
+                    conflicts.append((key, name))
+            elif key == "samples":
+                if set(value) != set(first):
+                    conflicts.append((key, name))
+            elif value != first:
+                conflicts.append((key, name))
+        if len(nested) > 1:
+            conflicts.extend(find_merge_conflicts(*zip(*nested)))
+    return conflicts
+
+
+def get_value(mapping, key):
+    """ Returns mapping[key] without storing a copy in a SampleDataLayer
+    """
+    return mapping._value(key) if isinstance(mapping, SampleDataLayer) else mapping[key]
+
+
+def get_changed_keys(new, base):
+    """ Lists the keys in which new may differ from base, without comparing the values.
+
+    If new and base are layers over the same parents (e.g. a step's sample_data and the merged sample_data of its
+    bases), only the keys set or deleted in new can differ. Otherwise, all keys of new are listed.
+
+    :return: A tuple: (keys of new that were added or may have been changed, keys of base deleted in new)
+    """
+    if isinstance(new, SampleDataLayer) and isinstance(base, SampleDataLayer) and \
+            len(new._parents) == len(base._parents) and \
+            all(new_parent is base_parent for new_parent, base_parent in zip(new._parents, base._parents)):
+        return [key for key in new if key in new._local], [key for key in new._deleted if key in base]
+    return list(new), [key for key in base if key not in new]
@@ -0,0 +1,141 @@
+""" An indexed list of sample names
+
+sample_data["samples"] is tested for membership in many places (e.g. "if sample in self.sample_data['samples']"),
+which takes time proportional to the number of samples for a list. A SampleList is a list that also keeps an index of
+its samples, so that membership tests take constant time. It behaves as a list in every other respect: it keeps the
+order of the samples, can be indexed, sliced and modified, and is encoded as a list in JSON.
+
+SampleLists also support order-preserving set operations: samples1 - samples2, samples1 & samples2 and
+samples1 | samples2 return SampleLists with the samples in the order of samples1 (followed by the new samples of
+samples2, for |). The other operand may be any iterable of samples.
+
+sample_data["samples"] is converted to a SampleList when it is set in a step's sample_data (see sample_data_layer.py).
+Note that a list assigned to sample_data["samples"] is copied, so changes to the original list are not seen in
+sample_data.
+
+Every change to a SampleList increments its version, so that data derived from the sample list (e.g. the grouping
+index, see grouping_index.py) can tell whether it is still current.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+class SampleList(list):
+    """ A list of samples with constant-time membership tests
+    """
+
+    def __init__(self, samples=()):
+        list.__init__(self, samples)
+        self._counts = dict()   # {sample: number of times in list}. Lists may contain duplicates.
+        self.version = 0
+        self._add(self)
+
+    def _add(self, samples):
+        self.version += 1
+        for sample in samples:
+            self._counts[sample] = self._counts.get(sample, 0) + 1
+
+    def _discard(self, samples):
+        self.version += 1
+        for sample in samples:
+            if self._counts[sample] == 1:
+                del self._counts[sample]
+            else:
+                self._counts[sample] -= 1
+
+    def __contains__(self, sample):
+        try:
+            return sample in self._counts
+        except TypeError:
+            # Unhashable values are never in the list
+            return False
+
+    def __reduce_ex__(self, protocol):
+        # Pickled (and copied) as a list. The index is built again when unpickling.
+        return self.__class__, (list(self),)
+
+    def copy(self):
+        return self.__class__(self)
+
+    # Modifying the list. Each method updates the index:
+
+    def append(self, sample):
+        list.append(self, sample)
+        self._add([sample])
+
+    def extend(self, samples):
+        samples = list(samples)
+        list.extend(self, samples)
+        self._add(samples)
+
+    def insert(self, index, sample):
+        list.insert(self, index, sample)
+        self._add([sample])
+
+    def remove(self, sample):
+        list.remove(self, sample)
+        self._discard([sample])
+
+    def pop(self, index=-1):
+        sample = list.pop(self, index)
+        self._discard([sample])
+        return sample
+
+    def clear(self):
+        list.clear(self)
+        self._counts.clear()
+        self.version += 1
+
+    # Reordering the list does not change the index, but changes the version:
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.version += 1
+
+    def reverse(self):
+        list.reverse(self)
+        self.version += 1
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._discard(list.__getitem__(self, index))
+            list.__setitem__(self, index, value)
+            self._add(value)
+        else:
+            self._discard([list.__getitem__(self, index)])
+            list.__setitem__(self, index, value)
+            self._add([value])
+
+    def __delitem__(self, index):
+        removed = list.__getitem__(self, index)
+        list.__delitem__(self, index)
+        self._discard(removed if isinstance(index, slice) else [removed])
+
+    def __iadd__(self, samples):
+        self.extend(samples)
+        return self
+
+    def __imul__(self, times):
+        list.__imul__(self, times)
+        self._counts.clear()
+        self._add(self)
+        return self
+
+    # Order-preserving set operations:
+
+    def __sub__(self, samples):
+        samples = samples if isinstance(samples, (SampleList, set, frozenset, dict)) else set(samples)
+        return self.__class__(sample for sample in self if sample not in samples)
+
+    def __and__(self, samples):
+        samples = samples if isinstance(samples, (SampleList, set, frozenset, dict)) else set(samples)
+        return self.__class__(sample for sample in self if sample in samples)
+
+    def __or__(self, samples):
+        union = self.__class__(self)
+        for sample in samples:
+            if sample not in union:
+                union.append(sample)
+        return union
@@ -0,0 +1,60 @@
+""" Resolving the script constructor classes of the executor
+
+The script constructors of an executor are defined in neatseq_flow/script_constructors/scriptconstructor<Executor>.py,
+as ScriptConstructor<Executor> (the base class, with the class methods creating the workflow-level scripts) and
+High/Low/KillScriptConstructor<Executor>. Executors that support array jobs also define
+ArrayScriptConstructor<Executor>. Instead of importing the module and looking up the class every time a
+script is created, the classes are resolved once by a ScriptConstructorRegistry. The registries are kept in this
+module, one per executor, and not in pipe_data, which is written to the JSON files and hashed by the step cache.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import importlib
+
+
+class ScriptConstructorRegistry(object):
+    """ The script constructor classes of an executor, resolved on first use
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.module = None
+        self.classes = dict()   # {level: class}
+
+    def get_class(self, level=""):
+        """ Returns the script constructor class for level: "high", "low", "kill", or "" for the base class.
+        """
+        level = level.lower().capitalize()
+        if level not in self.classes:
+            if self.module is None:
+                self.module = importlib.import_module("neatseq_flow.script_constructors.scriptconstructor{executor}".
+                                                      format(executor=self.executor))
+            self.classes[level] = getattr(self.module, "{level}ScriptConstructor{executor}".
+                                          format(level=level, executor=self.executor))
+        return self.classes[level]
+
+    def has_class(self, level):
+        """ Returns True if the executor defines a script constructor class for level, e.g. "array", which is
+            defined only by the executors that support array jobs.
+        """
+        try:
+            self.get_class(level)
+        except AttributeError:
+            return False
+        return True
+
+
+# {executor: ScriptConstructorRegistry}
+_registries = dict()
+
+
+def get_script_constructors(pipe_data):
+    """ Returns the registry of the executor in pipe_data, creating it if it does not exist yet.
+    """
+    executor = pipe_data["Executor"]
+    if executor not in _registries:
+        _registries[executor] = ScriptConstructorRegistry(executor)
+    return _registries[executor]
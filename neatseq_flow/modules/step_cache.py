@@ -0,0 +1,337 @@
+""" Reusing the scripts of steps that have not changed since the previous run
+
+Building a workflow rebuilds the scripts of all steps, even if only one step was changed. With incremental building,
+a fingerprint is computed for every step, hashing everything the step's scripts depend on:
+
+* The step's name, number and parameters and the source of its module.
+* The global parameters, pipe_data and the NeatSeq-Flow source files. The keys of pipe_data that change from run to
+  run without changing the scripts (RUN_VOLATILE_KEYS) are left out, and the run code is replaced by a placeholder.
+* The fingerprints of the base steps. Steps without bases hash the sample data instead.
+
+After a successful run, the state of each step built is saved in objects/step_cache, together with its fingerprint,
+its lines in the shared index files, and the content of its high-level and kill scripts (which are re-created when
+the step instances are made). In the next run, a step whose fingerprint has not changed, and whose scripts still exist,
+is restored from the saved state instead of being built. Since a step's fingerprint includes the fingerprints of its
+bases, changing a step rebuilds the step and all steps downstream of it.
+
+The run code is part of the job names and of some file names in the scripts. When a step is restored in a run with a
+different run code, the run code of the previous run is replaced with the new one in the restored state and scripts,
+including the step's low level scripts, and the step is saved again. The run code is replaced only where it is not
+part of a longer word, and only if it is at least MIN_RUN_CODE_LENGTH characters long. Steps saved with shorter run
+codes are rebuilt when the run code changes.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import io
+import os
+import json
+import pickle
+import re
+import hashlib
+
+from .sample_data_layer import SampleDataLayer
+
+
+# Change this when the structure of the saved records changes:
+CACHE_FORMAT = 2
+# pipe_data keys that do not affect the scripts (the run code is handled separately. See above):
+RUN_VOLATILE_KEYS = ["run_code", "message", "verbose"]
+# Shorter run codes are too likely to appear in the scripts by chance to be replaced:
+MIN_RUN_CODE_LENGTH = 8
+# Replaces the run code in the data hashed for fingerprints:
+RUN_CODE_PLACEHOLDER = "<run_code>"
+
+
+def get_run_code_re(run_code):
+    """ Returns a regular expression matching run_code where it is not part of a longer word
+    """
+    return re.compile(r"(?<![0-9A-Za-z]){run_code}(?![0-9A-Za-z])".format(run_code=re.escape(run_code)))
+
+
+def replace_run_code(data, run_code_re, new_run_code):
+    """ Returns a copy of data (made of dicts, lists, tuples and strings) with the run code replaced in all strings
+    """
+    if isinstance(data, str):
+        return run_code_re.sub(lambda match: new_run_code, data)
+    if isinstance(data, dict):
+        return {replace_run_code(key, run_code_re, new_run_code): replace_run_code(value, run_code_re, new_run_code)
+                for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(replace_run_code(value, run_code_re, new_run_code) for value in data)
+    return data
+
+
+def hash_data(*items):
+    """ Returns a hex digest of the JSON encoding of items.
+    """
+    try:
+        encoded = json.dumps(items, sort_keys=True, default=str)
+    except TypeError:
+        # Keys of different types can't be sorted. Using the insertion order, which is stable for the same input
+        encoded = json.dumps(items, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def hash_files(file_list):
+    """ Returns a hex digest of the content of the files in file_list. Missing files are hashed by name only.
+    """
+    digest = hashlib.sha256()
+    for file_name in file_list:
+        digest.update(file_name.encode("utf-8"))
+        try:
+            with open(file_name, "rb") as source_fh:
+                digest.update(source_fh.read())
+        except (IOError, OSError):
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+def get_source_files():
+    """ Returns the NeatSeq-Flow source files the scripts depend on, i.e. all .py files except the step modules.
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    source_files = list()
+    for sub_dir in ["", "modules", "script_constructors"]:
+        source_dir = os.path.join(package_dir, sub_dir)
+        source_files.extend(os.path.join(source_dir, file_name)
+                            for file_name
+                            in sorted(os.listdir(source_dir))
+                            if file_name.endswith(".py"))
+    return source_files
+
+
+class StepStatePickler(pickle.Pickler):
+    """ Pickles the state of a step. Objects that exist in every run (the steps, pipe_data, the index writer etc.) are
+        pickled by name. sample_data layers are pickled as plain dicts. Strings containing the run code are pickled as
+        their parts around it, so that a different run code can be put in when they are loaded.
+    """
+
+    def __init__(self, file, shared, run_code):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.shared = shared
+        self.run_code_re = get_run_code_re(run_code)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, str):
+            if self.run_code_re.search(obj):
+                return ("run_code_str", self.run_code_re.split(obj))
+            return None
+        if isinstance(obj, io.IOBase):
+            return ("closed_file",)
+        if id(obj) in self.shared:
+            return self.shared[id(obj)]
+        if isinstance(obj, SampleDataLayer):
+            return ("sample_data", obj.to_dict())
+        return None
+
+
+class StepStateUnpickler(pickle.Unpickler):
+    """ Resolves the references pickled by StepStatePickler
+    """
+
+    def __init__(self, file, shared, run_code):
+        pickle.Unpickler.__init__(self, file)
+        self.shared = shared
+        self.run_code = run_code
+
+    def persistent_load(self, pid):
+        if pid[0] == "run_code_str":
+            return self.run_code.join(pid[1])
+        if pid[0] == "closed_file":
+            closed_file = open(os.devnull, "w")
+            closed_file.close()
+            return closed_file
+        if pid[0] == "sample_data":
+            return SampleDataLayer([pid[1]])
+        return self.shared[pid]
+
+
+class StepCache(object):
+    """ Computes step fingerprints, restores unchanged steps and saves the steps built
+    """
+
+    def __init__(self, workflow):
+        """
+        :param workflow: The NeatSeqFlow object. Must define step_list, step_list_index, pipe_data, param_data,
+                         sample_data, index_writer and profiler. Must be created after the step instances, before building the scripts.
+        """
+        self.workflow = workflow
+        self.cache_dir = os.path.join(workflow.pipe_data["objects_dir"], "step_cache")
+        self.fingerprints = dict()  # {step name: fingerprint}
+        self.built = dict()         # {step name: shared file writes}, for the steps built in this run
+        self.restored = set()       # Names of the steps restored in this run, without changing the run code
+        self.restored_files = dict()    # {step name: script files}, for the steps restored with a new run code
+        self.run_code = workflow.pipe_data["run_code"]
+
+        pipe_data = {key: value for key, value in workflow.pipe_data.items() if key not in RUN_VOLATILE_KEYS}
+        self.global_fingerprint = hash_data(CACHE_FORMAT,
+                                            hash_files(get_source_files()),
+                                            workflow.param_data["Global"],
+                                            replace_run_code(pipe_data,
+                                                             get_run_code_re(self.run_code),
+                                                             RUN_CODE_PLACEHOLDER))
+        self.sample_data_fingerprint = hash_data(workflow.sample_data)
+
+        # Objects pickled by reference, as {id: persistent id}, and back:
+        self.shared_ids = {id(workflow.pipe_data): ("pipe_data",),
+                           id(workflow.index_writer): ("index_writer",),
+                           id(workflow.profiler): ("profiler",)}
+        for step_n in workflow.step_list:
+            self.shared_ids[id(step_n)] = ("step", step_n.get_step_name())
+        self.shared = {pid: obj
+                       for obj in [workflow.pipe_data, workflow.index_writer, workflow.profiler] + workflow.step_list
+                       for pid in [self.shared_ids[id(obj)]]}
+
+    def get_record_file(self, step_n):
+        return os.path.join(self.cache_dir, step_n.get_step_name() + ".pkl")
+
+    def get_fingerprint(self, step_n):
+        """ Returns the fingerprint of step_n. Must be called before the step is built, since building changes the
+            step's parameters.
+        """
+        name = step_n.get_step_name()
+        if name not in self.fingerprints:
+            base_name_list = step_n.get_base_step_name()
+            if base_name_list is None:
+                inputs = self.sample_data_fingerprint
+            else:
+                inputs = [self.get_fingerprint(self.workflow.step_list[self.workflow.step_list_index.index(base_name)])
+                          for base_name
+                          in base_name_list]
+            self.fingerprints[name] = hash_data(self.global_fingerprint,
+                                                name,
+                                                step_n.get_step_step(),
+                                                step_n.get_step_number(),
+                                                step_n.params,
+                                                hash_files([step_n.path]),
+                                                inputs)
+        return self.fingerprints[name]
+
+    def load_record(self, step_n):
+        """ Returns the saved record of step_n, or None if it does not exist or is unreadable.
+        """
+        try:
+            with open(self.get_record_file(step_n), "rb") as record_fh:
+                record = pickle.load(record_fh)
+        except Exception:
+            return None
+        if not isinstance(record, dict) or record.get("format") != CACHE_FORMAT:
+            return None
+        return record
+
+    def restore(self, step_n):
+        """ Restores step_n from its saved record, if its fingerprint has not changed and its scripts exist.
+            The step's writes to the shared files are stored in step_n.deferred_writes, to be written in order.
+
+        :return: True if the step was restored. False if it has to be built.
+        """
+        fingerprint = self.get_fingerprint(step_n)
+        record = self.load_record(step_n)
+        if record is None or record["fingerprint"] != fingerprint:
+            return False
+        old_run_code = record["run_code"]
+        if old_run_code != self.run_code:
+            if len(old_run_code) < MIN_RUN_CODE_LENGTH:
+                return False
+            run_code_re = get_run_code_re(old_run_code)
+            for key in ["writes", "files"]:
+                record[key] = replace_run_code(record[key], run_code_re, self.run_code)
+        script_index = self.workflow.pipe_data["script_index"]
+        for write in record["writes"]:
+            if write[0] == "append" and write[1] == script_index:
+                if not os.path.isfile(write[2].rstrip("\n").split("\t")[1]):
+                    return False
+        try:
+            state = StepStateUnpickler(io.BytesIO(record["state"]), self.shared, self.run_code).load()
+        except Exception:
+            return False
+
+        # The high-level and kill scripts were opened (and emptied) when the step instance was made.
+        # Closing them, and then writing their content from the previous run:
+        for value in list(vars(step_n).values()):
+            if hasattr(value, "__dict__"):
+                for attr in list(vars(value).values()):
+                    if isinstance(attr, io.IOBase):
+                        attr.close()
+        for file_name, content in record["files"].items():
+            with open(file_name, "w") as script_fh:
+                script_fh.write(content)
+
+        # Updating params in place, because the same dict is referenced by param_data:
+        step_n.params.clear()
+        step_n.params.update(state.pop("params"))
+        vars(step_n).update(state)
+        step_n.deferred_writes = list(record["writes"])
+        if old_run_code == self.run_code:
+            self.restored.add(step_n.get_step_name())
+        else:
+            self.replace_script_run_code(step_n.step_scripts_dir, run_code_re)
+            # The scripts are not open in the restored step. Saving their content as restored:
+            self.restored_files[step_n.get_step_name()] = record["files"]
+        step_n.write_warning("Step has not changed since the previous run. Reusing its scripts",
+                             admonition="ATTENTION")
+        return True
+
+    def replace_script_run_code(self, scripts_dir, run_code_re):
+        """ Replaces the run code of the previous run in the files in a step's scripts directory
+        """
+        for dir_path, dir_names, file_names in os.walk(scripts_dir):
+            for file_name in file_names:
+                script_file = os.path.join(dir_path, file_name)
+                with open(script_file, "r") as script_fh:
+                    content = script_fh.read()
+                new_content = run_code_re.sub(lambda match: self.run_code, content)
+                if new_content != content:
+                    with open(script_file, "w") as script_fh:
+                        script_fh.write(new_content)
+
+    def add_built_step(self, step_n, writes):
+        """ Stores the shared file writes of a step built in this run, for saving. Steps restored without changing the
+            run code are not saved again.
+        """
+        if step_n.get_step_name() not in self.restored:
+            self.built[step_n.get_step_name()] = writes
+
+    def save(self):
+        """ Saves the records of the steps built in this run. Must be called after the steps' script files are closed.
+        """
+        if not self.built:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for step_n in self.workflow.step_list:
+            name = step_n.get_step_name()
+            if name not in self.built:
+                continue
+            record_file = self.get_record_file(step_n)
+            temp_file = "{file}.{pid}".format(file=record_file, pid=os.getpid())
+            try:
+                files = self.restored_files.get(name)
+                if files is None:
+                    files = dict()
+                    for script_obj in [step_n.main_script_obj, step_n.kill_script_obj]:
+                        for attr in vars(script_obj).values():
+                            if isinstance(attr, io.IOBase):
+                                with open(attr.name, "r") as script_fh:
+                                    files[attr.name] = script_fh.read()
+                state = io.BytesIO()
+                StepStatePickler(state, self.shared_ids, self.run_code).dump(vars(step_n))
+                record = {"format": CACHE_FORMAT,
+                          "fingerprint": self.fingerprints[name],
+                          "run_code": self.run_code,
+                          "writes": self.built[name],
+                          "files": files,
+                          "state": state.getvalue()}
+                with open(temp_file, "wb") as record_fh:
+                    pickle.dump(record, record_fh, protocol=pickle.HIGHEST_PROTOCOL)
+                # Replacing in one step, so that an interrupted save never leaves a partial record
+                os.replace(temp_file, record_file)
+            except Exception as err:
+                # The step will be built in the next run
+                step_n.write_warning("Unable to save step for incremental building (%s)" % err)
+                for file_name in [temp_file, record_file]:
+                    if os.path.isfile(file_name):
+                        os.remove(file_name)
@@ -1,4 +1,10 @@
 """ Helper functions for parsing and interpolating variables in parameter file
+
+Variables are defined in the Vars section of the parameter file and referenced as {Vars.section.name}.
+The Vars section is compiled into a flat lookup table of variable names (e.g. "Vars.section.name") once. Each variable
+is expanded on first use, i.e. the variables it references are replaced with their values, and the expanded value is
+kept for later references. Strings are interpolated in one pass, and the results are memoized, since the same strings
+often appear in many steps.
 """
 
 __author__ = "Menachem Sklarz"
@@ -6,91 +12,127 @@ __version__ = "1.6.0"
 
 
 
-import re, sys, collections
+import re, sys
 from pprint import pprint as pp
 
+# Define a regular expression for variables (any contiguous alphanumeric or period between {})
+VAR_RE = re.compile("\{(Vars\.[\w\.\-]+?)\}")
+
+
+def flatten_vars(node, prefix="Vars", table=None):
+    """ Returns a flat lookup table of the variables in the Vars section: {"Vars.section.name": value}
+        Sections are included in the table as well, with their dict as value.
+    """
+    table = dict() if table is None else table
+    if isinstance(node, dict):
+        for key, value in node.items():
+            name = "%s.%s" % (prefix, key)
+            table[name] = value
+            flatten_vars(value, name, table)
+    return table
+
+
+class VarInterpolator(object):
+    """ Interpolates variables into strings, using a flat lookup table of the variables
+    """
+
+    def __init__(self, variables):
+        """
+        :param variables: The Vars section of the parameter file
+        """
+        self.table = flatten_vars(variables)
+        self.expanded = dict()      # {variable name: expanded value}
+        self.interpolated = dict()  # {string: interpolated string}
+        self.resolving = list()     # The variables being expanded, for detecting cyclic references
+
+    def get_value(self, name):
+        """ Returns the value of variable name, with the variables it references replaced.
+        """
+        if name in self.expanded:
+            return self.expanded[name]
+        if name not in self.table:
+            raise Exception("Unrecognised variable '%s'" % name, "Variables")
+        if name in self.resolving:
+            raise Exception("Cyclic variable reference: %s" %
+                            " -> ".join(self.resolving[self.resolving.index(name):] + [name]), "Variables")
+        value = self.table[name]
+        if isinstance(value, dict):
+            raise Exception("Variable '%s' is a section of variables, not a value" % name, "Variables")
+        if value is None:
+            value = ""
+        else:
+            # Also converting to str, in case value is int or float
+            value = str(value)
+            if "\\" in value:
+                # Values were always used as replacement templates, i.e. escapes such as \t are expanded.
+                value = VAR_RE.match("{%s}" % name).expand(value)
+        self.resolving.append(name)
+        try:
+            value = self.interpolate(value)
+        finally:
+            self.resolving.pop()
+        self.expanded[name] = value
+        return value
+
+    def interpolate(self, atom):
+        """ Returns atom with all variables replaced with their values
+        """
+        if "{Vars." not in atom:
+            return atom
+        if atom in self.interpolated:
+            return self.interpolated[atom]
+        result = VAR_RE.sub(lambda match: self.get_value(match.group(1)), atom)
+        # A value may complete a reference with the text around it (e.g. "{Vars.{Vars.name}}").
+        # Such references are replaced in further passes:
+        passes = {atom}
+        while VAR_RE.search(result):
+            if result in passes:
+                raise Exception("Cyclic variable reference in '%s'" % atom, "Variables")
+            passes.add(result)
+            result = VAR_RE.sub(lambda match: self.get_value(match.group(1)), result)
+        self.interpolated[atom] = result
+        return result
+
+
 # A closure:
-# Function make_interpol_func returns a function with a local copy of variables_bunch
-# The local copy is loc_variables_bunch, and is set as global so that eval will recognise it.
-def make_interpol_func(variables_bunch):
-    # Define a regular expression for variables (any contiguous alphanumeric or period between {})
-    var_re = re.compile("\{(Vars\.[\w\.\-]+?)\}")
-    global loc_variables_bunch
-    loc_variables_bunch = variables_bunch
-    
+# Function make_interpol_func returns a function interpolating the variables defined in variables (the Vars section)
+def make_interpol_func(variables):
+    interpolator = VarInterpolator(variables)
+
     # Define function to return:
     def interpol_atom(atom):
 
-        if isinstance(atom, str):
-
-            m = var_re.search(atom)
-            if not m:  # No variables match the atom
-                return atom
-
-            # While a match exists:
-            while (m):
-
-                try:
-                    # Replace the matched variable with something from variables_bunch
-                    # Also converting to str, in case value is int or float
-                    repl_str = eval("loc_variables_bunch.%s" % m.group(1))
-                    if repl_str is not None:
-                        repl_str = str(repl_str)
-                    else:
-                        repl_str = ""
-
-                    atom = var_re.sub(repl_str,atom,count=1)
-
-                except AttributeError:
-                    # If not found, raise exception
-                    raise Exception("Unrecognised variable '%s'" % m.group(1), "Variables")
-                except TypeError:
-                    raise Exception("A 'TypeError' exception has occured. This may happen when variables are left "
-                                    "empty. Make sure all your variables have values. ", "Variables")
-                m = var_re.search(atom)
-        if not atom:  # No variables match the atom
+        if not isinstance(atom, str) or "{Vars." not in atom or not VAR_RE.search(atom):
+            # No variables match the atom
+            return atom
+        atom = interpolator.interpolate(atom)
+        if not atom:  # Strings that are empty after interpolation are returned as None
             return None
 
         return atom
 
     return interpol_atom
 
-def walk(node, variables_bunch, callback):
-
+def walk(node, callback):
+    """ Applies callback to all strings in node, recursively walking dicts and lists
+    """
     if isinstance(node,dict):
         # Special case: The dict is actually a variable wrongly interpreted by the YAML parser as a dict!
-        if len(list(node.keys())) == 1 and list(node.values())==[None] and re.match("Vars\.([\w\.]+?)",list(node.keys())[0]):
-            node = callback("{%s}" % list(node.keys())[0])
+        keys = list(node.keys())
+        if len(keys) == 1 and isinstance(keys[0], str) and node[keys[0]] is None and \
+                re.match("Vars\.([\w\.]+?)", keys[0]):
+            node = callback("{%s}" % keys[0])
         else:
             for key, item in list(node.items()):
-                if isinstance(item, collections.Iterable):
-                    node[key] = walk(item, variables_bunch, callback)
-                elif isinstance(item, str):
-                    # node[key] = interpol_atom(item, variables_bunch)
-                    node[key] = callback(item)
-                else:
-                    # node[key] = item
-                    pass
+                node[key] = walk(item, callback)
     elif isinstance(node,list):
-        # print "in 2\n"
         for i in range(0,len(node)):
-            if isinstance(node[i], collections.Iterable):
-                node[i] = walk(node[i], variables_bunch, callback)
-            elif isinstance(node[i], str):
-                # node[i] = interpol_atom(node[i], variables_bunch)
-                node[i] = callback(node[i])
-            else:
-                pass
-    else:
-        # print "in 3\n"
-        if isinstance(node, str):
-            node = callback(node)
-        else:
-            pass
-#        raise Exception("walk() works on dicts and lists only")
+            node[i] = walk(node[i], callback)
+    elif isinstance(node, str):
+        node = callback(node)
     return node
 
-    
+
 def test_vars(node):
 
     if isinstance(node,dict):
@@ -113,3 +155,5 @@ def test_vars(node):
         pass
     else:
         raise Exception("ERROR: Unrecognised variable type (%s)" % node, "Variables")
+
+
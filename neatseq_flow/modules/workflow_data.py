@@ -0,0 +1,410 @@
+""" Writing and reading the compact WorkflowData.json
+
+The full encoding of a workflow (NeatSeqFlow.get_dict_encoding()) repeats the sample_data of every step, although
+most steps change only a few slots. The compact encoding stores:
+
+* The workflow sample_data, as read from the sample file.
+* For every step, its bases and its sample_data as a delta against the merged sample_data of its bases (or against
+  the workflow sample_data, for steps without bases). A delta is a dict with up to three keys: "+" for slots added or
+  replaced (with their full value), "~" for nested dicts that were changed (with their own delta), and "-" for a list
+  of deleted slots.
+* Directory prefixes of file paths in sample_data are stored once, in the "paths" list. Only absolute paths are
+  encoded, other strings are stored as is. A path is stored as {"@": [index in paths, rest of path]}. (A dict whose
+  only key is "@" or "@@" is stored as {"@@": dict}.)
+
+The compact encoding replaced the full encoding in version 1.6.0. Programs reading WorkflowData.json with json.load()
+must use WorkflowDataReader instead (WorkflowDataReader.to_dict() returns the full encoding). The file and the index
+start with "format" and "version" keys. The version is incremented whenever the encoding changes:
+
+* Version 1: The first compact encoding. Any string with a long directory prefix was encoded as a path.
+* Version 2: Only absolute paths are encoded.
+
+The reader reads all versions up to FORMAT_VERSION.
+
+The file is written one sample and one step at a time, and the position of each part is stored in an index file
+(WorkflowData.index.json), so that the WorkflowDataReader can load a single step or sample without parsing the whole
+file. The reader also reads the full encoding used by previous versions.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import os
+import json
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .sample_data_layer import SampleDataLayer, get_value, get_changed_keys
+
+
+FORMAT = "NeatSeq-Flow compact"
+FORMAT_VERSION = 2
+
+# Shorter directory prefixes are stored as is. A reference is not much shorter.
+MIN_PREFIX_LENGTH = 16
+
+
+def get_index_file(filename):
+    """ Returns the name of the index file for filename, e.g. WorkflowData.index.json for WorkflowData.json
+    """
+    return "{base}.index.json".format(base=os.path.splitext(filename)[0])
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Encoding
+
+def is_path(value):
+    """ Returns True if the string value is stored as a path: An absolute path on a single line
+    """
+    return os.path.isabs(value) and "\n" not in value
+
+
+class PathTable(object):
+    """ Stores each directory prefix once and encodes paths as references to the stored prefix
+    """
+
+    def __init__(self):
+        self.paths = list()
+        self.path_index = dict()
+
+    def encode(self, value):
+        """ Returns value ready for JSON encoding, with paths replaced by references
+        """
+        if isinstance(value, str):
+            if not is_path(value):
+                return value
+            sep_pos = value.rfind(os.sep) + 1
+            if sep_pos < MIN_PREFIX_LENGTH:
+                return value
+            prefix = value[:sep_pos]
+            if prefix not in self.path_index:
+                self.path_index[prefix] = len(self.paths)
+                self.paths.append(prefix)
+            return {"@": [self.path_index[prefix], value[sep_pos:]]}
+        if isinstance(value, Mapping):
+            encoded = {key: self.encode(value[key]) for key in value}
+            if len(encoded) == 1 and ("@" in encoded or "@@" in encoded):
+                return {"@@": encoded}
+            return encoded
+        if isinstance(value, (list, tuple)):
+            return [self.encode(element) for element in value]
+        return value
+
+
+def decode(value, paths):
+    """ Reverses PathTable.encode()
+    """
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if "@" in value:
+                return paths[value["@"][0]] + value["@"][1]
+            if "@@" in value:
+                return {key: decode(element, paths) for key, element in value["@@"].items()}
+        return {key: decode(element, paths) for key, element in value.items()}
+    if isinstance(value, list):
+        return [decode(element, paths) for element in value]
+    return value
+
+
+def get_delta(new, base, path_table):
+    """ Returns the delta turning base into new (see module docstring), with values encoded by path_table.
+    """
+    added = dict()
+    changed = dict()
+    keys, deleted = get_changed_keys(new, base)
+    for key in keys:
+        new_value = get_value(new, key)
+        if key not in base:
+            added[key] = path_table.encode(new_value)
+            continue
+        base_value = get_value(base, key)
+        if isinstance(new_value, Mapping) and isinstance(base_value, Mapping):
+            sub_delta = get_delta(new_value, base_value, path_table)
+            if sub_delta:
+                changed[key] = sub_delta
+        elif new_value != base_value or type(new_value) != type(base_value):
+            added[key] = path_table.encode(new_value)
+    delta = dict()
+    if added:
+        delta["+"] = added
+    if changed:
+        delta["~"] = changed
+    if deleted:
+        delta["-"] = deleted
+    return delta
+
+
+class OffsetWriter(object):
+    """ Writes text to a binary file handle, keeping track of the position
+    """
+
+    def __init__(self, file_handle):
+        self.file_handle = file_handle
+        self.position = 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.file_handle.write(data)
+        self.position += len(data)
+
+    def write_json(self, obj):
+        """ Writes obj as JSON and returns its [position, length] in the file
+        """
+        start = self.position
+        self.write(json.dumps(obj, separators=(",", ":")))
+        return [start, self.position - start]
+
+
+def write_workflow_data(filename, sample_data, pipe_data, global_params, step_list):
+    """ Writes the compact encoding of a workflow to filename, and its index to the index file.
+
+    :param sample_data: The workflow sample_data
+    :param pipe_data: The pipe_data to store
+    :param global_params: The Global parameters
+    :param step_list: The steps, in order. Steps not built yet are stored without sample_data.
+    """
+    path_table = PathTable()
+    index = {"format": FORMAT,
+             "version": FORMAT_VERSION,
+             "sample_data": dict(),
+             "step_data": dict()}
+    step_sample_data = dict()   # {step name: sample_data}, for computing the deltas of following steps
+
+    with open(filename, "wb") as json_fh:
+        writer = OffsetWriter(json_fh)
+        writer.write('{"format":%s,"version":%d,"pipe_data":' % (json.dumps(FORMAT), FORMAT_VERSION))
+        index["pipe_data"] = writer.write_json(pipe_data)
+        writer.write(',"global_params":')
+        index["global_params"] = writer.write_json(global_params)
+
+        writer.write(',"sample_data":{')
+        for num, key in enumerate(sample_data):
+            writer.write(("," if num else "") + json.dumps(key) + ":")
+            index["sample_data"][key] = writer.write_json(path_table.encode(sample_data[key]))
+
+        writer.write('},"step_data":{')
+        for num, step_n in enumerate(step_list):
+            name = step_n.get_step_name()
+            base_name_list = step_n.get_base_step_name()
+            step_sample_data[name] = getattr(step_n, "sample_data", None)
+            if step_sample_data[name] is None:
+                delta = None
+            else:
+                if base_name_list is None:
+                    base_sample_data = SampleDataLayer([sample_data])
+                else:
+                    base_sample_data = SampleDataLayer([step_sample_data[base_name]
+                                                        if step_sample_data.get(base_name) is not None
+                                                        else dict()
+                                                        for base_name
+                                                        in base_name_list])
+                delta = get_delta(step_sample_data[name], base_sample_data, path_table)
+            writer.write(("," if num else "") + json.dumps(name) + ":")
+            index["step_data"][name] = writer.write_json({"bases": base_name_list,
+                                                          "sample_data": delta,
+                                                          "param_data": step_n.params})
+        writer.write('},"paths":')
+        index["paths"] = writer.write_json(path_table.paths)
+        writer.write('}')
+        index["size"] = writer.position
+
+    with open(get_index_file(filename), "w") as index_fh:
+        json.dump(index, index_fh, separators=(",", ":"))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Reading
+
+class DeltaView(Mapping):
+    """ A read-only view of a mapping with a delta applied. Nested deltas are applied when their slot is read.
+    """
+
+    def __init__(self, base, delta, paths):
+        self.base = base
+        self.delta = delta
+        self.paths = paths
+
+    def __getitem__(self, key):
+        if key in self.delta.get("+", {}):
+            return decode(self.delta["+"][key], self.paths)
+        if key in self.delta.get("-", []):
+            raise KeyError(key)
+        value = get_value(self.base, key)
+        if key in self.delta.get("~", {}):
+            return DeltaView(value, self.delta["~"][key], self.paths)
+        return value
+
+    def __iter__(self):
+        deleted = set(self.delta.get("-", []))
+        for key in self.base:
+            if key not in deleted:
+                yield key
+        for key in self.delta.get("+", {}):
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __contains__(self, key):
+        if key in self.delta.get("+", {}):
+            return True
+        return key not in self.delta.get("-", []) and key in self.base
+
+
+def to_plain(value):
+    """ Converts Mappings (views and layers) to dicts, recursively
+    """
+    if isinstance(value, Mapping):
+        return {key: to_plain(get_value(value, key)) for key in value}
+    if isinstance(value, list):
+        return [to_plain(element) for element in value]
+    return value
+
+
+class LazySampleData(Mapping):
+    """ The workflow sample_data, loading each slot (e.g. a sample) from the file when it is first read
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.data = dict()
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            self.data[key] = decode(self.reader.load("sample_data", key), self.reader.get_paths())
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.reader.get_keys("sample_data"))
+
+    def __len__(self):
+        return len(self.reader.get_keys("sample_data"))
+
+    def __contains__(self, key):
+        return key in self.reader.get_keys("sample_data")
+
+
+class WorkflowDataReader(object):
+    """ Reads WorkflowData.json, loading only the parts requested.
+
+    Usage::
+
+        reader = WorkflowDataReader("objects/WorkflowData.json")
+        reader.get_step_names()
+        reader.get_step_sample_data("Merge_reads", "Sample1")   # The data of one sample in one step
+        reader.get_step("Merge_reads")                          # {"sample_data": ..., "param_data": ...}
+        reader.to_dict()                                        # The full encoding
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = None
+        self.data = None        # The whole file, when there is no index or the file has the full encoding
+        self.paths = None
+        self.step_views = dict()
+
+        index_file = get_index_file(filename)
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as index_fh:
+                index = json.load(index_fh)
+            # Using the index only if it was written with the current file:
+            if index.get("format") == FORMAT and index.get("size") == os.path.getsize(filename):
+                self.index = index
+        if self.index is None:
+            with open(filename, "r") as json_fh:
+                self.data = json.load(json_fh)
+        self.compact = self.index is not None or self.data.get("format") == FORMAT
+        if self.compact:
+            version = (self.index if self.index is not None else self.data).get("version", 1)
+            if version > FORMAT_VERSION:
+                raise ValueError("{file} was written in version {version} of the compact format. This version of "
+                                 "NeatSeq-Flow reads versions up to {max}".format(file=filename,
+                                                                                  version=version,
+                                                                                  max=FORMAT_VERSION))
+        self.sample_data = LazySampleData(self) if self.compact else self.data["sample_data"]
+
+    def load(self, section, key=None):
+        """ Returns the undecoded JSON of section (e.g. pipe_data), or of key in section (e.g. a step in step_data)
+        """
+        if self.data is not None:
+            return self.data[section] if key is None else self.data[section][key]
+        position, length = self.index[section] if key is None else self.index[section][key]
+        with open(self.filename, "rb") as json_fh:
+            json_fh.seek(position)
+            return json.loads(json_fh.read(length).decode("utf-8"))
+
+    def get_keys(self, section):
+        """ Returns the keys of section (sample_data or step_data), in order
+        """
+        return list(self.index[section] if self.data is None else self.data[section])
+
+    def get_paths(self):
+        if self.paths is None:
+            self.paths = self.load("paths") if self.compact else list()
+        return self.paths
+
+    def get_pipe_data(self):
+        return self.load("pipe_data")
+
+    def get_global_params(self):
+        return self.load("global_params")
+
+    def get_sample_data(self, key=None):
+        """ Returns the workflow sample_data, or only one slot of it, e.g. one sample or 'project_data'
+        """
+        return to_plain(self.sample_data if key is None else self.sample_data[key])
+
+    def get_step_names(self):
+        return self.get_keys("step_data")
+
+    def get_step_view(self, name):
+        """ Returns a read-only Mapping of the sample_data of step 'name', or None if the step was not built
+        """
+        if name not in self.step_views:
+            record = self.load("step_data", name)
+            if record["sample_data"] is None:
+                view = None
+            elif not self.compact:
+                view = record["sample_data"]
+            else:
+                if record["bases"] is None:
+                    base = self.sample_data
+                else:
+                    base = SampleDataLayer([self.get_step_view(base_name)
+                                            if self.get_step_view(base_name) is not None
+                                            else dict()
+                                            for base_name
+                                            in record["bases"]])
+                view = DeltaView(base, record["sample_data"], self.get_paths())
+            self.step_views[name] = view
+        return self.step_views[name]
+
+    def get_step_sample_data(self, name, key=None):
+        """ Returns the sample_data of step 'name', or only one slot of it, e.g. one sample or 'project_data'
+        """
+        view = self.get_step_view(name)
+        if view is None:
+            return None
+        return to_plain(view if key is None else get_value(view, key))
+
+    def get_step_params(self, name):
+        return self.load("step_data", name)["param_data"]
+
+    def get_step(self, name):
+        """ Returns the data of step 'name' as in the full encoding: {"sample_data": ..., "param_data": ...}
+        """
+        return {"sample_data": self.get_step_sample_data(name),
+                "param_data": self.get_step_params(name)}
+
+    def to_dict(self):
+        """ Returns the full encoding of the workflow (see NeatSeqFlow.get_dict_encoding())
+        """
+        return {"sample_data": self.get_sample_data(),
+                "pipe_data": self.get_pipe_data(),
+                "global_params": self.get_global_params(),
+                "step_data": {name: self.get_step(name) for name in self.get_step_names()}}
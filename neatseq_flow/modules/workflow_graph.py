@@ -0,0 +1,152 @@
+""" Functions for ordering workflow steps and expanding their dependencies
+
+The workflow is a DAG in which each step points at its base steps. The functions here compute a deterministic
+topological order of the steps and the full set of ancestors of each step in time linear in steps plus edges.
+"""
+
+__author__ = "Menachem Sklarz"
+__version__ = "1.6.0"
+
+
+import heapq
+
+
+def bit_count(bits):
+    """ Returns the number of set bits in an int (int.bit_count() is not available in older pythons)
+    """
+    return bin(bits).count("1")
+
+
+def get_topological_order(depend_dict):
+    """ Sorts the steps in depend_dict so that every step comes after all of its bases.
+
+    Uses Kahn's algorithm. Ancestor sets are accumulated as bitsets while walking the graph, so that the ready steps
+    can be released in order of (number of ancestors, step name). Since a step always has more ancestors than any of
+    its bases, this is the same 'by level' order the steps were always sorted by, and it is deterministic.
+
+    :param depend_dict: dict of the form {step_name: [base names]}. Empty names ("" for Import) are ignored.
+    :return: A tuple: (list of step names in topological order, dict of {step_name: ancestor bitset},
+             sorted list of step names. Bit i in the bitsets stands for step i in this list).
+             Steps caught in cycles, and steps downstream of them, are not included in the order.
+    """
+    names = sorted(depend_dict)
+    bit_index = {name: 1 << ind for ind, name in enumerate(names)}
+
+    bases = {name: set(base for base in depend_dict[name] if base) for name in names}
+    dependents = {name: list() for name in names}
+    for name in names:
+        for base in bases[name]:
+            dependents[base].append(name)
+    missing = {name: len(bases[name]) for name in names}
+
+    ancestors = dict()
+    ready = list()
+    for name in names:
+        if not missing[name]:
+            ancestors[name] = 0
+            ready.append((0, name))
+    heapq.heapify(ready)
+
+    order = list()
+    while ready:
+        _, name = heapq.heappop(ready)
+        order.append(name)
+        for dependent in dependents[name]:
+            missing[dependent] -= 1
+            if not missing[dependent]:
+                # All bases are done, so the ancestor set is complete:
+                dep_bits = 0
+                for base in bases[dependent]:
+                    dep_bits |= ancestors[base] | bit_index[base]
+                ancestors[dependent] = dep_bits
+                heapq.heappush(ready, (bit_count(dep_bits), dependent))
+
+    return order, ancestors, names
+
+
+def get_cyclic_steps(depend_dict, skip=None):
+    """ Returns the steps which are part of a dependency cycle, i.e. which depend on themselves.
+
+    Uses an iterative version of Tarjan's strongly connected components algorithm. Steps downstream of a cycle are not
+    reported, only the steps on it.
+
+    :param depend_dict: dict of the form {step_name: [base names]}
+    :param skip: Optional collection of step names known not to be on a cycle (e.g. the ones already ordered)
+    :return: Sorted list of step names
+    """
+    skip = set(skip) if skip else set()
+    graph = {name: [base for base in depend_dict[name] if base and base not in skip]
+             for name in depend_dict
+             if name not in skip}
+
+    index = dict()
+    lowlink = dict()
+    on_stack = set()
+    stack = list()
+    counter = 0
+    cyclic = list()
+
+    for root in sorted(graph):
+        if root in index:
+            continue
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph[child])))
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = list()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in graph[node]:
+                    cyclic.extend(component)
+
+    return sorted(cyclic)
+
+
+def expand_dependencies(depend_dict):
+    """ Computes the full list of ancestors for every step.
+
+    :param depend_dict: dict of the form {step_name: [base names]}
+    :return: A tuple: (dict of {step_name: [ancestor names]}, list of step names in topological order,
+             list of steps on cycles). Ancestor lists are given in topological order.
+             If there are cycles, the dict and order are only partial.
+    """
+    order, ancestors, names = get_topological_order(depend_dict)
+
+    if len(order) < len(names):
+        return None, order, get_cyclic_steps(depend_dict, skip=order)
+
+    position = {name: ind for ind, name in enumerate(order)}
+    expanded = dict()
+    for name in order:
+        ancestor_list = list()
+        bits = ancestors[name]
+        while bits:
+            lowest = bits & -bits
+            ancestor_list.append(names[lowest.bit_length() - 1])
+            bits ^= lowest
+        expanded[name] = sorted(ancestor_list, key=position.get)
+
+    return expanded, order, []
@@ -1,8 +1,10 @@
 import os
 import sys
 import re
+import shutil
 
 from ..PLC_step import AssertionExcept
+from ..modules import event_log
 
 from pprint import pprint as pp
 
@@ -165,18 +167,20 @@ locksed() {{
 Checkresources() {{
     # $1: sed command
     # $2: file
-    # $3: needed resources
-    # $4: max resource
+    # $3: needed cpus
+    # $4: max cpus
+    # $5: needed memory (MB)
+    # $6: max memory (MB). 0 for no limit
     ok2run=-1
     sedlock=${{2}}.lock
     exec 200>$sedlock
     flock -w 0.1 200 || ok2run=0
     if (( $ok2run != 0 )); then
         # flock -w 4002 200 || exit 1
-        # Check for resources used
-        cpu_used=$(grep -v "^#" $2 | awk '{{ SUM += $4}} END {{ print SUM }}' )
+        # Check for resources used (cpus and memory are the 4th and 5th columns of running jobs)
+        used=($(grep -v "^#" $2 | awk '{{ CPUS += $4; MEM += $5 }} END {{ print CPUS+0, MEM+0 }}' ))
         # Check for available resources 
-        if [ $(($cpu_used + $3)) -le $4 ]; then
+        if [ $((${{used[0]}} + $3)) -le $4 ] && {{ [ ${{6:-0}} -eq 0 ] || [ $((${{used[1]}} + ${{5:-0}})) -le $6 ]; }}; then
             # echo do sed 
                 sed -i -e "$1" $2
             ok2run=1
@@ -193,7 +197,8 @@ runlock() {{
     # $1: qsubname
     # $2: file
     # $3: shell command
-    # $4: needed resources
+    # $4: needed cpus
+    # $5: needed memory (MB)
     # Setting script as done in run index:
     sedlock=${{2}}.lock
     exec 200>$sedlock
@@ -207,7 +212,7 @@ runlock() {{
     fi
 
     # echo do sed 
-    sed -i -e "s:\($1\).*$:\\1\\tPID\\t$!\\t$4:"  $2
+    sed -i -e "s:\($1\).*$:\\1\\tPID\\t$!\\t$4\\t$5:"  $2
     
     # echo unlock
     flock -u 200
@@ -218,8 +223,139 @@ runlock() {{
            qstat_path=pipe_data["qsub_params"]["qstat_path"],
            run_index=pipe_data["run_index"])
 
+        if "event_log" in pipe_data:
+            script += cls.get_event_log_funcs(pipe_data)
+
         return script
 
+    @classmethod
+    def get_event_log_funcs(cls, pipe_data):
+        """ Returns the helper functions for appending the job events to the event log instead of writing them to
+            the log file under a lock ('event_log: jsonl', see modules/event_log.py). They replace log_echo and
+            func_trap, and keep their entry points for the inheriting classes.
+        """
+        signal_codes = " ".join("{sig}) exit_code={code};;".format(sig=sig, code=code)
+                                for sig, code in sorted(event_log.SIGNAL_EXIT_CODES.items()))
+        return """
+# The events of the jobs are appended to {event_log} (see event_log.py).
+# The following functions replace the ones writing to the log file:
+
+event_echo() {{
+    # $1: type (Started/Finished)
+    # $2: module
+    # $3: instance
+    # $4: instance_id
+    # $5: level
+    # $6: hostname
+    # $7: jobid
+    # $8: maxvmem
+    # $9: status
+    # $10: exit code (Finished only)
+    local now=${{EPOCHREALTIME/,/.}}
+    if [ -z "$now" ]; then
+        now=$(date '+%s.%6N')
+    fi
+    local now_us=$((10#${{now/./}}))
+    local extra=""
+    if [ $1 == 'Started' ]; then
+        NSF_EVENT_START=$now_us
+    else
+        extra=', "exit_code": '${{10:-0}}
+        if [ -n "$NSF_EVENT_START" ]; then
+            local duration=$(($now_us - $NSF_EVENT_START))
+            printf -v duration ', "duration": %d.%06d' $(($duration / 1000000)) $(($duration % 1000000))
+            extra+=$duration
+        fi
+    fi
+    local fields=() field
+    for field in "${{@:2:7}}"; do
+        field=${{field//\\\\/\\\\\\\\}}
+        fields+=("${{field//\\"/\\\\\\"}}")
+    done
+    local line
+    printf -v line '{{"time": %s, "event": "%s", "module": "%s", "instance": "%s", "job": "%s", "level": "%s", "host": "%s", "jobid": "%s", "maxvmem": "%s", "status": "%s"%s}}\\n' \\
+        $now $1 "${{fields[@]}}" $9 "$extra"
+    # A single write to a file opened for appending. Lines written by concurrent jobs are not interleaved:
+    printf '%s' "$line" >> {event_log}
+}}
+
+func_trap() {{
+    # $1: module
+    # $2: instance
+    # $3: instance_id
+    # $4: level
+    # $5: hostname
+    # $6: jobid
+    # $7: sig
+    exit_code=$?
+    jobid=$6
+
+    ## maxvmem calc entry point
+
+    if [ $7 == 'ERR' ]; then err_code='ERROR'; fi
+    if [ $7 == 'INT' ]; then err_code='TERMINATED'; fi
+    if [ $7 == 'TERM' ]; then err_code='TERMINATED'; fi
+    if [ $7 == 'SIGUSR2' ]; then err_code='TERMINATED'; fi
+    case $7 in {signal_codes} esac
+
+    event_echo Finished $1 $2 $3 $4 $5 $6 "$maxvmem" $err_code $exit_code
+    ## locksed command entry point
+    exit 1;
+}}
+
+log_echo() {{
+    # $1: module
+    # $2: instance
+    # $3: instance_id
+    # $4: level
+    # $5: hostname
+    # $6: jobid
+    # $7: type (Started/Finished)
+    jobid=$6
+
+    if [ $7 == 'Finished' ]; then
+        ## maxvmem calc entry point
+    else
+        maxvmem="-";
+    fi
+
+    if [ $jobid == 'ND' ]; then
+        jobid=$$
+    fi
+
+    event_echo $7 $1 $2 $3 $4 $5 $jobid "$maxvmem" OK 0
+}}
+
+""".format(event_log=pipe_data["event_log_file"],
+           signal_codes=signal_codes)
+
+    @classmethod
+    def get_module_command(cls, module):
+        """ Returns the command executing one of the modules in neatseq_flow/modules as a script, e.g. run_state.
+            The python interpreter and the package are found when the command is executed: The module is executed with
+            'python3 -m' (or $NSF_PYTHON, if set), so neatseq_flow is looked up on the PYTHONPATH and among the
+            installed packages. The directory neatseq_flow was imported from when the workflow was generated is
+            appended to the PYTHONPATH, as a fallback for running from a checkout.
+        """
+        package_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        return "env PYTHONPATH=${{PYTHONPATH:+$PYTHONPATH:}}{package_dir} ${{NSF_PYTHON:-python3}} " \
+               "-m neatseq_flow.modules.{module}".format(package_dir=package_dir, module=module)
+
+    @classmethod
+    def get_event_log_script(cls, pipe_data):
+        """ Returns the script for writing the log file from the event log
+        """
+        return """\
+#!/bin/bash
+# Write the log file {log_file} from the event log {event_log}. Usage:
+#   NSF_event_log.sh            Write the log file once
+#   NSF_event_log.sh --follow   Keep adding the new events to the log file, e.g. while monitoring the run
+
+exec {event_log_module} --events {event_log} --log_file {log_file} "$@"
+""".format(event_log_module=cls.get_module_command("event_log"),
+           event_log=pipe_data["event_log_file"],
+           log_file=pipe_data["log_file"])
+
     @classmethod
     def get_exec_script(cls, pipe_data):
         """ Returns the code for the helper script
@@ -263,11 +399,25 @@ locksed "s:# \($qsubname\).*:\\1\\thold:" $run_index
 
 # Getting script needed resources 
 # local NCPUS=$(nproc)
-# local NCPUS=$( echo "0.8*$NCPUS/1" | bc )
-# local pe=$(grep '#$ -pe' $script_path | grep -o '[0-9]*')
+# local NMEM=$(awk '/^MemTotal:/ {{print int($2/1024)}}' /proc/meminfo 2> /dev/null)
+# local NMEM=${{NMEM:-0}}
+# local pe=$(grep '#$ -pe' $script_path | awk '{{print $NF}}' | grep -o '^[0-9]*')
 # local if [[ -z "$pe" ]]; then
 # local     pe=0
 # local fi
+# local mem=$(grep '#$ -mem' $script_path | awk '{{print $NF}}' | grep -o '^[0-9]*')
+# local if [[ -z "$mem" ]]; then
+# local     mem=0
+# local fi
+# local # Jobs requesting more than the node has would never run. Waiting for the whole node instead:
+# local if (( $pe > $NCPUS )); then
+# local     echo "The job requests $pe CPUs, but only $NCPUS are available. Waiting for all of them to be free."
+# local     pe=$NCPUS
+# local fi
+# local if (( $NMEM > 0 && $mem > $NMEM )); then
+# local     echo "The job requests ${{mem}}MB memory, but only ${{NMEM}}MB are available. Waiting for all of it to be free."
+# local     mem=$NMEM
+# local fi
 
 # 3. Getting script dependencies
 
@@ -324,7 +474,7 @@ do
     # echo "Overlap: $overlap"
     if (( $overlap == 0 )); then
         # Check for available resources 
-        # local if (( $(Checkresources "s:\($qsubname\).*$:\\1\\tPID\\t$$\\t$pe:" $run_index $pe $NCPUS) == 1 )); then
+        # local if (( $(Checkresources "s:\($qsubname\).*$:\\1\\tPID\\t$$\\t$pe\\t$mem:" $run_index $pe $NCPUS $mem $NMEM) == 1 )); then
             flag=1
         # local fi
     fi
@@ -341,8 +491,102 @@ done
            run_index=pipe_data["run_index"],
            helper_funcs=pipe_data["helper_funcs"])
 
+        if "run_state" in pipe_data:
+            script = script.replace('running=$(grep -v "^#" $run_index)', 'running=$(run_state_active)')
+
         return script
 
+    @classmethod
+    def get_run_state_funcs(cls, pipe_data):
+        """ Returns the helper functions for keeping the run state in an SQLite database instead of run_index
+            ('run_state: sqlite', see modules/run_state.py). They replace the functions defined above, and are
+            appended to the helper script by the executors tracking the jobs in run_index.
+        """
+        # Imported here, so that the sqlite3 module is loaded only with 'run_state: sqlite'
+        from ..modules import run_state
+        sqlite3 = shutil.which("sqlite3")
+        if sqlite3:
+            # Read by every waiting job every few seconds. The sqlite3 program is much quicker to start than python:
+            active_cmd = '{sqlite3} -cmd ".timeout {timeout}" {db} "SELECT name FROM run_index WHERE active = 1"'.\
+                format(sqlite3=sqlite3, timeout=run_state.BUSY_TIMEOUT * 1000, db=pipe_data["run_state_db"])
+        else:
+            active_cmd = "run_state active"
+
+        return """
+# The run state is kept in {db} (see run_state.py).
+# The following functions replace the ones updating and reading run_index:
+
+run_state() {{
+    {run_state} --db {db} --run_index {run_index} "$@"
+}}
+
+run_state_active() {{
+    # Print the names of the active jobs
+    {active_cmd}
+}}
+
+locksed() {{
+    # $1: sed command
+    run_state sed "$1"
+}}
+
+Checkresources() {{
+    # $1: sed command
+    # $2: file (not used)
+    # $3: needed cpus
+    # $4: max cpus
+    # $5: needed memory (MB)
+    # $6: max memory (MB). 0 for no limit
+    run_state reserve "$1" $3 $4 ${{5:-0}} ${{6:-0}}
+}}
+
+runlock() {{
+    # $1: qsubname
+    # $2: file (not used)
+    # $3: shell command
+    # $4: needed cpus
+    # $5: needed memory (MB)
+    iscsh=$(grep "csh" <<< $3)
+    if [ -z $iscsh ]; then
+        bash $3 &
+    else
+        csh $3 &
+    fi
+    # Only if still active. The script may have finished already:
+    run_state sed "s:^\\($1\\).*$:\\1\\tPID\\t$!\\t$4\\t$5:"
+}}
+
+""".format(run_state=cls.get_module_command("run_state"),
+           db=pipe_data["run_state_db"],
+           run_index=pipe_data["run_index"],
+           active_cmd=active_cmd)
+
+    @classmethod
+    def get_run_state_script(cls, pipe_data):
+        """ Returns the script for using the run state database from the command line and from the scripts
+        """
+        return """\
+#!/bin/bash
+# The run state of the workflow, kept in {db}. Usage:
+#   NSF_run_state.sh export     Write the run state to {run_index}
+#   NSF_run_state.sh active     List the active jobs
+# For all commands, run 'NSF_run_state.sh --help'
+
+exec {run_state} --db {db} --run_index {run_index} "$@"
+""".format(run_state=cls.get_module_command("run_state"),
+           db=pipe_data["run_state_db"],
+           run_index=pipe_data["run_index"])
+
+    @classmethod
+    def get_run_state_clean_script(cls, pipe_data):
+        """ Returns the run_index cleaning script for runs keeping the run state in a database
+        """
+        return """\
+#!/bin/bash
+bash {script} clean
+bash {script} export
+""".format(script=pipe_data["run_state_script"])
+
 # ----------------------------------------------------------------
 # Instance methods
 # ----------------------------------------------------------------
@@ -494,6 +738,13 @@ while [[ $lc -lt 10 ]]; do if source {activate_path} {environ}; then break; else
         """
         return("rm -rf {dir}*\n".format(dir=self.master.base_dir))
 
+    def get_index_lines_command(self, prefix):
+        """ Returns the command printing the run_index lines of the active jobs whose name starts with prefix
+        """
+        if "run_state" in self.pipe_data:
+            return "bash {script} lines '{prefix}'".format(script=self.pipe_data["run_state_script"], prefix=prefix)
+        return "grep '^{prefix}' {run_index}".format(prefix=prefix, run_index=self.pipe_data["run_index"])
+
     def write_command(self, command):
     
         self.filehandle.write(command)
@@ -575,6 +826,46 @@ trap '' ERR
 
         return ""
 
+    def get_task_command(self, script_obj):
+        """ Returns the lines submitting a low level script collected for bundling or array jobs, which is either a
+            task script (see TaskScriptConstructor) or a script left on its own.
+            By default, the script is submitted like any other low level script.
+        """
+
+        return self.get_child_command(script_obj)
+
+    def get_queue_tasks_command(self, script_obj):
+        """ Returns the lines marking the tasks of a task script as queued in run_index, so that jobs depending on
+            the tasks wait until they are done (Each task marks itself as done in run_index).
+            For executors which track the jobs in run_index. Returns an empty string for other low level scripts.
+        """
+
+        if not isinstance(script_obj, TaskScriptConstructor):
+            return ""
+
+        if "run_state" in self.pipe_data:
+            return """
+# Marking the tasks of {script_id} as queued in run state:
+bash {run_state_script} queue {task_tables}
+""".format(script_id=script_obj.script_id,
+           task_tables=" ".join(script_obj.get_task_tables()),
+           run_state_script=self.pipe_data["run_state_script"])
+
+        return """
+# Marking the tasks of {script_id} as queued in run index:
+exec 200>{run_index}.lock
+flock -w 4003 200 || exit 1
+awk -v run_index={run_index} \\
+    'BEGIN {{FS=OFS="\\t"}}
+     FILENAME != run_index {{tasks["# "$1]=1; next}}
+     $1 in tasks {{print substr($1,3), "queued"; next}}
+     {{print}}' {task_tables} {run_index} > {run_index}.tmp
+mv {run_index}.tmp {run_index}
+flock -u 200
+""".format(script_id=script_obj.script_id,
+           task_tables=" ".join(script_obj.get_task_tables()),
+           run_index=self.pipe_data["run_index"])
+
 
 # ----------------------------------------------------------------------------------
 # LowScriptConstructor defintion
@@ -748,6 +1039,136 @@ flock -u 230\n""".format(kill_cmd = re.escape(kill_cmd),
         return script
         
         
+# ----------------------------------------------------------------------------------
+# TaskScriptConstructor defintion
+# ----------------------------------------------------------------------------------
+
+
+class TaskScriptConstructor(LowScriptConstructor):
+    """ A script running other low level scripts of the step (its tasks).
+        The tasks are listed in a task table, one per line, with their script_id and script path.
+        The task scripts are the regular low level scripts, so each task writes its own log lines.
+    """
+
+    def __init__(self, **kwargs):
+
+        super(TaskScriptConstructor, self).__init__(**kwargs)
+
+        self.tasks = kwargs["tasks"]
+        self.task_table = os.path.splitext(self.script_path)[0] + ".tasks"
+
+    def get_task_tables(self):
+        """ Returns the task tables of this script and of its tasks which are task scripts themselves
+        """
+
+        task_tables = [self.task_table]
+        for task in self.tasks:
+            if isinstance(task, TaskScriptConstructor):
+                task_tables.extend(task.get_task_tables())
+        return task_tables
+
+    def get_task_header(self):
+        """ Returns lines to add to the script header. Override in inheriting classes.
+        """
+
+        return ""
+
+    def get_task_code(self):
+        """ Returns the code running the tasks. Override in inheriting classes.
+        """
+
+        raise AssertionExcept("Task scripts are not defined for executor %s" % self.pipe_data["Executor"],
+                              step=self.name)
+
+    def write_script(self):
+        """ Writes the task table and the script
+        """
+
+        with open(self.task_table, "w") as table_fh:
+            for task in self.tasks:
+                table_fh.write("{script_id}\t{script_path}\n".format(script_id=task.script_id,
+                                                                       script_path=task.script_path))
+
+        self.write_command("\n".join([self.get_script_preamble().rstrip("\n"),
+                                      self.get_task_header(),
+                                      self.get_task_code()]))
+
+
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructor defintion
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructor(TaskScriptConstructor):
+    """ A script running the tasks as a single array job. Each task of the array executes the script in the line of
+        its task number in the task table.
+        Executors supporting array jobs define get_task_header() and the variable holding the task number.
+        The array script replaces itself with the task script (exec), so executor specific closing lines of low level
+        scripts are not added. Inheriting classes should list ArrayScriptConstructor first.
+    """
+
+    # Name of the variable holding the task number. Set by inheriting classes.
+    task_id_var = None
+
+    def get_task_code(self):
+        """ Returns the code executing the script of the current task
+        """
+
+        return """
+# Executing the script of the current task:
+task_script=$(awk -F '\\t' -v task=${task_id_var} 'NR==task {{print $2}}' {task_table})
+echo "Running script: " $task_script
+exec bash $task_script
+""".format(task_id_var=self.task_id_var,
+           task_table=self.task_table)
+
+
+# ----------------------------------------------------------------------------------
+# BundleScriptConstructor defintion
+# ----------------------------------------------------------------------------------
+
+
+class BundleScriptConstructor(TaskScriptConstructor):
+    """ A script running a bundle of tasks as a single job, 'parallel' tasks at a time.
+        The bundle exits with an error if any of its tasks failed.
+        Inheriting classes should list the executor's low level class first, so that its closing lines are added
+        (e.g. marking the bundle as done in run_index).
+    """
+
+    def __init__(self, **kwargs):
+
+        super(BundleScriptConstructor, self).__init__(**kwargs)
+
+        self.parallel = kwargs.get("parallel", 1)
+
+    def get_task_code(self):
+        """ Returns the code executing the scripts of the bundle
+            xargs exits with an error if any of the scripts failed. The error is caught by the ERR trap, which marks
+            the bundle as failed in run_index and the log file and exits, like in any low level script.
+        """
+
+        trap_line = self.get_trap_line()
+        if trap_line:
+            on_error = ""
+        else:
+            # No trap lines. Importing the helper functions and exiting with an error explicitly:
+            trap_line = """
+# Import helper functions
+. {helper_funcs}
+""".format(helper_funcs=self.pipe_data["helper_funcs"])
+            on_error = " || exit 1"
+
+        return """{trap_line}
+
+# Executing the scripts of the bundle, {parallel} at a time:
+cut -f2 {task_table} | xargs -t -n 1 -P {parallel} {shell}{on_error}
+""".format(trap_line=trap_line.rstrip(),
+           parallel=self.parallel,
+           shell=self.shell,
+           task_table=self.task_table,
+           on_error=on_error)
+
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructor defintion
 # ----------------------------------------------------------------------------------
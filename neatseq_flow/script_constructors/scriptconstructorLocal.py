@@ -13,6 +13,25 @@ __version__ = "1.6.0"
 
 
 from .scriptconstructor import *
+from ..modules import local_scheduler
+from ..modules import job_tokens
+
+
+# SGE resources (-l) requesting memory per slot:
+SGE_MEM_RESOURCES = ["h_vmem", "s_vmem", "mem_free", "mem_req", "virtual_free", "h_rss", "mem"]
+
+
+def get_opt_value(opts, names):
+    """ Returns the value of the first option in names set in opts, or None.
+        Options may be set as keys ('--mem': '4G') or, when split from Qsub_opts, with their value ('--mem=4G': '').
+    """
+    for name in names:
+        if opts.get(name) not in [None, ""]:
+            return str(opts[name]).strip()
+        for key in opts:
+            if key.startswith(name + "="):
+                return key[len(name) + 1:].strip()
+    return None
 
 
 class ScriptConstructorLocal(ScriptConstructor):
@@ -26,29 +45,60 @@ class ScriptConstructorLocal(ScriptConstructor):
                         script)
         script = re.sub("## maxvmem calc entry point", 'maxvmem="-";', script)
 
-        # Add job_limit function:
-        if "job_limit" in pipe_data:
+        # Add job_limit function and tokens:
+        if pipe_data.get("job_limit"):
             script += """\
     job_limit={job_limit}
     holdlimit=$(nproc)
     holdlimit=$( echo "0.5*$holdlimit/1" | bc )
 
     wait_limit() {{
+        # The number of running jobs is limited with tokens (see get_token). Waiting while too many jobs are on hold:
         while : ; do
             # Count hold jobs
             numhold=$(grep -v "^#" $run_index | grep -P ".*\.\..*\.\..*\.\." | grep -w -c "hold") || true;
-            maxrun=$(sed -ne "s/limit=\([0-9]*\).*/\\1/p" $job_limit);
-            sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" $job_limit);
             [[ $numhold -ge $holdlimit ]] || break;
-            # Count active (PID) jobs
-            numrun=$(grep -v "^#" $run_index | grep -w -c "PID") || true;
-            [[ $numrun -ge $maxrun ]] || [[ $numhold -ge $holdlimit ]] || break;
-            sleep $sleeptime;
+            sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" $job_limit);
+            sleep ${{sleeptime:-{sleeptime}}};
         done
     }}
-    """.format(job_limit=pipe_data["job_limit"])
-        #        numrun=$(awk 'BEGIN {{jobsc=0}} /^\w/ {{jobsc=jobsc+1}} END {{print jobsc}}' $run_index);
-        #        numrun=$(grep -c '\sPID\s'  $run_index);
+
+get_token() {{
+    # $1: qsubname
+    # Waits for a job_limit token (see job_tokens.py). Low level jobs get the token before reserving their resources,
+    # and hold it while running: The token is returned when the lock on file descriptor {token_fd}, inherited by the
+    # job, is released.
+    token_lock={token_base}.$1.lock
+    exec {token_fd}>$token_lock
+    flock {token_fd}
+    coproc NSF_TOKEN {{ exec {job_tokens} --socket {socket} --job_limit {job_limit} hold --lock $token_lock $1 \\
+        {token_fd}>&- < /dev/null; }}
+    token_out=${{NSF_TOKEN[0]}}
+    token_pid=$NSF_TOKEN_PID
+    while : ; do
+        read -t 3 -u $token_out token && break
+        # Not a timeout: The token process exited without a token
+        (( $? > 128 )) || break
+        if [ -f $run_index.killall ] || [ ! -f $run_index ]; then
+            echo "Stopping while waiting for a job_limit token"
+            kill $token_pid
+            locksed "s:\($1\).*:# \\1\\tkilled:" $run_index
+            kill $$;
+            exit 1;
+        fi
+    done
+    if [[ "$token" != "ok" ]]; then
+        echo "Failed getting a job_limit token for $1"
+        locksed "s:\($1\).*:# \\1\\tERROR:" $run_index
+        exit 1
+    fi
+}}
+""".format(job_limit=pipe_data["job_limit"],
+           sleeptime=pipe_data["Default_wait"],
+           token_fd=job_tokens.TOKEN_FD,
+           job_tokens=cls.get_module_command("job_tokens"),
+           socket=cls.get_token_socket(pipe_data),
+           token_base=os.path.splitext(cls.get_token_socket(pipe_data))[0])
         else:
             pipe_data["job_limit"]=''
             script += """\
@@ -72,22 +122,42 @@ class ScriptConstructorLocal(ScriptConstructor):
             script = re.sub(" bc ", " " + path + " ", script)
         else:
             sys.exit("You need to have the 'bc' program installed")
-    
-    
-    
+
+        if "run_state" in pipe_data:
+            script = re.sub(r"numhold=\$\(grep .*", "numhold=$(run_state count hold --low);", script)
+            script += cls.get_run_state_funcs(pipe_data)
+
         return script
 
     @classmethod
     def get_exec_script(cls, pipe_data):
         """ Not used for SGE. Returning None"""
 
+        if "local_scheduler" in pipe_data:
+            return cls.get_scheduler_exec_script(pipe_data)
+
         script = super(ScriptConstructorLocal, cls).get_exec_script(pipe_data)
 
         # Adding PID after hold in run_index
         script = re.sub("(locksed.*hold)", r"\1\\t$$", script)
         
         script = re.sub("(# local )", r"", script)
-        
+
+        if pipe_data.get("job_limit"):
+            # Low level jobs get a job_limit token once the dependencies are done, before reserving the resources:
+            script = re.sub(r"(\n *)(# Check for available resources *\n *if \(\( \$\(Checkresources)",
+                            r"\1# Waiting for a job_limit token (see get_token in the helper functions):"
+                            r"\1[[ -n $token || $qsubname != *..*..*..* ]] || get_token $qsubname"
+                            r"\1\2",
+                            script)
+
+        # Node capacity set in the parameters replaces the detected one:
+        local_resources = pipe_data.get("local_resources", dict())
+        if local_resources.get("cpus"):
+            script = re.sub("NCPUS=\$\(nproc\)", "NCPUS={cpus}".format(cpus=local_resources["cpus"]), script)
+        if local_resources.get("mem"):
+            script = re.sub("NMEM=\$\(awk .*", "NMEM={mem}".format(mem=local_resources["mem"]), script)
+
         script += """\
 
 # iscsh=$(grep "csh" <<< $script_path)
@@ -100,17 +170,63 @@ class ScriptConstructorLocal(ScriptConstructor):
 # # gpid=$(ps -o pgid= $! | grep -o '[0-9]*')
 # locksed "s:\($qsubname\).*$:\\1\\tPID\\t$!\\t$pe:" $run_index
 
-runlock $qsubname $run_index $script_path $pe
+runlock $qsubname $run_index $script_path $pe $mem
 
 """
-        path = shutil.which("bc")
-        if path:
-            script = re.sub(" bc "," " + path + " ", script)
-        else:
-            sys.exit("You need to have the 'bc' program installed")
-    
         return script
 
+    @classmethod
+    def get_scheduler_exec_script(cls, pipe_data):
+        """ Returns the exec script used with 'local_scheduler': Instead of waiting for the job's dependencies, the
+            job is passed to the run's scheduler daemon (see modules/local_scheduler.py)
+        """
+
+        job_limit = ""
+        if pipe_data.get("job_limit"):
+            job_limit = "    --job_limit {job_limit} \\\n".format(job_limit=pipe_data["job_limit"])
+        if "run_state" in pipe_data:
+            job_limit += "    --run_state {db} \\\n".format(db=pipe_data["run_state_db"])
+        if "event_log" in pipe_data:
+            job_limit += "    --event_log {event_log} \\\n".format(event_log=pipe_data["event_log_file"])
+        local_resources = pipe_data.get("local_resources", dict())
+        for resource in ["cpus", "mem"]:
+            if local_resources.get(resource):
+                job_limit += "    --{resource} {value} \\\n".format(resource=resource, value=local_resources[resource])
+
+        return """\
+#!/bin/bash
+# Passes jobs to the scheduler daemon of the run, starting it if it is not running:
+#   NSF_exec.sh submit <job name> <stdout file> <stderr file>
+#   NSF_exec.sh cancel <job name prefix>    (Kill waiting jobs)
+#   NSF_exec.sh status                      (List waiting and running jobs)
+
+exec {scheduler} \\
+    --socket {socket} \\
+    --run_index {run_index} \\
+    --script_index {script_index} \\
+    --log_file {log_file} \\
+{job_limit}    "$@"
+""".format(scheduler=cls.get_module_command("local_scheduler"),
+           socket=cls.get_scheduler_socket(pipe_data),
+           run_index=pipe_data["run_index"],
+           script_index=pipe_data["script_index"],
+           log_file=pipe_data["log_file"],
+           job_limit=job_limit)
+
+    @classmethod
+    def get_token_socket(cls, pipe_data):
+        """ Returns the path of the socket of the run's job_limit token daemon
+        """
+        return "{dir}NSF_tokens_{run_code}.sock".format(dir=pipe_data["objects_dir"],
+                                                        run_code=pipe_data["run_code"])
+
+    @classmethod
+    def get_scheduler_socket(cls, pipe_data):
+        """ Returns the path of the socket of the run's scheduler daemon
+        """
+        return "{dir}NSF_scheduler_{run_code}.sock".format(dir=pipe_data["objects_dir"],
+                                                           run_code=pipe_data["run_code"])
+
     @classmethod
     def get_utilities_script(cls, pipe_data):
 
@@ -165,6 +281,16 @@ function recover_run {{
                            main=pipe_data["scripts_dir"] + "00.workflow.commands.sh",
                            step_order=pipe_data["step_order"],
                            recover_script=pipe_data["scripts_dir"] + "AA.Recovery_script.sh")
+        if "event_log" in pipe_data:
+            # The failed steps are read from the log file. Writing it from the event log first:
+            recover_script = recover_script.replace("function recover_run {\n",
+                                                    "function recover_run {{\n    bash {script}\n".
+                                                    format(script=pipe_data["event_log_script"]))
+        if "run_state" in pipe_data:
+            # Bringing run_index up to date with the run state database:
+            recover_script = recover_script.replace("function recover_run {\n",
+                                                    "function recover_run {{\n    bash {script} export\n".
+                                                    format(script=pipe_data["run_state_script"]))
 
         return util_script + recover_script
 
@@ -173,6 +299,8 @@ function recover_run {{
     @classmethod
     def get_run_index_clean_script(cls, pipe_data):
             # Create run_index cleaning script
+        if "run_state" in pipe_data:
+            return cls.get_run_state_clean_script(pipe_data)
         return """\
 #!/bin/bash
 sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}\n""".\
@@ -193,6 +321,14 @@ sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1
 
         if "slow_release" in list(self.params.keys()):
             sys.exit("Slow release no longer supported. Use 'job_limit'")
+        elif "local_scheduler" in self.pipe_data:
+            # The job is registered by the scheduler daemon, which writes the job's output to the files:
+            script += """\
+bash {nsf_exec} submit {script_id} {stdout} {stderr}\n\n""".\
+                format(script_id = self.script_id,
+                       nsf_exec = self.pipe_data["exec_script"],
+                       stderr = "{dir}{id}.e".format(dir=stderr_dir, id=self.script_id),
+                       stdout = "{dir}{id}.o".format(dir=stdout_dir, id=self.script_id))
         else:
             script += """\
 bash {nsf_exec} {script_id} 1> {stdout} 2> {stderr} & \n\n""".\
@@ -323,6 +459,15 @@ class HighScriptConstructorLocal(ScriptConstructorLocal,HighScriptConstructor):
         
         command = super(HighScriptConstructorLocal, self).get_command()
 
+        if "local_scheduler" in self.pipe_data:
+            # Jobs are registered by the scheduler daemon before the command returns. No need to wait.
+            return """
+# ---------------- Code for {script_id} ------------------
+echo running {script_id}
+{command}
+""".format(script_id=self.script_id,
+           command=command)
+
         job_limit = ""
 
         if "job_limit" in list(self.pipe_data.keys()):
@@ -353,16 +498,23 @@ sleep {sleep_time}
             spec_qsub_name is the qsub name without the run code (see caller)
         """
 
+        if "local_scheduler" in self.pipe_data:
+            # job_limit is applied by the scheduler daemon
+            return """
+# ---------------- Code for {script_id} ------------------
+{child_cmd}
+""".format(script_id=script_obj.script_id,
+           child_cmd=script_obj.get_command())
+
         job_limit = ""
 
+        # wait_limit waits while too many jobs are on hold. With job_limit, the number of running jobs is limited when
+        # the jobs start (see get_token in the helper script and modules/job_tokens.py):
         if "job_limit" in list(self.pipe_data.keys()):
             job_limit = """\
 # Sleeping while jobs exceed limit
 wait_limit
-"""#.format(limit_file=self.pipe_data["job_limit"],
-    #       run_index=self.pipe_data["run_index"])
-
-# """while : ; do numrun=$(egrep -c "^\w" {run_index}); maxrun=$(sed -ne "s/limit=\([0-9]*\).*/\\1/p" {limit_file}); sleeptime=$(sed -ne "s/.*sleep=\([0-9]*\).*/\\1/p" {limit_file}); [[ $numrun -ge $maxrun ]] || break; sleep $sleeptime; done"""
+"""
         script = """
 # ---------------- Code for {script_id} ------------------
 {job_limit}
@@ -377,6 +529,14 @@ sleep {sleep_time}
 
         return script
 
+    def get_task_command(self, script_obj):
+        """ Writing task script execution lines to high level script.
+            The tasks are first marked as queued in run_index, so that jobs depending on them wait until they are
+            done.
+        """
+
+        return self.get_queue_tasks_command(script_obj) + self.get_child_command(script_obj)
+
     def get_script_postamble(self):
         """ Local script postamble is same as general postamble with addition of sed command to mark as finished in run_index
         """
@@ -422,14 +582,38 @@ class LowScriptConstructorLocal(ScriptConstructorLocal, LowScriptConstructor):
 
         
         general_header = super(LowScriptConstructorLocal, self).get_script_header(**kwargs)
-        
-        qsub_opt = '-pe'
-        if qsub_opt in self.params["qsub_params"]["opts"]:
-            general_header += "\n#$ {key} {val}\n".format(key=qsub_opt, val=self.params["qsub_params"]["opts"][qsub_opt]) 
-        else:
-            general_header += "\n#$ {key} {val}\n".format(key=qsub_opt, val='1') 
+
+        # The resources requested by the job, for starting it only when the node has them free (see NSF_exec.sh)
+        pe, mem = self.get_requested_resources()
+        general_header += "\n#$ -pe {val}\n".format(val=pe)
+        if mem:
+            general_header += "#$ -mem {val}\n".format(val=mem)
         return general_header + "\n\n"
 
+    def get_requested_resources(self):
+        """ Returns the CPUs ('-pe' value) and memory (in MB, or None) requested in the qsub opts.
+            SLURM style options are used as well: -c (--cpus-per-task), --mem and --mem-per-cpu.
+            SGE memory requests with -l (e.g. h_vmem=4G) are per slot.
+        """
+        opts = self.params["qsub_params"]["opts"]
+
+        pe = get_opt_value(opts, ["-pe"]) or get_opt_value(opts, ["-c", "--cpus-per-task"]) or "1"
+        cpus = max(local_scheduler.get_leading_number(pe), 1)
+
+        mem = get_opt_value(opts, ["--mem"])
+        if mem is not None:
+            return pe, local_scheduler.parse_mem_size(mem)
+        mem = get_opt_value(opts, ["--mem-per-cpu"])
+        if mem is not None:
+            mem = local_scheduler.parse_mem_size(mem)
+            return pe, mem * cpus if mem else None
+        mem = None
+        for resource in re.split("[,\s]+", get_opt_value(opts, ["-l"]) or ""):
+            name, _, value = resource.partition("=")
+            if name in SGE_MEM_RESOURCES and local_scheduler.parse_mem_size(value, "b"):
+                mem = max(mem or 0, local_scheduler.parse_mem_size(value, "b") * cpus)
+        return pe, mem
+
     def write_script(self):
         # ,
         #              script,
@@ -457,6 +641,18 @@ locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
 """.format(run_index=self.pipe_data["run_index"],
            script_id=self.script_id))
 
+# ----------------------------------------------------------------------------------
+# BundleScriptConstructorLocal defintion
+# ----------------------------------------------------------------------------------
+
+
+class BundleScriptConstructorLocal(LowScriptConstructorLocal, BundleScriptConstructor):
+    """ Bundle script for Local. Is marked as done in run_index when all its tasks are done, like any low level script.
+    """
+
+    pass
+
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorLocal defintion
 # ----------------------------------------------------------------------------------
@@ -512,7 +708,19 @@ rm -rf {run_index}.killall
 
 
         # Create one killing routine for all instance jobs:
-        script = """\
+        script = ""
+        if "local_scheduler" in self.pipe_data:
+            # Waiting jobs are held by the scheduler daemon, and have no process to kill:
+            script += """\
+
+# Kill the waiting jobs of the step:
+bash {nsf_exec} cancel '{step}{sep}{name}{sep}'
+""".format(nsf_exec=self.pipe_data["exec_script"],
+           step=caller_script.step,
+           name=caller_script.name,
+           sep=caller_script.master.jid_name_sep)
+
+        script += """\
 
 # 1. Find lines for step instance
 # 2. Keep only lines containing hold or PID
@@ -520,7 +728,7 @@ rm -rf {run_index}.killall
 # 4. Create kill commands on pgids
 # 5. Uniqify - several commands will have same pgid!
 # 6. Execute commands
-grep '^{step}{sep}{name}' {run_index} \\
+{index_lines} \\
     | sed -En '/\\t(PID|hold)\\t/p' \\
     | cut -f3 \\
     | while read item1; do
@@ -529,10 +737,9 @@ grep '^{step}{sep}{name}' {run_index} \\
     | sort -u \
     | xargs -I {{}} sh -c "kill -- -{{}}"
 
-""".format(run_index = self.pipe_data["run_index"],
-           step=caller_script.step,
-           name=caller_script.name,
-           sep=caller_script.master.jid_name_sep)
+""".format(index_lines=self.get_index_lines_command("{step}{sep}{name}".format(step=caller_script.step,
+                                                                                name=caller_script.name,
+                                                                                sep=caller_script.master.jid_name_sep)))
 
         self.filehandle.write(script)
 
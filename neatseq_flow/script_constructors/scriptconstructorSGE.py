@@ -462,6 +462,36 @@ class LowScriptConstructorSGE(ScriptConstructorSGE,LowScriptConstructor):
                           qsub_queue,
                           qsub_opts]).replace("\n\n", "\n") + "\n\n"
 
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructorSGE definition
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructorSGE(ArrayScriptConstructor, LowScriptConstructorSGE):
+    """ Array script for SGE. Uses the low level script header, so the tasks are sent with the step's qsub params.
+    """
+
+    task_id_var = "SGE_TASK_ID"
+
+    def get_task_header(self):
+        """ Returns the qsub line defining the array tasks
+        """
+
+        return "#$ -t 1-{task_num}".format(task_num=len(self.tasks))
+
+
+# ----------------------------------------------------------------------------------
+# BundleScriptConstructorSGE definition
+# ----------------------------------------------------------------------------------
+
+
+class BundleScriptConstructorSGE(LowScriptConstructorSGE, BundleScriptConstructor):
+    """ Bundle script for SGE. Uses the low level script header, so the bundle is sent with the step's qsub params.
+    """
+
+    pass
+
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorSGE definition
 # ----------------------------------------------------------------------------------
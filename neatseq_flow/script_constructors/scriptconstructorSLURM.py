@@ -40,6 +40,9 @@ wait_limit() {{
 }}
 """.format(job_limit=pipe_data["job_limit"])
 #        numrun=$(awk 'BEGIN {{jobsc=0}} /^\w/ {{jobsc=jobsc+1}} END {{print jobsc}}' $run_index);
+        if "run_state" in pipe_data:
+            script = re.sub(r"numrun=\$\(grep .*", "numrun=$(run_state count PID);", script)
+            script += cls.get_run_state_funcs(pipe_data)
         return script
 
     @classmethod
@@ -59,6 +62,8 @@ locksed "s:\($qsubname\).*$:\\1\\trunning\\t$jobid:" $run_index
     @classmethod
     def get_run_index_clean_script(cls, pipe_data):
 
+        if "run_state" in pipe_data:
+            return cls.get_run_state_clean_script(pipe_data)
         return """\
 #!/bin/bash
 sed -i -E -e 's/^([^#][^[[:space:]]+).*/# \\1/g' -e 's/^(# [^[[:space:]]+).*/\\1/g' {run_index}\n""".\
@@ -259,6 +264,14 @@ sleep {sleep_time}
             
         return script
 
+    def get_task_command(self, script_obj):
+        """ Writing task script submission lines to high level script.
+            The tasks are first marked as queued in run_index, so that jobs depending on them wait until they are
+            done.
+        """
+
+        return self.get_queue_tasks_command(script_obj) + self.get_child_command(script_obj)
+
     def get_script_postamble(self):
         """ Local script postamble is same as general postamble with addition of sed command to mark as finished in run_index
         """
@@ -349,6 +362,37 @@ locksed  "s:^\({script_id}\).*:# \\1\\tdone:" {run_index}
 """.format(run_index = self.pipe_data["run_index"],
            script_id = self.script_id))
 
+# ----------------------------------------------------------------------------------
+# ArrayScriptConstructorSLURM definition
+# ----------------------------------------------------------------------------------
+
+
+class ArrayScriptConstructorSLURM(ArrayScriptConstructor, LowScriptConstructorSLURM):
+    """ Array script for SLURM. Uses the low level script header, so the tasks are sent with the step's sbatch params.
+        The array is waited for and submitted by the exec script, like any other low level script.
+    """
+
+    task_id_var = "SLURM_ARRAY_TASK_ID"
+
+    def get_task_header(self):
+        """ Returns the sbatch line defining the array tasks
+        """
+
+        return "#SBATCH --array 1-{task_num}".format(task_num=len(self.tasks))
+
+
+# ----------------------------------------------------------------------------------
+# BundleScriptConstructorSLURM definition
+# ----------------------------------------------------------------------------------
+
+
+class BundleScriptConstructorSLURM(LowScriptConstructorSLURM, BundleScriptConstructor):
+    """ Bundle script for SLURM. Is marked as done in run_index when all its tasks are done, like any low level script.
+    """
+
+    pass
+
+
 # ----------------------------------------------------------------------------------
 # KillScriptConstructorSLURM defintion
 # ----------------------------------------------------------------------------------
@@ -388,16 +432,15 @@ rm -rf {run_index}.killall
 
         # Create one killing routine for all instance jobs:
         script = """\
-line2kill=$(grep '^{step}{sep}{name}' {run_index} | awk '{{print $3}}')
+line2kill=$({index_lines} | awk '{{print $3}}')
 line2kill=(${{line2kill//,/ }})
 for item1 in "${{line2kill[@]}}"; do 
     echo running "scancel --full --signal TERM $item1"
     scancel --full --signal TERM $item1 
 done
 
-""".format(run_index = self.pipe_data["run_index"],
-           step=caller_script.step,
-           name=caller_script.name,
-           sep=caller_script.master.jid_name_sep)
+""".format(index_lines=self.get_index_lines_command("{step}{sep}{name}".format(step=caller_script.step,
+                                                                                name=caller_script.name,
+                                                                                sep=caller_script.master.jid_name_sep)))
 
         self.filehandle.write(script)
@@ -17,7 +17,8 @@ setup(
     packages            = find_packages(),
     include_package_data= True,  # See  MANIFEST.in
     scripts             = ['bin/neatseq_flow_monitor.py',
-                            'bin/neatseq_flow.py'],
+                            'bin/neatseq_flow.py',
+                            'bin/neatseq_flow_benchmark.py'],
                             # 'etc/activate.d/env_vars.sh',
                             # 'etc/deactivate.d/env_vars.sh'],
     data_files          = [('NeatSeq-Flow-Workflows',['Workflows/RNA_seq_Trinity.yaml']),